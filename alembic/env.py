@@ -7,7 +7,8 @@ from sqlalchemy.ext.asyncio import async_engine_from_config
 
 from alembic import context
 
-from service.config import db_url
+from service import migrations
+from service.config import get_shard_url
 from service.models import Base
 
 # this is the Alembic Config object, which provides
@@ -19,7 +20,11 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
-config.set_main_option('sqlalchemy.url', db_url.render_as_string(hide_password=False))
+# `alembic -x shard=N ...` migrates the N-th of DATABASE_SHARDS instead of the main database.
+# `-x lock_timeout=...` and `-x dry_run=true` are described in service.migrations.
+x_arguments = context.get_x_argument(as_dictionary=True)
+shard = int(x_arguments.get('shard', 0))
+config.set_main_option('sqlalchemy.url', get_shard_url(shard).render_as_string(hide_password=False))
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -57,9 +62,28 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def include_name(name: str | None, type_: str, parent_names: dict) -> bool:
+    return not (type_ == 'table' and name == migrations.PROGRESS_TABLE)
+
+
 def do_run_migrations(connection: Connection) -> None:
-    context.configure(connection=connection, target_metadata=target_metadata)
+    migrations.configure(connection, x_arguments)
+
+    if migrations.options.dry_run:
+        # Alembic leaves a transaction begun here alone, so all of it is rolled back.
+        with connection.begin() as transaction:
+            context.configure(connection=connection, target_metadata=target_metadata, include_name=include_name)
+            context.run_migrations()
+            transaction.rollback()
+        return
 
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        include_name=include_name,
+        # Locks are held until commit, so each migration commits on its own.
+        transaction_per_migration=True
+    )
     with context.begin_transaction():
         context.run_migrations()
 
@@ -0,0 +1,102 @@
+"""Intern product names
+
+The expand half: products and check_products.product_id are added and
+filled while check_products.name stays, so the code before and after it
+both work against this schema. Until the contract revision 7b3f9d1c4a60
+drops it, a trigger fills in whichever of name and product_id an insert
+leaves out.
+
+Revision ID: 33db67619002
+Revises: 5d1f0c7be2a4
+Create Date: 2026-10-19 14:29:33.290141
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from service.migrations import backfill, set_not_null, validate_constraint
+
+
+# revision identifiers, used by Alembic.
+revision: str = '33db67619002'
+down_revision: Union[str, None] = '5d1f0c7be2a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+INTERN_PRODUCT_NAME = """
+CREATE OR REPLACE FUNCTION intern_product_name(product_name VARCHAR) RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    interned INTEGER;
+BEGIN
+    SELECT id INTO interned FROM products WHERE name = product_name;
+    IF interned IS NULL THEN
+        INSERT INTO products (name) VALUES (product_name) ON CONFLICT (name) DO NOTHING RETURNING id INTO interned;
+    END IF;
+    IF interned IS NULL THEN
+        SELECT id INTO interned FROM products WHERE name = product_name;
+    END IF;
+    RETURN interned;
+END
+$$
+"""
+
+SET_CHECK_PRODUCT_ID = """
+CREATE OR REPLACE FUNCTION set_check_product_id() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.product_id IS NULL THEN
+        NEW.product_id := intern_product_name(NEW.name);
+    ELSIF NEW.name IS NULL THEN
+        SELECT name INTO NEW.name FROM products WHERE id = NEW.product_id;
+    END IF;
+    RETURN NEW;
+END
+$$
+"""
+
+CREATE_TRIGGER = """
+CREATE TRIGGER check_products_set_product_id BEFORE INSERT ON check_products
+FOR EACH ROW EXECUTE FUNCTION set_check_product_id()
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('products',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_index('idx_products_name_trgm', 'products', ['name'], unique=False, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.add_column('check_products', sa.Column('product_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        'check_products_product_id_fkey', 'check_products', 'products', ['product_id'], ['id'],
+        postgresql_not_valid=True
+    )
+
+    # Rows the old code inserts with just a name get their id on the way in,
+    # the existing ones from the backfill; rows the new code inserts with
+    # just an id get their name, for the old code still reading them.
+    op.execute(INTERN_PRODUCT_NAME)
+    op.execute(SET_CHECK_PRODUCT_ID)
+    op.execute(CREATE_TRIGGER)
+    backfill(
+        'check_products_product_id', 'check_products',
+        set_='product_id = intern_product_name(name)', where='check_products.product_id IS NULL'
+    )
+    validate_constraint('check_products', 'check_products_product_id_fkey')
+    set_not_null('check_products', 'product_id')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER check_products_set_product_id ON check_products')
+    op.execute('DROP FUNCTION set_check_product_id()')
+    op.execute('DROP FUNCTION intern_product_name(VARCHAR)')
+    op.drop_constraint('check_products_product_id_fkey', 'check_products', type_='foreignkey')
+    op.drop_column('check_products', 'product_id')
+    op.drop_index('idx_products_name_trgm', table_name='products', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.drop_table('products')
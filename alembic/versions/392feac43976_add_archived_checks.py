@@ -0,0 +1,41 @@
+"""Add archived_checks
+
+Revision ID: 392feac43976
+Revises: eb2e3980e96c
+Create Date: 2026-10-19 17:21:44.918273
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '392feac43976'
+down_revision: Union[str, None] = 'eb2e3980e96c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('archived_checks',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('public_id', sa.CHAR(length=25), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.Column('payload', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_archived_checks_public_id'), 'archived_checks', ['public_id'], unique=True)
+    op.create_index(op.f('ix_archived_checks_user_id'), 'archived_checks', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_archived_checks_user_id'), table_name='archived_checks')
+    op.drop_index(op.f('ix_archived_checks_public_id'), table_name='archived_checks')
+    op.drop_table('archived_checks')
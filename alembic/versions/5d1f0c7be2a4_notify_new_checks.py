@@ -0,0 +1,39 @@
+"""Notify new checks
+
+Revision ID: 5d1f0c7be2a4
+Revises: 28947b1551aa
+Create Date: 2026-10-19 20:48:05.913276
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d1f0c7be2a4'
+down_revision: Union[str, None] = '28947b1551aa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("""
+CREATE OR REPLACE FUNCTION notify_new_checks() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('new_checks', user_id::text) FROM (SELECT DISTINCT user_id FROM new_checks) AS users;
+    RETURN NULL;
+END
+$$
+""")
+    op.execute("""
+CREATE TRIGGER checks_notify_new AFTER INSERT ON checks
+REFERENCING NEW TABLE AS new_checks FOR EACH STATEMENT EXECUTE FUNCTION notify_new_checks()
+""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER checks_notify_new ON checks')
+    op.execute('DROP FUNCTION notify_new_checks()')
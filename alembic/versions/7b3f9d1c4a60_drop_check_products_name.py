@@ -0,0 +1,87 @@
+"""Drop check_products name
+
+The contract half of 33db67619002: drops check_products.name, its trigram
+index and the trigger that kept it and product_id in step. Run it only
+once no code that reads or writes the name is left running (see "Schema
+migrations" in the README). The downgrade brings them back for the code
+that reads names while the current code still inserts without them.
+
+Revision ID: 7b3f9d1c4a60
+Revises: c51a7e93d2f8
+Create Date: 2026-10-20 11:02:18.340517
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from service.migrations import backfill, create_index_concurrently, drop_index_concurrently, set_not_null
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b3f9d1c4a60'
+down_revision: Union[str, None] = 'c51a7e93d2f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+INTERN_PRODUCT_NAME = """
+CREATE OR REPLACE FUNCTION intern_product_name(product_name VARCHAR) RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    interned INTEGER;
+BEGIN
+    SELECT id INTO interned FROM products WHERE name = product_name;
+    IF interned IS NULL THEN
+        INSERT INTO products (name) VALUES (product_name) ON CONFLICT (name) DO NOTHING RETURNING id INTO interned;
+    END IF;
+    IF interned IS NULL THEN
+        SELECT id INTO interned FROM products WHERE name = product_name;
+    END IF;
+    RETURN interned;
+END
+$$
+"""
+
+SET_CHECK_PRODUCT_ID = """
+CREATE OR REPLACE FUNCTION set_check_product_id() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.product_id IS NULL THEN
+        NEW.product_id := intern_product_name(NEW.name);
+    ELSIF NEW.name IS NULL THEN
+        SELECT name INTO NEW.name FROM products WHERE id = NEW.product_id;
+    END IF;
+    RETURN NEW;
+END
+$$
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('DROP TRIGGER check_products_set_product_id ON check_products')
+    op.execute('DROP FUNCTION set_check_product_id()')
+    op.execute('DROP FUNCTION intern_product_name(VARCHAR)')
+    drop_index_concurrently('idx_check_products_name_trgm', table_name='check_products')
+    op.drop_column('check_products', 'name')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('check_products', sa.Column('name', sa.VARCHAR(length=255), autoincrement=False, nullable=True))
+    op.execute(INTERN_PRODUCT_NAME)
+    op.execute(SET_CHECK_PRODUCT_ID)
+    op.execute("""
+CREATE TRIGGER check_products_set_product_id BEFORE INSERT ON check_products
+FOR EACH ROW EXECUTE FUNCTION set_check_product_id()
+""")
+    backfill(
+        'check_products_name', 'check_products',
+        set_='name = (SELECT products.name FROM products WHERE products.id = check_products.product_id)',
+        where='check_products.name IS NULL'
+    )
+    set_not_null('check_products', 'name')
+    create_index_concurrently(
+        'idx_check_products_name_trgm', 'check_products', ['name'], unique=False,
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+    )
@@ -0,0 +1,32 @@
+"""Add checks user_id/id index
+
+Revision ID: 8e810269ecdc
+Revises: bdc0cb3ffdb5
+Create Date: 2026-10-19 12:40:11.204117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from service.migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e810269ecdc'
+down_revision: Union[str, None] = 'bdc0cb3ffdb5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    create_index_concurrently(
+        'idx_checks_user_id_id_desc', 'checks', ['user_id', sa.literal_column('id DESC')], unique=False
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    drop_index_concurrently('idx_checks_user_id_id_desc', table_name='checks')
@@ -0,0 +1,33 @@
+"""Add shard_map
+
+Revision ID: 9a3cc0556368
+Revises: 11ea7af2d629
+Create Date: 2026-10-19 19:31:30.914676
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a3cc0556368'
+down_revision: Union[str, None] = '11ea7af2d629'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('shard_map',
+    sa.Column('bucket', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.SmallInteger(), nullable=False),
+    sa.Column('moving', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('shard_map')
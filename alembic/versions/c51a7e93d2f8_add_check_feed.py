@@ -0,0 +1,63 @@
+"""Add check feed
+
+New checks are recorded in `check_feed` by the trigger that notifies them,
+under the id of the transaction that inserted them, so that `service.feed`
+reads them in commit-safe order. Transactions that copy existing checks set
+`checkbox.skip_check_feed` to keep them out. Checks inserted before this
+revision are not in the feed: clients holding an old numeric cursor start
+over from now.
+
+Revision ID: c51a7e93d2f8
+Revises: 33db67619002
+Create Date: 2026-10-20 10:14:37.551902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c51a7e93d2f8'
+down_revision: Union[str, None] = '33db67619002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('check_feed',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('xact_id', sa.BigInteger(), server_default=sa.text('pg_current_xact_id()::text::bigint'), nullable=False),
+    sa.Column('check_id', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text("TIMEZONE('utc', CURRENT_TIMESTAMP)"), nullable=False),
+    sa.PrimaryKeyConstraint('user_id', 'xact_id', 'check_id')
+    )
+    op.create_index('idx_check_feed_created_at', 'check_feed', ['created_at'], unique=False, postgresql_using='brin')
+    op.execute("""
+CREATE OR REPLACE FUNCTION notify_new_checks() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF current_setting('checkbox.skip_check_feed', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO check_feed (user_id, check_id) SELECT user_id, id FROM new_checks;
+    PERFORM pg_notify('new_checks', user_id::text) FROM (SELECT DISTINCT user_id FROM new_checks) AS users;
+    RETURN NULL;
+END
+$$
+""")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("""
+CREATE OR REPLACE FUNCTION notify_new_checks() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('new_checks', user_id::text) FROM (SELECT DISTINCT user_id FROM new_checks) AS users;
+    RETURN NULL;
+END
+$$
+""")
+    op.drop_index('idx_check_feed_created_at', table_name='check_feed', postgresql_using='brin')
+    op.drop_table('check_feed')
@@ -0,0 +1,35 @@
+"""Add check_products name search
+
+Revision ID: eb2e3980e96c
+Revises: 8e810269ecdc
+Create Date: 2026-10-19 12:52:37.510284
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from service.migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'eb2e3980e96c'
+down_revision: Union[str, None] = '8e810269ecdc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    create_index_concurrently(op.f('ix_check_products_check_id'), 'check_products', ['check_id'], unique=False)
+    create_index_concurrently(
+        'idx_check_products_name_trgm', 'check_products', ['name'], unique=False,
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    drop_index_concurrently('idx_check_products_name_trgm', table_name='check_products')
+    drop_index_concurrently(op.f('ix_check_products_check_id'), table_name='check_products')
@@ -0,0 +1,110 @@
+"""Hot table size and list latency before and after archiving old checks.
+
+Seeds the database configured through the usual DATABASE_* variables the way
+`benchmarks.product_search` does (check dates spread over the last year),
+then reports the size of the hot and archive tables, `Check.get_list` latency
+for the busiest user and single-check lookup latency:
+
+- before archiving;
+- after `archive_checks` and a plain VACUUM, which makes the space reusable
+  but does not give it back;
+- after VACUUM FULL, which rewrites the hot tables at their new size.
+
+    python -m benchmarks.archive --checks 250000 --older-than-days 90
+"""
+import argparse
+import asyncio
+import datetime
+import statistics
+import time
+
+from sqlalchemy import text
+
+from benchmarks.product_search import seed
+from service import schemas
+from service.archive import archive_checks
+from service.config import async_session_factory, db_engine
+from service.models import Check
+from service.routers.checks import get_check
+
+
+TABLES = ['checks', 'check_products', 'archived_checks']
+
+
+def timed_ms(timings: list[float]) -> str:
+    timings = sorted(timings)
+    return f'p50={statistics.median(timings):.2f}ms p95={timings[int(len(timings) * 0.95) - 1]:.2f}ms'
+
+
+async def report(stage: str, runs: int, user_id: int, public_ids: dict[str, str]) -> None:
+    async with async_session_factory() as session:
+        sizes = (await session.execute(text(
+            'SELECT ' + ', '.join(f"pg_total_relation_size('{table}')" for table in TABLES)
+        ))).one()
+        print(f'{stage}: ' + ' '.join(f'{table}={size / 2 ** 20:.1f}MB' for table, size in zip(TABLES, sizes)))
+
+        for name, filters in [('list', schemas.CheckListFilters()), ('product', schemas.CheckListFilters(product='молоко'))]:
+            params = schemas.CheckListParams(filters=filters, order='-created_at', page=1, page_size=25)
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                _, total = await Check.get_list(session=session, user_id=user_id, params=params)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f'    {name:<8} total={total:<6} {timed_ms(timings)}')
+
+        for name, public_id in public_ids.items():
+            timings = []
+            for _ in range(runs):
+                session.expunge_all()
+                started = time.perf_counter()
+                await get_check(session=session, public_id=public_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f'    get {name:<4} {timed_ms(timings)}')
+
+
+async def vacuum(full: bool) -> None:
+    async with db_engine.connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.execute(text(f'VACUUM {"(FULL, ANALYZE)" if full else "ANALYZE"} checks, check_products'))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--checks', type=int, default=250_000)
+    parser.add_argument('--products-per-check', type=int, default=8)
+    parser.add_argument('--older-than-days', type=int, default=90)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        await seed(args.users, args.checks, args.products_per_check)
+
+    cutoff = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) \
+        - datetime.timedelta(days=args.older_than_days)
+    async with async_session_factory() as session:
+        user_id = await session.scalar(text(
+            'SELECT user_id FROM checks GROUP BY user_id ORDER BY count(*) DESC LIMIT 1'
+        ))
+        public_ids = {
+            'new': await session.scalar(text('SELECT public_id FROM checks ORDER BY id DESC LIMIT 1')),
+            'old': await session.scalar(
+                text('SELECT public_id FROM checks WHERE created_at < :cutoff LIMIT 1'), {'cutoff': cutoff}
+            ),
+        }
+    await report('before', args.runs, user_id, public_ids)
+
+    started = time.perf_counter()
+    archived = await archive_checks(cutoff=cutoff, batch_size=args.batch_size)
+    print(f'archived {archived} checks in {time.perf_counter() - started:.1f}s')
+    await vacuum(full=False)
+    await report('after VACUUM', args.runs, user_id, public_ids)
+    await vacuum(full=True)
+    await report('after VACUUM FULL', args.runs, user_id, public_ids)
+    await db_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+"""A TCP proxy for putting a slow or unreliable network between the service and Postgres.
+
+Everything Postgres sends back is held for `latency_ms` plus a uniformly
+random 0 to `jitter_ms`, then let through at no more than `bandwidth_kbps`;
+order is kept, so a delayed packet delays the ones behind it, as on a real
+link. With `reset_rate`, every packet has that chance of resetting its
+connection (an RST to both ends), as a failover or a dropped NAT entry would.
+The faults can be changed while it runs and apply to open connections too.
+
+`benchmarks.tail_latency` starts one in process. To use it by hand, point
+DATABASE_HOST and DATABASE_PORT of the service at it:
+
+    python -m benchmarks.db_proxy --port 6432 --latency-ms 20 --jitter-ms 30 --reset-rate 0.0001
+"""
+import argparse
+import asyncio
+import random
+import socket
+import struct
+import time
+
+from dataclasses import dataclass
+
+from service.config import settings
+
+
+@dataclass
+class Faults:
+    latency_ms: float = 0
+    jitter_ms: float = 0
+    bandwidth_kbps: float | None = None  # kilobytes per second, per connection and direction
+    reset_rate: float = 0
+
+
+class Reset(Exception):
+    pass
+
+
+class DbProxy:
+
+    def __init__(self, upstream_host: str, upstream_port: int, faults: Faults | None = None, random_seed: int = 0):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.faults = faults or Faults()
+        self.connections = 0
+        self.resets = 0
+        self._rng = random.Random(random_seed)
+        self._server: asyncio.Server | None = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self._server = await asyncio.start_server(self._handle, host, port)
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self) -> 'DbProxy':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def _handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+        except OSError:
+            client_writer.close()
+            return
+
+        pipes = [
+            asyncio.create_task(self._forward(client_reader, upstream_writer, faulty=False)),
+            asyncio.create_task(self._forward(upstream_reader, client_writer, faulty=True)),
+        ]
+        done, pending = await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        reset = any(isinstance(task.exception(), Reset) for task in done if not task.cancelled())
+        for writer in (client_writer, upstream_writer):
+            if reset:
+                # SO_LINGER 0: closing sends an RST instead of a FIN
+                writer.get_extra_info('socket').setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0)
+                )
+                writer.transport.abort()
+            else:
+                writer.close()
+
+    async def _forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, faulty: bool) -> None:
+        if not faulty:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            return
+
+        # Packets are read as they come and released by a separate writer, so
+        # latency delays them without limiting how many are in flight.
+        packets: asyncio.Queue[tuple[float, bytes]] = asyncio.Queue()
+
+        async def release() -> None:
+            release_at = 0.0
+            while True:
+                arrived_at, data = await packets.get()
+                if not data:
+                    return
+                faults = self.faults
+                delay = (faults.latency_ms + self._rng.uniform(0, faults.jitter_ms)) / 1000
+                release_at = max(release_at, arrived_at + delay)
+                if faults.bandwidth_kbps:
+                    release_at += len(data) / (faults.bandwidth_kbps * 1024)
+                await asyncio.sleep(release_at - time.monotonic())
+                if faults.reset_rate and self._rng.random() < faults.reset_rate:
+                    self.resets += 1
+                    raise Reset()
+                writer.write(data)
+                await writer.drain()
+
+        async def receive() -> None:
+            while data := await reader.read(65536):
+                packets.put_nowait((time.monotonic(), data))
+            packets.put_nowait((time.monotonic(), b''))
+            await asyncio.Event().wait()  # until everything is released
+
+        # Whichever ends first ends both: the releaser once it let the last
+        # packet through or reset the connection.
+        receiver, releaser = asyncio.create_task(receive()), asyncio.create_task(release())
+        try:
+            await asyncio.wait([receiver, releaser], return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                receiver.result()
+            await releaser
+        finally:
+            receiver.cancel()
+            releaser.cancel()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6432)
+    parser.add_argument('--upstream-host', default=settings.database_host)
+    parser.add_argument('--upstream-port', type=int, default=settings.database_port)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-kbps', type=float)
+    parser.add_argument('--reset-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    faults = Faults(args.latency_ms, args.jitter_ms, args.bandwidth_kbps, args.reset_rate)
+    proxy = DbProxy(args.upstream_host, args.upstream_port, faults)
+    await proxy.start(args.host, args.port)
+    print(f'{args.host}:{proxy.port} -> {args.upstream_host}:{args.upstream_port} with {faults}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""Time and memory of creating one check with very many lines.
+
+Posts the same check to POST /checks/ (whole body parsed and validated, one
+ORM object per product, full check in the response) and to POST /checks/large
+(incremental parsing, chunked validation, COPY, summary response). Each
+endpoint runs in its own interpreter; the request is made once untraced for
+wall time and peak RSS, then again under tracemalloc for the Python heap peak.
+The streamed body is generated while it is sent, the regular one is built up
+front as any client would have to. Needs the database configured through the
+usual DATABASE_* variables.
+
+    python -m benchmarks.large_check --lines 100000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import AsyncIterator
+
+
+USERNAME = 'bench_large_check'
+PASSWORD = 'bench_large_check_password'
+PAYMENT = {'type': 'cashless', 'amount': '1000000000.00'}
+
+
+def make_product(n: int) -> dict:
+    return {'name': f'Товар №{n} ваговий, фасування {n % 900 + 100}г', 'price': f'{n % 500 + 1}.99', 'quantity': '1.250'}
+
+
+async def stream_body(lines: int, piece: int = 1000) -> AsyncIterator[bytes]:
+    yield f'{{"payment": {json.dumps(PAYMENT)}, "products": ['.encode()
+    for start in range(0, lines, piece):
+        products = (json.dumps(make_product(n), ensure_ascii=False) for n in range(start, min(start + piece, lines)))
+        yield (',' if start else '').encode() + ','.join(products).encode()
+    yield b']}'
+
+
+async def child(endpoint: str, lines: int) -> dict[str, float]:
+    import httpx
+
+    from service import models, schemas
+    from service.config import get_session_factory
+    from service.main import create_app
+    from service.utils import get_password_hash
+
+    async with get_session_factory()() as session:
+        if not await models.User.get_by_username(session=session, username=USERNAME):
+            user = schemas.UserIn(username=USERNAME, full_name=USERNAME, password=PASSWORD)
+            await models.User.create(session=session, user=user, password_hash=get_password_hash(PASSWORD))
+
+    app = create_app()
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            response = await client.post('/users/login', data={'username': USERNAME, 'password': PASSWORD})
+            headers = {'Authorization': f"Bearer {response.json()['access_token']}", 'Content-Type': 'application/json'}
+
+            async def post() -> None:
+                if endpoint == 'large':
+                    content = stream_body(lines)
+                else:
+                    content = json.dumps(
+                        {'payment': PAYMENT, 'products': [make_product(n) for n in range(lines)]}, ensure_ascii=False
+                    ).encode()
+                response = await client.post(f'/checks/{endpoint}', content=content, headers=headers)
+                response.raise_for_status()
+
+            started = time.perf_counter()
+            await post()
+            results['seconds'] = time.perf_counter() - started
+            results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+            tracemalloc.start()
+            await post()
+            results['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=100_000)
+    parser.add_argument('--child', choices=['', 'large'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        import asyncio
+        print(json.dumps(asyncio.run(child(args.child, args.lines))))
+        return
+
+    for endpoint in ('', 'large'):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.large_check', '--lines', str(args.lines), '--child', endpoint],
+            env=os.environ, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f'POST /checks/{endpoint:<5} lines={args.lines} time={result["seconds"]:.2f}s '
+            f'max_rss={result["max_rss_mb"]:.0f}MB traced_peak={result["traced_peak_mb"]:.1f}MB'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Payload size and latency of GET /checks/ with and without products.
+
+Seeds one user with `benchmarks.seed` into the database configured through
+the usual DATABASE_* variables, then requests full pages of their checks
+through the app (in process, no network) in each mode:
+
+- full: every field, products loaded and serialized;
+- no products: `include_products=false`;
+- dashboard: `fields=id,total,created_at,payment`.
+
+Sizes are of the uncompressed body and of the gzip-encoded one the
+compression middleware sends to clients that accept it.
+
+    python -m benchmarks.list_fields --checks 20000 --products-mean 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks.seed import Distribution, seed
+from service.main import create_app
+
+
+PASSWORD = 'bench_list_fields_password'
+MODES = {
+    'full': '',
+    'no products': '&include_products=false',
+    'dashboard': '&fields=id,total,created_at,payment',
+}
+
+
+def timed_ms(timings: list[float]) -> str:
+    timings = sorted(timings)
+    return f'p50={statistics.median(timings):6.2f}ms p95={timings[int(len(timings) * 0.95) - 1]:6.2f}ms'
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', type=int, default=20_000)
+    parser.add_argument('--products-mean', type=float, default=8)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    distribution = Distribution(
+        products_mean=args.products_mean, products_max=50, cash_share=0.3, start=end - timedelta(days=365), end=end
+    )
+    plan = await seed(users=1, checks=args.checks, distribution=distribution, workers=0, password=PASSWORD)
+
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            response = await client.post(
+                '/users/login', data={'username': f'seed_{plan.first_user_id}', 'password': PASSWORD}
+            )
+            headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+            for name, query in MODES.items():
+                url = f'/checks/?page_size={args.page_size}{query}'
+                sizes = []
+                for encoding in ('identity', 'gzip'):
+                    response = await client.get(url, headers={**headers, 'Accept-Encoding': encoding})
+                    response.raise_for_status()
+                    sizes.append(int(response.headers.get('Content-Length', len(response.content))))
+
+                timings = []
+                for run in range(args.runs):
+                    # a different page each time, so the database does the same work on every run
+                    page = run % max(args.checks // args.page_size, 1) + 1
+                    started = time.perf_counter()
+                    response = await client.get(f'{url}&page={page}', headers={**headers, 'Accept-Encoding': 'identity'})
+                    timings.append((time.perf_counter() - started) * 1000)
+                    response.raise_for_status()
+                print(
+                    f'{name:<12} size={sizes[0] / 1024:7.1f}KB gzip={sizes[1] / 1024:6.1f}KB {timed_ms(timings)}'
+                )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""Cost of money handling with NUMERIC/Decimal versus integer minor units.
+
+Runs the same work once per MONEY_MINOR_UNITS value, each in a fresh
+interpreter, and reports the median time per check:
+
+- validate: `CheckIn` from a decoded JSON body, as the create endpoint does;
+- totals: the `total` and `rest` computed fields on validated checks;
+- serialize: `CheckOut` from loaded rows to JSON, as the list endpoint does;
+- fetch: decoding the money columns of a page of rows with asyncpg.
+
+The fetch step reads generated rows from the database configured through the
+usual DATABASE_* variables and needs no schema.
+
+    python -m benchmarks.money --checks 2000 --products 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+
+FETCH_SQL = {
+    False: 'SELECT (n % 99999)::numeric(12, 2) / 100, (n % 777)::numeric(12, 2) / 100, 100000.00::numeric(12, 2)'
+           ' FROM generate_series(1, $1) AS n',
+    True: 'SELECT (n % 99999)::bigint, (n % 777)::bigint, 10000000::bigint FROM generate_series(1, $1) AS n',
+}
+
+
+def make_body(n: int, products: int) -> dict:
+    return {
+        'products': [
+            {
+                'name': f'товар {n}-{p}',
+                'price': f'{(n * 7 + p) % 5000 + 1}.{p % 100:02d}',
+                'quantity': f'{p % 3 + 1}.{n % 1000:03d}',
+            }
+            for p in range(products)
+        ],
+        'payment': {'type': 'cash', 'amount': '1000000.00'},
+    }
+
+
+def timed(fn, runs: int, per: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) / per * 1e6)
+    return statistics.median(timings)
+
+
+def child(checks: int, products: int, runs: int) -> dict[str, float]:
+    import asyncio
+    import asyncpg
+
+    from service import schemas
+    from service.config import get_db_url, settings
+
+    bodies = [json.loads(json.dumps(make_body(n, products))) for n in range(checks)]
+    results = {'validate': timed(lambda: [schemas.CheckIn.model_validate(body) for body in bodies], runs, checks)}
+
+    def totals() -> None:
+        for check in [schemas.CheckIn.model_validate(body) for body in bodies]:
+            check.rest
+    results['totals'] = max(timed(totals, runs, checks) - results['validate'], 0)
+
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for n, body in enumerate(bodies):
+        check = schemas.CheckIn.model_validate(body)
+        rows.append(SimpleNamespace(
+            public_id=f'ch_{n:022d}', created_at=created_at, total=check.total, rest=check.rest,
+            payment=check.payment.model_dump(),
+            products=[SimpleNamespace(**product.model_dump(exclude={'total'})) for product in check.products],
+        ))
+    page = schemas.TypeAdapter(list[schemas.CheckOut])
+    results['serialize'] = timed(lambda: page.dump_json(page.validate_python(rows), by_alias=True), runs, checks)
+
+    async def fetch() -> float:
+        connection = await asyncpg.connect(get_db_url().set(drivername='postgresql').render_as_string(False))
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            await connection.fetch(FETCH_SQL[settings.money_minor_units], checks * products)
+            timings.append((time.perf_counter() - started) / checks * 1e6)
+        await connection.close()
+        return statistics.median(timings)
+    results['fetch'] = asyncio.run(fetch())
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.checks, args.products, args.runs)))
+        return
+
+    for minor_units in ('false', 'true'):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.money', '--child',
+             '--checks', str(args.checks), '--products', str(args.products), '--runs', str(args.runs)],
+            env={**os.environ, 'MONEY_MINOR_UNITS': minor_units}, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f'{"minor units" if minor_units == "true" else "numeric":<12}'
+            + ''.join(f' {phase}={result[phase]:6.1f}us' for phase in ('validate', 'totals', 'serialize', 'fetch'))
+            + f'  per check of {args.products} products'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Latency of the `product` filter on GET /checks/ at millions of product rows.
+
+Seeds a disposable database (the one configured through the usual DATABASE_*
+variables) with set-based INSERT .. SELECT statements, then times
+`Check.get_list` for a few search terms and prints the query plan.
+
+pg_trgm only extracts trigrams from characters the database locale treats as
+alphanumeric, so run it against a UTF-8 locale (as the postgres image uses);
+under the C locale Cyrillic names get no trigrams and every row is rechecked.
+
+    python -m benchmarks.product_search --checks 500000 --products-per-check 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from sqlalchemy import text
+
+from service import schemas
+from service.config import async_session_factory, db_engine
+from service.models import Base, Check
+
+
+WORDS = [
+    'хліб', 'молоко', 'кефір', 'сир', 'масло', 'олія', 'борошно', 'цукор', 'сіль', 'кава',
+    'чай', 'яблуко', 'банан', 'апельсин', 'картопля', 'морква', 'цибуля', 'гречка', 'рис', 'макарони',
+]
+VARIANTS = ['білий', 'житній', '2.5%', '3.2%', 'органічний', 'пшеничний', 'вищого ґатунку', 'фермерський']
+
+SEED_SQL = [
+    """
+    INSERT INTO users (username, full_name, password_hash, created_at)
+    SELECT 'bench_' || n, 'Bench User ' || n, 'x', now()
+    FROM generate_series(1, :users) AS n
+    ON CONFLICT (username) DO NOTHING
+    """,
+    """
+    INSERT INTO checks (public_id, user_id, total, rest, created_at, payment_type, payment_amount)
+    SELECT
+        'ch_' || lpad(to_hex(n + (SELECT coalesce(max(id), 0) FROM checks)), 22, '0'),
+        (SELECT min(id) FROM users WHERE username LIKE 'bench\\_%') + n % :users,
+        100.00, 0.00,
+        now() - (n % 365) * interval '1 day',
+        (CASE WHEN n % 3 = 0 THEN 'cash' ELSE 'cashless' END)::check_payment_type,
+        100.00
+    FROM generate_series(1, :checks) AS n
+    """,
+    """
+    INSERT INTO products (name)
+    SELECT initcap(word) || ' ' || variant || ' ' || grams::text || 'г'
+    FROM unnest(CAST(:words AS text[])) AS word, unnest(CAST(:variants AS text[])) AS variant,
+        generate_series(100, 999) AS grams
+    ON CONFLICT (name) DO NOTHING
+    """,
+    """
+    INSERT INTO check_products (check_id, product_id, price, quantity)
+    SELECT
+        c.id,
+        products.id,
+        ((c.id + p) % 500 + 1)::numeric(10, 2),
+        1.000
+    FROM checks c
+    CROSS JOIN generate_series(1, :products_per_check) AS p
+    JOIN products ON products.name =
+        initcap((CAST(:words AS text[]))[1 + (c.id * 7 + p) % cardinality(CAST(:words AS text[]))]) || ' '
+            || (CAST(:variants AS text[]))[1 + (c.id + p * 3) % cardinality(CAST(:variants AS text[]))] || ' '
+            || (100 + (c.id + p) % 900)::text || 'г'
+    WHERE c.user_id IN (SELECT id FROM users WHERE username LIKE 'bench\\_%')
+      AND NOT EXISTS (SELECT 1 FROM check_products cp WHERE cp.check_id = c.id)
+    """,
+]
+
+
+async def seed(users: int, checks: int, products_per_check: int) -> None:
+    async with db_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        params = {
+            'users': users, 'checks': checks, 'products_per_check': products_per_check,
+            'words': WORDS, 'variants': VARIANTS,
+        }
+        for sql in SEED_SQL:
+            started = time.perf_counter()
+            await conn.execute(text(sql), params)
+            print(f'seed step done in {time.perf_counter() - started:.1f}s')
+    async with db_engine.connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        await conn.execute(text('VACUUM ANALYZE checks, check_products, products'))
+
+
+async def bench(term: str, runs: int) -> None:
+    async with async_session_factory() as session:
+        user_id = await session.scalar(text(
+            "SELECT user_id FROM checks GROUP BY user_id ORDER BY count(*) DESC LIMIT 1"
+        ))
+        params = schemas.CheckListParams(
+            filters=schemas.CheckListFilters(product=term),
+            order='-created_at', page=1, page_size=25
+        )
+
+        timings = []
+        total = None
+        for _ in range(runs):
+            started = time.perf_counter()
+            _, total = await Check.get_list(session=session, user_id=user_id, params=params)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        page_stmt = Check.ListStmtBuilder(
+            init_stmt=Check.__table__.select().where(Check.user_id == user_id), params=params, user_id=user_id
+        ).add_filters().add_order().add_pagination().build()
+        compiled = page_stmt.compile(db_engine.sync_engine, compile_kwargs={'literal_binds': True})
+        plan = (await session.execute(text(f'EXPLAIN (ANALYZE, BUFFERS) {compiled}'))).scalars().all()
+
+    timings.sort()
+    print(
+        f'{term!r}: matches={total} '
+        f'p50={statistics.median(timings):.1f}ms '
+        f'p95={timings[int(len(timings) * 0.95) - 1]:.1f}ms '
+        f'max={timings[-1]:.1f}ms'
+    )
+    print('\n'.join(f'    {line}' for line in plan))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--checks', type=int, default=250_000)
+    parser.add_argument('--products-per-check', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--term', action='append', dest='terms')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        await seed(args.users, args.checks, args.products_per_check)
+    for term in args.terms or ['молоко', 'гречка органічний', 'житній 5', 'немає такого']:
+        await bench(term, args.runs)
+    await db_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""Size of check products with names interned in `products` versus stored inline.
+
+Seeds the database configured through the usual DATABASE_* variables with
+`benchmarks.seed`, then rebuilds the same rows the way they were stored
+before the `products` table, with the name in every `check_products` row and
+its trigram index, and compares table and index sizes and the time of the
+`product` filter of GET /checks/ for the busiest user on both, written the
+way `Check.ListStmtBuilder` builds it for each layout.
+
+    python -m benchmarks.product_storage --checks 1000000 --products-mean 5
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from benchmarks.seed import Distribution, seed
+from service.config import get_db_engine, get_session_factory
+
+INLINE_TABLE = 'bench_check_products_inline'
+
+BUILD_INLINE = [
+    f'DROP TABLE IF EXISTS {INLINE_TABLE}',
+    f"""
+    CREATE TABLE {INLINE_TABLE} AS
+    SELECT check_products.id, check_products.check_id, products.name::VARCHAR(255) AS name,
+        check_products.price, check_products.quantity
+    FROM check_products JOIN products ON products.id = check_products.product_id
+    ORDER BY check_products.id
+    """,
+    f'ALTER TABLE {INLINE_TABLE} ADD PRIMARY KEY (id)',
+    f'CREATE INDEX ON {INLINE_TABLE} (check_id)',
+    f'CREATE INDEX ON {INLINE_TABLE} USING gin (name gin_trgm_ops)',
+]
+
+SEARCHES = {
+    'interned': """
+        SELECT count(*) FROM checks WHERE user_id = :user_id AND id IN (
+            SELECT check_products.check_id FROM check_products
+            JOIN checks AS user_checks ON user_checks.id = check_products.check_id
+            WHERE user_checks.user_id = :user_id AND check_products.product_id IN (
+                SELECT id FROM products WHERE name ILIKE :pattern
+            )
+        )
+    """,
+    'inline': f"""
+        SELECT count(*) FROM checks WHERE user_id = :user_id AND EXISTS (
+            SELECT 1 FROM {INLINE_TABLE} WHERE {INLINE_TABLE}.check_id = checks.id AND name ILIKE :pattern
+        )
+    """,
+}
+
+
+async def sizes(tables: list[str]) -> tuple[int, int]:
+    async with get_session_factory()() as session:
+        heap, indexes = (await session.execute(text(
+            'SELECT sum(pg_table_size(t)), sum(pg_indexes_size(t)) FROM unnest(CAST(:tables AS regclass[])) AS t'
+        ), {'tables': tables})).one()
+    return int(heap), int(indexes)
+
+
+async def search_ms(layout: str, term: str, runs: int) -> float:
+    async with get_session_factory()() as session:
+        user_id = await session.scalar(text(
+            'SELECT user_id FROM checks GROUP BY user_id ORDER BY count(*) DESC LIMIT 1'
+        ))
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            await session.scalar(text(SEARCHES[layout]), {'user_id': user_id, 'pattern': f'%{term}%'})
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--checks', type=int, default=1_000_000)
+    parser.add_argument('--products-mean', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--term', default='молоко')
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        end = datetime.now(timezone.utc).replace(tzinfo=None)
+        distribution = Distribution(
+            products_mean=args.products_mean, products_max=50, cash_share=0.3, start=end - timedelta(days=365), end=end
+        )
+        await seed(users=args.users, checks=args.checks, distribution=distribution, workers=args.workers)
+
+    async with get_db_engine().connect() as conn:
+        await conn.execution_options(isolation_level='AUTOCOMMIT')
+        for sql in BUILD_INLINE:
+            await conn.execute(text(sql))
+        await conn.execute(text(f'VACUUM ANALYZE check_products, products, {INLINE_TABLE}'))
+
+    try:
+        for layout, tables in [('inline', [INLINE_TABLE]), ('interned', ['check_products', 'products'])]:
+            heap, indexes = await sizes(tables)
+            print(
+                f'{layout:<8} table={heap / 2 ** 20:8.1f}MB indexes={indexes / 2 ** 20:8.1f}MB '
+                f'total={(heap + indexes) / 2 ** 20:8.1f}MB '
+                f'product filter p50={await search_ms(layout, args.term, args.runs):7.2f}ms'
+            )
+    finally:
+        async with get_db_engine().begin() as conn:
+            await conn.execute(text(f'DROP TABLE IF EXISTS {INLINE_TABLE}'))
+        await get_db_engine().dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""Full pages of checks read through the ORM versus as plain rows.
+
+Seeds one user with `benchmarks.seed` into the database configured through
+the usual DATABASE_* variables, then reads pages of their checks and dumps
+them to JSON both ways, as the list endpoint did before and does now:
+
+- orm: `Check.get_page` (ORM instances, selectin-loaded products), then
+  `PageSchema` validated from them and dumped;
+- rows: `Check.get_page_rows` (`CheckRow`s from two Core selects), dumped by
+  `dump_check_row`.
+
+Reported are the time per page, split into fetching and serializing, and
+per item the memory blocks the fetched page keeps alive and the peak memory
+of the whole read, both from tracemalloc.
+
+    python -m benchmarks.read_path --checks 20000 --products-mean 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+from benchmarks.seed import Distribution, seed
+from service import schemas
+from service.config import get_db_engine, get_session_factory
+from service.models import Check
+
+
+def orm_fetch(session, user_id: int, params: schemas.CheckListParams) -> Awaitable[Any]:
+    return Check.get_page(session=session, user_id=user_id, params=params)
+
+
+def orm_dump(items: Any, params: schemas.CheckListParams, total: int) -> str:
+    return schemas.PageSchema.model_validate(
+        {'items': items, 'page': params.page, 'page_size': params.page_size, 'total': total}
+    ).model_dump_json(by_alias=True)
+
+
+def rows_fetch(session, user_id: int, params: schemas.CheckListParams) -> Awaitable[Any]:
+    return Check.get_page_rows(session=session, user_id=user_id, params=params)
+
+
+def rows_dump(items: Any, params: schemas.CheckListParams, total: int) -> str:
+    return schemas.DumpedPageSchema.model_construct(
+        items=[schemas.dump_check_row(row) for row in items],
+        page=params.page,
+        page_size=params.page_size,
+        total=total
+    ).model_dump_json()
+
+
+PATHS: dict[str, tuple[Callable, Callable]] = {
+    'orm': (orm_fetch, orm_dump),
+    'rows': (rows_fetch, rows_dump),
+}
+
+
+def pct(timings: list[float], q: float) -> float:
+    return sorted(timings)[max(int(len(timings) * q) - 1, 0)]
+
+
+async def measure(name: str, user_id: int, pages: int, page_size: int, runs: int, total: int) -> str:
+    fetch, dump = PATHS[name]
+    fetch_ms, dump_ms, total_ms = [], [], []
+    for run in range(runs):
+        params = schemas.CheckListParams(
+            filters=schemas.CheckListFilters(), page=run % pages + 1, page_size=page_size
+        )
+        async with get_session_factory()() as session:
+            started = time.perf_counter()
+            items = await fetch(session, user_id, params)
+            fetched = time.perf_counter()
+            dump(items, params, total)
+            done = time.perf_counter()
+        fetch_ms.append((fetched - started) * 1000)
+        dump_ms.append((done - fetched) * 1000)
+        total_ms.append((done - started) * 1000)
+
+    params = schemas.CheckListParams(filters=schemas.CheckListFilters(), page=1, page_size=page_size)
+    async with get_session_factory()() as session:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        items = await fetch(session, user_id, params)
+        held = tracemalloc.take_snapshot().compare_to(before, 'filename')
+        dump(items, params, total)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in held)
+    return (
+        f'{name:<5} p50={statistics.median(total_ms):6.2f}ms p95={pct(total_ms, 0.95):6.2f}ms '
+        f'(fetch {statistics.median(fetch_ms):5.2f}ms, serialize {statistics.median(dump_ms):5.2f}ms) '
+        f'blocks/item={blocks / page_size:6.1f} peak/item={peak / page_size / 1024:5.1f}KB'
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checks', type=int, default=20_000)
+    parser.add_argument('--products-mean', type=float, default=8)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    distribution = Distribution(
+        products_mean=args.products_mean, products_max=50, cash_share=0.3, start=end - timedelta(days=365), end=end
+    )
+    plan = await seed(users=1, checks=args.checks, distribution=distribution, workers=0)
+    pages = max(args.checks // args.page_size, 1)
+
+    for name in PATHS:
+        await measure(name, plan.first_user_id, pages, args.page_size, runs=10, total=args.checks)  # warm-up
+    for name in PATHS:
+        print(await measure(name, plan.first_user_id, pages, args.page_size, args.runs, total=args.checks))
+    await get_db_engine().dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,318 @@
+"""Bulk-loads synthetic users, checks and products into the service's tables.
+
+Rows follow the `service.models` schema and money mode and are consistent
+with what the API would have stored: totals are the rounded sum of line
+totals and the rest is what the payment leaves. Each user's checks go to
+the shard their bucket is assigned to, with public ids that start with the
+bucket, and the users are mirrored there. Ids are reserved up front on every
+shard so worker processes can COPY checks and their products independently;
+`created_at` grows with the id across the `--days` spread, as real data does.
+
+    python -m benchmarks.seed --users 1000 --checks 10000000 --workers 8 --rebuild-indexes
+
+`--rebuild-indexes` drops the secondary indexes of the checks tables for
+the load and builds them once at the end, which is much faster for large
+loads into existing tables. Seeded users share `--password`. Seeded checks
+are kept out of the new checks feed.
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import time
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+from typing import Sequence
+
+import asyncpg
+
+from sqlalchemy import text
+
+from benchmarks.product_search import VARIANTS, WORDS
+from service.config import get_shard_engine, get_shard_url, get_shards, settings
+from service.models import SKIP_CHECK_FEED_SETTING, Base, Check, CheckProduct, Product, ShardBucket, User
+from service.sharding import bucket_of_user
+from service.utils import from_minor_units, generate_check_id, get_password_hash, line_total
+
+
+CHECK_COLUMNS = ['id', 'public_id', 'user_id', 'total', 'rest', 'created_at', 'payment_type', 'payment_amount']
+PRODUCT_COLUMNS = ['check_id', 'product_id', 'price', 'quantity']
+MAX_PRICE = 10 ** 10 - 1  # NUMERIC(10, 2) in kopecks
+
+
+@dataclass(frozen=True)
+class Distribution:
+    products_mean: float
+    products_max: int
+    cash_share: float
+    start: datetime
+    end: datetime
+
+    def products_count(self, rng: random.Random) -> int:
+        # Geometric on 1, 2, ... with the requested mean, cut at products_max.
+        if self.products_mean <= 1:
+            return 1
+        p = 1 / self.products_mean
+        return min(1 + int(math.log(1 - rng.random()) / math.log(1 - p)), self.products_max)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    shard: int
+    first_id: int
+    count: int
+
+
+@dataclass(frozen=True)
+class ShardPlan:
+    first_check_id: int
+    checks: int
+    user_ids: list[int]
+    product_ids: dict[str, int]
+
+
+@dataclass(frozen=True)
+class Plan:
+    distribution: Distribution
+    checks: int
+    first_user_id: int
+    users: int
+    seed: int
+    shards: dict[int, ShardPlan]
+
+
+def to_column(value: int, scale: int):
+    return value if settings.money_minor_units else from_minor_units(value, scale)
+
+
+def product_names() -> list[str]:
+    """Every name `make_rows` can pick."""
+    return [
+        f'{word.capitalize()} {variant} {grams}г'
+        for word in WORDS for variant in VARIANTS for grams in range(100, 1000)
+    ]
+
+
+def make_rows(plan: Plan, chunk: Chunk) -> tuple[list[tuple], list[tuple]]:
+    rng = random.Random((plan.seed * 1_000_003 + chunk.first_id) * 1009 + chunk.shard)
+    distribution, shard_plan = plan.distribution, plan.shards[chunk.shard]
+    step = (distribution.end - distribution.start) / max(shard_plan.checks, 1)
+    checks, products = [], []
+    for check_id in range(chunk.first_id, chunk.first_id + chunk.count):
+        total = 0
+        for _ in range(distribution.products_count(rng)):
+            price = min(max(int(rng.lognormvariate(9.0, 1.0)), 1), MAX_PRICE)
+            quantity = rng.randint(1, 5) * 1000 if rng.random() < 0.7 else rng.randint(50, 3000)
+            total += line_total(price, quantity)
+            name = f'{rng.choice(WORDS).capitalize()} {rng.choice(VARIANTS)} {rng.randrange(100, 1000)}г'
+            products.append((check_id, shard_plan.product_ids[name], to_column(price, 2), to_column(quantity, 3)))
+
+        if rng.random() < distribution.cash_share:
+            payment_type, amount = 'cash', -(-total // 10000) * 10000  # rounded up to whole hundreds
+        else:
+            payment_type, amount = 'cashless', total
+        user_id = rng.choice(shard_plan.user_ids)
+        checks.append((
+            check_id,
+            generate_check_id(user_id),
+            user_id,
+            to_column(total, 2),
+            to_column(amount - total, 2),
+            distribution.start + step * (check_id - shard_plan.first_check_id),
+            payment_type,
+            to_column(amount, 2),
+        ))
+    return checks, products
+
+
+async def connect(shard: int = 0) -> asyncpg.Connection:
+    return await asyncpg.connect(get_shard_url(shard).set(drivername='postgresql').render_as_string(False))
+
+
+async def load_chunks(plan: Plan, chunks: list[Chunk]) -> int:
+    connections: dict[int, asyncpg.Connection] = {}
+    products_count = 0
+    try:
+        for chunk in chunks:
+            checks, products = make_rows(plan, chunk)
+            if chunk.shard not in connections:
+                connections[chunk.shard] = await connect(chunk.shard)
+            connection = connections[chunk.shard]
+            async with connection.transaction():
+                await connection.execute(f"SELECT set_config('{SKIP_CHECK_FEED_SETTING}', 'on', true)")
+                await connection.copy_records_to_table(Check.__tablename__, columns=CHECK_COLUMNS, records=checks)
+                await connection.copy_records_to_table(
+                    CheckProduct.__tablename__, columns=PRODUCT_COLUMNS, records=products
+                )
+            products_count += len(products)
+    finally:
+        for connection in connections.values():
+            await connection.close()
+    return products_count
+
+
+def run_worker(plan: Plan, chunks: list[Chunk]) -> int:
+    return asyncio.run(load_chunks(plan, chunks))
+
+
+async def reserve_ids(connection: asyncpg.Connection, table: str, count: int) -> int:
+    """Takes `count` consecutive ids from the table's sequence and returns the first one."""
+    async with connection.transaction():
+        # Holds back concurrent inserts, which would otherwise draw ids from the middle of the block.
+        await connection.execute(f'LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE')
+        sequence = await connection.fetchval("SELECT pg_get_serial_sequence($1, 'id')", table)
+        first = await connection.fetchval('SELECT nextval($1::regclass)', sequence)
+        await connection.execute('SELECT setval($1::regclass, $2)', sequence, first + count - 1)
+    return first
+
+
+async def seed_products(connection: asyncpg.Connection) -> dict[str, int]:
+    names = product_names()
+    await connection.execute(
+        f'INSERT INTO {Product.__tablename__} (name) SELECT unnest($1::varchar[]) ON CONFLICT (name) DO NOTHING', names
+    )
+    return dict(await connection.fetch(
+        f'SELECT name, id FROM {Product.__tablename__} WHERE name = ANY($1::varchar[])', names
+    ))
+
+
+async def seed_users(connection: asyncpg.Connection, users: int, password: str) -> int:
+    first_id = await reserve_ids(connection, User.__tablename__, users)
+    await copy_users(connection, range(first_id, first_id + users), get_password_hash(password))
+    return first_id
+
+
+async def copy_users(connection: asyncpg.Connection, user_ids: Sequence[int], password_hash: str) -> None:
+    # Shards get copies without the password hash, as `sharding.mirror_users` makes them.
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    await connection.copy_records_to_table(
+        User.__tablename__,
+        columns=['id', 'username', 'full_name', 'password_hash', 'created_at'],
+        records=[(user_id, f'seed_{user_id}', f'Seed User {user_id}', password_hash, now) for user_id in user_ids]
+    )
+
+
+async def users_by_shard(connection: asyncpg.Connection, user_ids: Sequence[int]) -> dict[int, list[int]]:
+    """The users of each shard, as `sharding.shard_map` assigns them."""
+    shards: dict[int, int] = {}
+    if settings.database_shards:
+        shards = dict(await connection.fetch(f'SELECT bucket, shard FROM {ShardBucket.__tablename__}'))
+    by_shard = defaultdict(list)
+    for user_id in user_ids:
+        by_shard[shards.get(bucket_of_user(user_id), 0)].append(user_id)
+    return dict(by_shard)
+
+
+async def seed(
+        users: int,
+        checks: int,
+        distribution: Distribution,
+        workers: int,
+        batch_size: int = 10_000,
+        password: str = 'seed_password',
+        rebuild_indexes: bool = False,
+        random_seed: int = 0
+) -> Plan:
+    for shard in get_shards():
+        async with get_shard_engine(shard).begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            if rebuild_indexes:
+                for table in (Check.__table__, CheckProduct.__table__):
+                    for index in table.indexes:
+                        await conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+
+    connection = await connect()
+    try:
+        first_user_id = await seed_users(connection, users, password)
+        shard_users = await users_by_shard(connection, range(first_user_id, first_user_id + users))
+    finally:
+        await connection.close()
+
+    # Checks are spread over the shards in proportion to their users.
+    shard_plans, planned, assigned = {}, 0, 0
+    for shard, user_ids in sorted(shard_users.items()):
+        assigned += len(user_ids)
+        shard_checks = checks * assigned // users - planned
+        planned += shard_checks
+        connection = await connect(shard)
+        try:
+            if shard:
+                await copy_users(connection, user_ids, password_hash='')
+            first_check_id = await reserve_ids(connection, Check.__tablename__, shard_checks)
+            product_ids = await seed_products(connection)
+        finally:
+            await connection.close()
+        shard_plans[shard] = ShardPlan(first_check_id, shard_checks, user_ids, product_ids)
+
+    plan = Plan(distribution, checks, first_user_id, users, random_seed, shard_plans)
+    chunks = [
+        Chunk(shard, first_id, min(batch_size, shard_plan.first_check_id + shard_plan.checks - first_id))
+        for shard, shard_plan in shard_plans.items()
+        for first_id in range(shard_plan.first_check_id, shard_plan.first_check_id + shard_plan.checks, batch_size)
+    ]
+    started = time.perf_counter()
+    if workers:
+        with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as executor:
+            products = sum(executor.map(run_worker, [plan] * workers, [chunks[i::workers] for i in range(workers)]))
+    else:
+        products = await load_chunks(plan, chunks)
+    elapsed = time.perf_counter() - started
+    print(f'loaded {checks} checks and {products} products in {elapsed:.1f}s ({checks / elapsed:,.0f} checks/s)')
+
+    for shard in shard_plans:
+        async with get_shard_engine(shard).begin() as conn:
+            if rebuild_indexes:
+                started = time.perf_counter()
+                await conn.execute(text("SET LOCAL maintenance_work_mem = '512MB'"))
+                await conn.run_sync(lambda sync_conn: [
+                    index.create(sync_conn, checkfirst=True)
+                    for table in (Check.__table__, CheckProduct.__table__)
+                    for index in table.indexes
+                ])
+                print(f'rebuilt indexes of shard {shard} in {time.perf_counter() - started:.1f}s')
+            await conn.execute(text(
+                f'ANALYZE {User.__tablename__}, {Check.__tablename__}, {CheckProduct.__tablename__}, '
+                f'{Product.__tablename__}'
+            ))
+    for shard in get_shards():
+        await get_shard_engine(shard).dispose()
+    return plan
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--checks', type=int, default=1_000_000)
+    parser.add_argument('--products-mean', type=float, default=5, help='mean products per check')
+    parser.add_argument('--products-max', type=int, default=50)
+    parser.add_argument('--cash-share', type=float, default=0.3, help='share of checks paid in cash')
+    parser.add_argument('--days', type=float, default=365, help='created_at spread back from now')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='0 loads in this process')
+    parser.add_argument('--batch-size', type=int, default=10_000, help='checks per COPY transaction')
+    parser.add_argument('--password', default='seed_password')
+    parser.add_argument('--rebuild-indexes', action='store_true')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    distribution = Distribution(
+        products_mean=args.products_mean,
+        products_max=args.products_max,
+        cash_share=args.cash_share,
+        start=end - timedelta(days=args.days),
+        end=end
+    )
+    await seed(
+        users=args.users, checks=args.checks, distribution=distribution, workers=args.workers,
+        batch_size=args.batch_size, password=args.password, rebuild_indexes=args.rebuild_indexes,
+        random_seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
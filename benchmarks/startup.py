@@ -0,0 +1,103 @@
+"""Worker startup cost and first-request latency, with and without warm-up.
+
+Every run happens in a fresh interpreter, so imports and lazily built objects
+are measured the way a newly forked worker pays for them: importing
+`service.main`, building the app, running its lifespan startup, then the first
+and second login and receipt requests. Needs the database configured through
+the usual DATABASE_* variables.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+PHASES = ['import', 'create_app', 'startup', 'first_login', 'second_login', 'first_view', 'second_view']
+
+USERNAME = 'bench_startup'
+PASSWORD = 'bench_startup_password'
+
+
+async def child() -> dict[str, float]:
+    timings = {}
+
+    started = time.perf_counter()
+    from service.main import create_app
+    timings['import'] = time.perf_counter() - started
+
+    import httpx
+    from sqlalchemy.exc import IntegrityError
+
+    from service import models, schemas
+    from service.config import get_session_factory
+    from service.utils import get_password_hash
+
+    async with get_session_factory()() as session:
+        if not await models.User.get_by_username(session=session, username=USERNAME):
+            user = schemas.UserIn(username=USERNAME, full_name=USERNAME, password=PASSWORD)
+            try:
+                await models.User.create(session=session, user=user, password_hash=get_password_hash(PASSWORD))
+            except IntegrityError:
+                pass
+    await get_session_factory().kw['bind'].dispose()
+
+    started = time.perf_counter()
+    app = create_app()
+    timings['create_app'] = time.perf_counter() - started
+
+    lifespan = app.router.lifespan_context(app)
+    started = time.perf_counter()
+    await lifespan.__aenter__()
+    timings['startup'] = time.perf_counter() - started
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for attempt in ('first', 'second'):
+            started = time.perf_counter()
+            response = await client.post('/users/login', data={'username': USERNAME, 'password': PASSWORD})
+            timings[f'{attempt}_login'] = time.perf_counter() - started
+            response.raise_for_status()
+
+            started = time.perf_counter()
+            await client.get('/checks/ch_0000000000000000000000/view')
+            timings[f'{attempt}_view'] = time.perf_counter() - started
+
+    await lifespan.__aexit__(None, None, None)
+    return timings
+
+
+def run(warmup: bool) -> dict[str, float]:
+    env = dict(os.environ, STARTUP_WARMUP=str(warmup).lower())
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup', '--child'],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        import asyncio
+        print(json.dumps(asyncio.run(child())))
+        return
+
+    for warmup in (False, True):
+        runs = [run(warmup) for _ in range(args.runs)]
+        print(f'warm-up {"on" if warmup else "off"}:')
+        for phase in PHASES:
+            timings = sorted(timing[phase] * 1000 for timing in runs)
+            print(f'    {phase:<13} p50={statistics.median(timings):7.1f}ms max={timings[-1]:7.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Tail latency, pool exhaustion and errors of the API when Postgres is slow or unreliable.
+
+Seeds `--users` users with `benchmarks.seed` into the database configured
+through the usual DATABASE_* variables, through a `benchmarks.db_proxy`
+started in process, then points the service at the proxy and drives it (in
+process, no network) with `--concurrency` clients for `--duration` seconds
+per scenario. Each client picks the next request at random:
+
+- 60% the default page of GET /checks/;
+- 15% a filtered page of GET /checks/;
+- 15% GET /checks/{check_id};
+- 10% POST /checks/.
+
+Each scenario sets the proxy's faults (see SCENARIOS), and starts with a new
+connection pool. Reported are the latency percentiles of all requests, the
+share and kinds of errors (status codes, and exceptions such as the pool's
+TimeoutError when no connection could be had within `pool_timeout`), and how
+full the pool was: its most checked out connections against what
+`Settings.sqlalchemy_engine_options` allows, and the share of time it was
+exhausted.
+
+Pool options and the request deadline can be overridden to see how a change
+would fare before making it:
+
+    python -m benchmarks.tail_latency --duration 20 --concurrency 50
+    python -m benchmarks.tail_latency --scenarios slow,spiky --pool-size 40 --max-overflow 0 --pool-timeout 2
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import text
+
+from benchmarks.db_proxy import DbProxy, Faults
+from benchmarks.seed import Distribution, seed
+from service.config import get_db_engine, get_db_url, get_session_factory, settings
+from service.main import create_app
+
+
+PASSWORD = 'bench_tail_latency_password'
+
+SCENARIOS = {
+    'baseline': Faults(),
+    'slow': Faults(latency_ms=20, jitter_ms=10),
+    'spiky': Faults(latency_ms=2, jitter_ms=250),
+    'narrow': Faults(latency_ms=2, bandwidth_kbps=256),
+    'resets': Faults(latency_ms=2, reset_rate=0.001),
+}
+
+PRODUCTS = [
+    {'name': 'молоко 2,5%', 'price': '42.90', 'quantity': '2'},
+    {'name': 'хліб житній', 'price': '31.50', 'quantity': '1'},
+]
+
+
+def pct(timings: list[float], q: float) -> float:
+    return sorted(timings)[max(int(len(timings) * q) - 1, 0)]
+
+
+class Load:
+
+    def __init__(self, client: httpx.AsyncClient, users: list[tuple[dict, list[str]]], random_seed: int):
+        self.client = client
+        self.users = users  # headers and some check ids of each
+        self.rng = random.Random(random_seed)
+        self.timings: list[float] = []
+        self.outcomes: Counter[str] = Counter()
+
+    def next_request(self) -> tuple[str, str, dict]:
+        headers, check_ids = self.rng.choice(self.users)
+        roll = self.rng.random()
+        if roll < 0.6:
+            return 'GET', '/checks/', {'headers': headers}
+        if roll < 0.75:
+            return 'GET', '/checks/?payment_type=cash&total_start=100', {'headers': headers}
+        if roll < 0.9:
+            return 'GET', f'/checks/{self.rng.choice(check_ids)}', {'headers': headers}
+        payment = {'type': 'cash', 'amount': '200.00'}
+        return 'POST', '/checks/', {'headers': headers, 'json': {'products': PRODUCTS, 'payment': payment}}
+
+    async def client_loop(self, until: float) -> None:
+        while time.monotonic() < until:
+            method, url, kwargs = self.next_request()
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+                outcome = 'ok' if response.status_code < 400 else str(response.status_code)
+            except Exception as e:
+                outcome = f'{type(e).__module__}.{type(e).__name__}'
+            self.timings.append((time.perf_counter() - started) * 1000)
+            self.outcomes[outcome] += 1
+
+
+async def sample_pool(until: float, samples: list[int]) -> None:
+    pool = get_db_engine().pool
+    while time.monotonic() < until:
+        samples.append(pool.checkedout())
+        await asyncio.sleep(0.01)
+
+
+async def run_scenario(
+        name: str, proxy: DbProxy, users: list[tuple[dict, list[str]]], duration: float, concurrency: int
+) -> str:
+    await get_db_engine().dispose()
+    proxy.faults = SCENARIOS[name]
+    resets = proxy.resets
+
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        # Exceptions reach the client as they would a load balancer: as an
+        # error, named here rather than as a bare 500.
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            load = Load(client, users, random_seed=len(name))
+            until = time.monotonic() + duration
+            samples: list[int] = []
+            await asyncio.gather(
+                sample_pool(until, samples), *(load.client_loop(until) for _ in range(concurrency))
+            )
+
+    options = settings.sqlalchemy_engine_options
+    capacity = options.get('pool_size', 5) + options.get('max_overflow', 10)
+    requests = sum(load.outcomes.values())
+    errors = {outcome: count for outcome, count in load.outcomes.most_common() if outcome != 'ok'}
+    return (
+        f'{name:<8} {requests / duration:7.1f} req/s '
+        f'p50={statistics.median(load.timings):7.1f}ms p95={pct(load.timings, 0.95):7.1f}ms '
+        f'p99={pct(load.timings, 0.99):7.1f}ms max={max(load.timings):7.1f}ms '
+        f'errors={sum(errors.values()) / requests:6.2%} '
+        f'pool max={max(samples, default=0)}/{capacity} exhausted={sum(s >= capacity for s in samples) / len(samples):6.1%} '
+        f'resets={proxy.resets - resets}'
+        + ''.join(f'\n{"":<9}{count:6} {outcome}' for outcome, count in errors.items())
+    )
+
+
+async def login(client: httpx.AsyncClient, user_id: int) -> dict:
+    response = await client.post('/users/login', data={'username': f'seed_{user_id}', 'password': PASSWORD})
+    response.raise_for_status()
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--checks', type=int, default=50_000)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--pool-size', type=int)
+    parser.add_argument('--max-overflow', type=int)
+    parser.add_argument('--pool-timeout', type=float)
+    parser.add_argument('--request-deadline', type=float, help='REQUEST_DEADLINE_SECONDS and every REQUEST_DEADLINES')
+    args = parser.parse_args()
+
+    for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+        if getattr(args, option) is not None:
+            settings.sqlalchemy_engine_options[option] = getattr(args, option)
+    if args.request_deadline is not None:
+        settings.request_deadline_seconds = args.request_deadline
+        settings.request_deadlines = {route: args.request_deadline for route in settings.request_deadlines}
+
+    proxy = DbProxy(settings.database_host, settings.database_port)
+    await proxy.start()
+    settings.database_host, settings.database_port = '127.0.0.1', proxy.port
+    # Importing the benchmarks may already have built them for the database itself.
+    for factory in (get_db_url, get_db_engine, get_session_factory):
+        factory.cache_clear()
+
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    distribution = Distribution(
+        products_mean=5, products_max=50, cash_share=0.3, start=end - timedelta(days=365), end=end
+    )
+    plan = await seed(users=args.users, checks=args.checks, distribution=distribution, workers=0, password=PASSWORD)
+
+    user_ids = range(plan.first_user_id, plan.first_user_id + plan.users)
+    async with get_session_factory()() as session:
+        check_ids = {user_id: [] for user_id in user_ids}
+        for user_id, public_id in await session.execute(text(
+            'SELECT user_id, public_id FROM checks WHERE id >= :first_id ORDER BY random() LIMIT 5000'
+        ), {'first_id': plan.shards[0].first_check_id}):
+            check_ids[user_id].append(public_id)
+    app = create_app()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+        users = [(await login(client, user_id), check_ids[user_id]) for user_id in user_ids if check_ids[user_id]]
+
+    print(f'{args.concurrency} clients for {args.duration:.0f}s each, pool {settings.sqlalchemy_engine_options}')
+    try:
+        for name in args.scenarios.split(','):
+            print(await run_scenario(name, proxy, users, args.duration, args.concurrency))
+    finally:
+        await get_db_engine().dispose()
+        await proxy.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,10 @@
+#!/bin/sh
+set -e
+
+# Metrics files left by the previous run would be added to this one's.
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+exec "$@"
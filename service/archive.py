@@ -0,0 +1,60 @@
+"""Moves checks older than a cutoff from the hot tables to `archived_checks`.
+
+    python -m service.archive --older-than-days 365
+
+Runs in batches, each in its own transaction, and can run next to the API:
+rows locked by concurrent requests are skipped until the next run. Archived
+checks stay reachable by id through the retrieve and view endpoints but leave
+the lists. Needs CACHE_URL, so that the API workers' list totals and ETags
+change with them.
+"""
+import argparse
+import asyncio
+import datetime
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import models
+from service.cache import list_counts_cache, require_shared_cache
+from service.config import get_session_factory, get_shard_engine, get_shard_session_factory, get_shards, settings
+
+
+async def archive_checks(
+        cutoff: datetime.datetime,
+        batch_size: int,
+        session_factory: async_sessionmaker[AsyncSession] | None = None
+) -> int:
+    require_shared_cache('Archiving')
+    session_factory = session_factory or get_session_factory()
+    archived = 0
+    while True:
+        async with session_factory() as session:
+            user_ids = await models.ArchivedCheck.archive_older_than(session, cutoff=cutoff, limit=batch_size)
+            await session.commit()
+        for user_id in set(user_ids):
+            await list_counts_cache.invalidate(scope=user_id)
+        archived += len(user_ids)
+        if len(user_ids) < batch_size:
+            return archived
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--older-than-days', type=int, default=settings.archive_after_days)
+    parser.add_argument('--batch-size', type=int, default=settings.archive_batch_size)
+    args = parser.parse_args()
+
+    # created_at is a naive UTC timestamp
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    cutoff = now - datetime.timedelta(days=args.older_than_days)
+    archived = 0
+    for shard in get_shards():
+        archived += await archive_checks(
+            cutoff=cutoff, batch_size=args.batch_size, session_factory=get_shard_session_factory(shard)
+        )
+        await get_shard_engine(shard).dispose()
+    print(f'Archived {archived} checks created before {cutoff:%Y-%m-%d %H:%M:%S} UTC')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
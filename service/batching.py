@@ -0,0 +1,134 @@
+import asyncio
+
+from typing import Sequence
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import schemas, models
+from service.config import get_shard_session_factory, settings
+from service.jobs import enqueue_check_created
+from service.metrics import write_batch_fallbacks, write_batch_size
+from service.recent_checks import recent_checks
+
+
+PendingCheck = tuple[int, schemas.CheckIn, asyncio.Future]
+
+
+class CheckWriteCoalescer:
+
+    def __init__(
+            self,
+            window_ms: float,
+            max_batch: int,
+            session_factory: async_sessionmaker[AsyncSession] | None = None,
+            shard: int = 0
+    ):
+        self._session_factory = session_factory
+        self.shard = shard
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: list[PendingCheck] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    @property
+    def session_factory(self) -> async_sessionmaker[AsyncSession]:
+        return self._session_factory or get_shard_session_factory(self.shard)
+
+    async def submit(self, user_id: int, check: schemas.CheckIn) -> models.Check:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_id, check, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+
+        # The write is already queued with other callers' rows, so a cancelled
+        # request must not cancel the shared flush.
+        return await asyncio.shield(future)
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+        task.add_done_callback(lambda _: self._cancel_unresolved(batch))
+
+    async def _flush(self, batch: Sequence[PendingCheck]) -> None:
+        write_batch_size.observe(len(batch))
+        try:
+            try:
+                results = await self._insert_batch(batch)
+            except DBAPIError:
+                write_batch_fallbacks.inc()
+                results = await self._insert_isolated(batch)
+        except Exception as exc:
+            results = [exc] * len(batch)
+
+        # Only committed checks change a user's list; failed ones leave it as it was.
+        for (user_id, _, _), result in zip(batch, results):
+            if not isinstance(result, BaseException):
+                await recent_checks.add(user_id, result)
+
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _cancel_unresolved(self, batch: Sequence[PendingCheck]) -> None:
+        for _, _, future in batch:
+            future.cancel()
+
+    async def _insert_batch(self, batch: Sequence[PendingCheck]) -> list[models.Check | BaseException]:
+        async with self.session_factory() as session:
+            db_checks = await models.Check.create_many(
+                session=session, checks=[(user_id, check) for user_id, check, _ in batch]
+            )
+            for db_check in db_checks:
+                enqueue_check_created(session, db_check)
+            await session.commit()
+        return list(db_checks)
+
+    async def _insert_isolated(self, batch: Sequence[PendingCheck]) -> list[models.Check | BaseException]:
+        results: list[models.Check | BaseException] = []
+        async with self.session_factory() as session:
+            for user_id, check, _ in batch:
+                try:
+                    async with session.begin_nested():
+                        [db_check] = await models.Check.create_many(session=session, checks=[(user_id, check)])
+                        enqueue_check_created(session, db_check)
+                except DBAPIError as exc:
+                    results.append(exc)
+                else:
+                    results.append(db_check)
+            await session.commit()
+        return results
+
+
+check_writer = CheckWriteCoalescer(
+    window_ms=settings.check_write_window_ms,
+    max_batch=settings.check_write_max_batch
+)
+_shard_check_writers: dict[int, CheckWriteCoalescer] = {0: check_writer}
+
+
+def get_check_writer(shard: int) -> CheckWriteCoalescer:
+    if shard not in _shard_check_writers:
+        _shard_check_writers[shard] = CheckWriteCoalescer(
+            window_ms=settings.check_write_window_ms,
+            max_batch=settings.check_write_max_batch,
+            shard=shard
+        )
+    return _shard_check_writers[shard]
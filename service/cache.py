@@ -0,0 +1,239 @@
+import asyncio
+import json
+import time
+import uuid
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Hashable
+
+from service.config import settings
+from service.metrics import cache_requests
+from service.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    import redis.asyncio as redis
+
+
+class CacheBackend(ABC):
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None: ...
+
+    @abstractmethod
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool: ...
+
+    @abstractmethod
+    async def swap(self, key: str, value: bytes) -> bytes | None:
+        """Sets `key` with no expiry and returns what it replaced, in one step."""
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> None: ...
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalCacheBackend(CacheBackend):
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._data: OrderedDict[str, tuple[bytes, float | None]] = OrderedDict()
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        if await self.get(key) is not None:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def swap(self, key: str, value: bytes) -> bytes | None:
+        previous = await self.get(key)
+        await self.set(key, value)
+        return previous
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class RedisCacheBackend(CacheBackend):
+
+    def __init__(self, client: 'redis.Redis'):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> 'RedisCacheBackend':
+        # Imported here so that workers without a shared cache don't pay for it at startup.
+        import redis.asyncio as redis
+        return cls(redis.Redis.from_url(url))
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        await self.client.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def add(self, key: str, value: bytes, ttl: float | None = None) -> bool:
+        return bool(await self.client.set(key, value, px=int(ttl * 1000) if ttl else None, nx=True))
+
+    async def swap(self, key: str, value: bytes) -> bytes | None:
+        return await self.client.set(key, value, get=True)
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self.client.delete(*keys)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+_backend: CacheBackend | None = None
+
+
+def get_cache_backend() -> CacheBackend:
+    global _backend
+    if _backend is None:
+        if settings.cache_url:
+            _backend = RedisCacheBackend.from_url(settings.cache_url)
+        else:
+            _backend = LocalCacheBackend(max_entries=settings.cache_local_max_entries)
+    return _backend
+
+
+def set_cache_backend(backend: CacheBackend | None) -> None:
+    global _backend
+    _backend = backend
+
+
+def require_shared_cache(action: str) -> None:
+    """Raises unless CACHE_URL is set, for processes that change checks the API workers list.
+
+    Only a shared backend carries their invalidations to the workers; without
+    it the workers' list ETags and totals would not change.
+    """
+    if not settings.cache_url:
+        raise RuntimeError(f'{action} needs CACHE_URL, the cache the API workers share, to tell them of the change')
+
+
+class Cache:
+    """A namespace of JSON values in the shared cache backend.
+
+    Entries may belong to a scope (e.g. a user id). Invalidating a scope swaps
+    its generation token, which every worker reads from the backend, so all of
+    the scope's entries become unreachable at once and expire on their own.
+
+    Values that go stale on changes made by other workers are `shared_only`:
+    without `CACHE_URL` an invalidation only reaches the worker's own LRU, so
+    they are not cached at all.
+    """
+
+    lock_ttl = 5.0
+    lock_poll_interval = 0.05
+
+    def __init__(self, namespace: str, ttl: float, backend: CacheBackend | None = None, shared_only: bool = False):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.shared_only = shared_only
+        self._backend = backend
+        self._flight = SingleFlight(f'cache:{namespace}')
+
+    @property
+    def enabled(self) -> bool:
+        return not self.shared_only or bool(settings.cache_url)
+
+    @property
+    def backend(self) -> CacheBackend:
+        return self._backend or get_cache_backend()
+
+    def _generation_key(self, scope: Hashable) -> str:
+        return f'{settings.cache_prefix}:{self.namespace}:{scope}:generation'
+
+    async def generation(self, scope: Hashable) -> str:
+        key = self._generation_key(scope)
+        if (generation := await self.backend.get(key)) is None:
+            await self.backend.add(key, uuid.uuid4().hex.encode())
+            generation = await self.backend.get(key)
+        return generation.decode() if generation else ''
+
+    async def make_key(self, key: Hashable, scope: Hashable | None = None) -> str:
+        if scope is None:
+            return f'{settings.cache_prefix}:{self.namespace}:{key}'
+        return f'{settings.cache_prefix}:{self.namespace}:{scope}:{await self.generation(scope)}:{key}'
+
+    async def get(self, key: Hashable, scope: Hashable | None = None) -> Any:
+        raw = await self.backend.get(await self.make_key(key, scope))
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key: Hashable, value: Any, scope: Hashable | None = None) -> None:
+        await self.backend.set(await self.make_key(key, scope), json.dumps(value).encode(), self.ttl)
+
+    async def invalidate(self, scope: Hashable) -> tuple[str | None, str]:
+        """Swaps the scope's generation; returns the one it replaced (None if there was none) and the new one."""
+        generation = uuid.uuid4().hex
+        previous = await self.backend.swap(self._generation_key(scope), generation.encode())
+        return previous.decode() if previous else None, generation
+
+    async def get_or_set(
+            self,
+            key: Hashable,
+            loader: Callable[[], Awaitable[Any]],
+            scope: Hashable | None = None
+    ) -> Any:
+        if not self.enabled:
+            return await loader()
+        full_key = await self.make_key(key, scope)
+        if (raw := await self.backend.get(full_key)) is not None:
+            cache_requests.labels(self.namespace, 'hit').inc()
+            return json.loads(raw)
+
+        cache_requests.labels(self.namespace, 'miss').inc()
+        return await self._flight.do(full_key, lambda: self._load(full_key, loader))
+
+    async def _load(self, full_key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        # Concurrent misses within a worker are already coalesced by the flight;
+        # the lock does the same across workers that share the backend.
+        lock_key = f'{full_key}:lock'
+        locked = await self.backend.add(lock_key, b'1', self.lock_ttl)
+        if not locked:
+            deadline = time.monotonic() + self.lock_ttl
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self.lock_poll_interval)
+                if (raw := await self.backend.get(full_key)) is not None:
+                    return json.loads(raw)
+
+        try:
+            value = await loader()
+            if value is not None:
+                await self.backend.set(full_key, json.dumps(value).encode(), self.ttl)
+            return value
+        finally:
+            if locked:
+                await self.backend.delete(lock_key)
+
+
+principals_cache = Cache('principals', ttl=settings.cache_principal_ttl)
+receipts_cache = Cache('receipts', ttl=settings.cache_receipt_ttl)
+list_counts_cache = Cache('list_counts', ttl=settings.cache_list_count_ttl, shared_only=True)
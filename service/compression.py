@@ -0,0 +1,68 @@
+import brotli
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from service.metrics import compression_bytes_in, compression_bytes_out
+
+
+class CountingResponderMixin:
+    content_encoding: str
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = super().apply_compression(body, more_body=more_body)  # type: ignore[misc]
+        compression_bytes_in.labels(self.content_encoding).inc(len(body))
+        compression_bytes_out.labels(self.content_encoding).inc(len(compressed))
+        return compressed
+
+
+class BrotliResponder(IdentityResponder):
+    content_encoding = 'br'
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int = 4) -> None:
+        super().__init__(app, minimum_size)
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        body = self.compressor.process(body)
+        return body + (self.compressor.flush() if more_body else self.compressor.finish())
+
+
+class CountingGZipResponder(CountingResponderMixin, GZipResponder):
+    pass
+
+
+class CountingBrotliResponder(CountingResponderMixin, BrotliResponder):
+    pass
+
+
+class CompressionMiddleware:
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            minimum_size: int = 1000,
+            gzip_level: int = 6,
+            brotli_quality: int = 4
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = Headers(scope=scope).get('Accept-Encoding', '')
+        responder: ASGIApp
+        if 'br' in accept_encoding:
+            responder = CountingBrotliResponder(self.app, self.minimum_size, quality=self.brotli_quality)
+        elif 'gzip' in accept_encoding:
+            responder = CountingGZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+
+        await responder(scope, receive, send)
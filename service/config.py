@@ -1,9 +1,10 @@
-from typing import Any
+from functools import cache
+from typing import Any, Callable
 
 from pydantic import Field, HttpUrl, PositiveInt
 from pydantic_settings import BaseSettings
-from sqlalchemy import URL
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
 
 class Settings(BaseSettings):
@@ -13,6 +14,7 @@ class Settings(BaseSettings):
     auth_secret_key: str = Field(default=...)  # hint: openssl rand -hex 32
     jwt_algorithm: str = 'HS256'
     access_token_expire_minutes: int = 600
+    refresh_token_expire_days: int = 30
 
     database_host: str = Field(default=...)
     database_port: int = Field(default=...)
@@ -20,23 +22,140 @@ class Settings(BaseSettings):
     database_password: str = Field(default=...)
     database_name: str = Field(default=...)
 
+    # Further databases for checks, as a JSON list of URLs; see service.sharding.
+    database_shards: list[str] = []
+    shard_buckets: int = Field(default=1024, ge=1, le=62 ** 2)  # part of check ids, fixed once there are checks
+    shard_map_refresh_seconds: float = 10
+
     sqlalchemy_engine_options: dict[str, Any] = {
         'pool_size': 20,
         'pool_recycle': 600,
         'pool_pre_ping': True
     }
 
+    compression_minimum_size: int = 1000
+    gzip_compresslevel: int = 6
+    brotli_quality: int = 4
+
+    check_write_coalescing: bool = False
+    check_write_window_ms: float = 2.0
+    check_write_max_batch: int = 100
+    large_check_chunk_size: int = 1000
+    large_check_idle_timeout_seconds: float = 30  # longest wait for the next piece of a POST /checks/large body
+    large_check_upload_timeout_seconds: float = 600
+    check_lookup_max_ids: int = 1000
+    money_minor_units: bool = False  # BIGINT kopecks and thousandths instead of NUMERIC
+    product_id_cache_max_entries: int = 100_000  # product name to id, per worker
+    archive_after_days: int = 365
+    archive_batch_size: int = 500
+
+    cache_url: str | None = None  # e.g. redis://localhost:6379/0, in-process LRU if unset
+    cache_prefix: str = 'checkbox'
+    cache_local_max_entries: int = 10_000
+    cache_principal_ttl: float = 60
+    cache_receipt_ttl: float = 24 * 60 * 60
+    cache_list_count_ttl: float = 5 * 60
+    recent_checks_per_user: int = 25  # newest checks kept per user for the default list page, 0 to turn off
+    recent_checks_max_users: int = 1000
+
+    sql_slow_query_ms: float | None = 200
+    sql_repeated_statement_threshold: int = 10  # warn about likely N+1 queries
+
+    profiling_secret: str | None = None  # enables the signed X-Profile-Token header
+    profiling_sample_rate: float = 0.0
+    profiling_dir: str = 'profiles'
+    profiling_interval_ms: float = 1.0
+
+    tracing_otlp_file: str | None = None  # e.g. traces.jsonl, tracing is off if unset
+
+    metrics_token: str | None = None  # bearer token for GET /metrics, which is not served if unset
+
+    jobs_enabled: bool = True  # deferred work after creating checks, needs `python -m service.jobs` running
+    job_max_attempts: int = 5
+    job_retry_backoff_seconds: float = 5  # doubled on every further attempt
+    job_visibility_timeout: float = 60
+    job_poll_interval: float = 1
+    job_concurrency: int = 10
+    receipt_prerender_widths: list[int] = [32]
+
+    feed_heartbeat_seconds: float = 15  # comment line sent on idle check streams to keep proxies from closing them
+    feed_max_wait_seconds: float = 60  # longest a long-poll for new checks is held open
+    feed_batch_size: int = 100
+    feed_held_back_retry_seconds: float = 0.05  # how often feeds held back by running transactions are rechecked
+    feed_retention_hours: float = 24  # how long check_feed entries are kept, pruned by `python -m service.jobs`
+
+    # statement_timeout budget of a request's transactions, counted from its start; None for no limit
+    request_deadline_seconds: float | None = 10
+    request_deadlines: dict[str, float | None] = {  # by route path
+        '/checks/': 5,
+        '/checks/large': 30,  # counted from when the body has been received
+    }
+
+    startup_warmup: bool = True
+    db_pool_warmup_connections: int = 2
+
 
 settings = Settings()
 
 
-db_url = URL.create(
-    drivername='postgresql+asyncpg',
-    username=settings.database_user,
-    password=settings.database_password,
-    host=settings.database_host,
-    port=settings.database_port,
-    database=settings.database_name
-)
-db_engine = create_async_engine(db_url, **settings.sqlalchemy_engine_options)
-async_session_factory = async_sessionmaker(bind=db_engine, expire_on_commit=False)
+@cache
+def get_db_url() -> URL:
+    return URL.create(
+        drivername='postgresql+asyncpg',
+        username=settings.database_user,
+        password=settings.database_password,
+        host=settings.database_host,
+        port=settings.database_port,
+        database=settings.database_name
+    )
+
+
+@cache
+def get_db_engine() -> AsyncEngine:
+    return create_async_engine(get_db_url(), **settings.sqlalchemy_engine_options)
+
+
+@cache
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(bind=get_db_engine(), expire_on_commit=False)
+
+
+def get_shards() -> range:
+    return range(len(settings.database_shards) + 1)
+
+
+def get_shard_url(shard: int) -> URL:
+    if shard == 0:
+        return get_db_url()
+    return make_url(settings.database_shards[shard - 1]).set(drivername='postgresql+asyncpg')
+
+
+@cache
+def _get_shard_engine(shard: int) -> AsyncEngine:
+    return create_async_engine(get_shard_url(shard), **settings.sqlalchemy_engine_options)
+
+
+def get_shard_engine(shard: int) -> AsyncEngine:
+    return get_db_engine() if shard == 0 else _get_shard_engine(shard)
+
+
+@cache
+def _get_shard_session_factory(shard: int) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(bind=get_shard_engine(shard), expire_on_commit=False)
+
+
+def get_shard_session_factory(shard: int) -> async_sessionmaker[AsyncSession]:
+    return get_session_factory() if shard == 0 else _get_shard_session_factory(shard)
+
+
+_lazy_attributes: dict[str, Callable[[], Any]] = {
+    'db_url': get_db_url,
+    'db_engine': get_db_engine,
+    'async_session_factory': get_session_factory,
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _lazy_attributes:
+        return _lazy_attributes[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,131 @@
+"""Deadlines for the database work of a request, and cancelling it when its client goes away.
+
+A request gets `REQUEST_DEADLINE_SECONDS`, or the entry for its route in
+`REQUEST_DEADLINES`, counted from when it came in. Every transaction of the
+sessions handed out by `get_db_session` starts with `statement_timeout` set to
+what is left of it, so a list or count query that would run on in Postgres
+long after the client gave up is cancelled there and answered with a 504.
+
+When the client disconnects before the response is complete, the request is
+cancelled; asyncpg then cancels the query it was waiting for on the server and
+the connection goes back to the pool.
+"""
+import asyncio
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from service.config import settings
+from service.errors import DeadlineExceededError
+from service.metrics import requests_cancelled, requests_deadline_exceeded
+
+
+DEADLINE_KEY = 'deadline'
+QUERY_CANCELED = '57014'
+
+# A bound value keeps it to one prepared statement whatever the timeout.
+SET_STATEMENT_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+def route_path(scope: Scope) -> str:
+    return getattr(scope.get('route'), 'path', 'unmatched')
+
+
+def get_deadline(request: Request, started: float | None = None) -> float | None:
+    """The `time.monotonic()` by which the request's queries have to be done, None if they have no limit."""
+    budget = settings.request_deadlines.get(route_path(request.scope), settings.request_deadline_seconds)
+    if budget is None:
+        return None
+    started = started or getattr(request.state, 'started_at', None) or time.monotonic()
+    return started + budget
+
+
+@contextmanager
+def apply_deadline(request: Request, session: AsyncSession) -> Iterator[None]:
+    """Runs the transactions of `session` under the request's deadline and answers 504 when a query outlives it."""
+    session.info[DEADLINE_KEY] = get_deadline(request)
+    try:
+        yield
+    except DBAPIError as e:
+        if getattr(e.orig, 'sqlstate', None) != QUERY_CANCELED:
+            raise
+        requests_deadline_exceeded.labels(route_path(request.scope)).inc()
+        raise DeadlineExceededError() from e
+
+
+def restart_deadline(request: Request, session: AsyncSession) -> None:
+    """Counts the request's deadline from now, for a request that only goes to the database once its body is in."""
+    session.info[DEADLINE_KEY] = get_deadline(request, started=time.monotonic())
+
+
+@event.listens_for(Session, 'after_begin')
+def set_statement_timeout(session: Session, transaction: SessionTransaction, connection: Connection) -> None:
+    deadline = session.info.get(DEADLINE_KEY)
+    if deadline is None:
+        return
+    # Statements of a transaction each get what was left when it began; one
+    # that begins past the deadline fails on its first statement.
+    remaining_ms = max(int((deadline - time.monotonic()) * 1000), 1)
+    connection.execute(SET_STATEMENT_TIMEOUT, {'timeout': f'{remaining_ms}ms'})
+
+
+class CancelOnDisconnectMiddleware:
+    """Cancels a request whose client disconnects before the response is complete.
+
+    The request body is read on the app's behalf, one message ahead, so that
+    the disconnect is noticed even while the app is busy elsewhere.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        scope.setdefault('state', {})['started_at'] = time.monotonic()
+        messages: asyncio.Queue[Message] = asyncio.Queue(maxsize=1)
+        response_complete = False
+
+        async def receive_queued() -> Message:
+            message = await messages.get()
+            if message['type'] == 'http.disconnect':
+                messages.put_nowait(message)  # and for every later call
+            return message
+
+        async def send_tracked(message: Message) -> None:
+            nonlocal response_complete
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.create_task(self.app(scope, receive_queued, send_tracked))
+
+        async def watch() -> None:
+            while (message := await receive())['type'] != 'http.disconnect':
+                await messages.put(message)
+            # Background tasks run after the response and are left alone.
+            if not response_complete:
+                requests_cancelled.labels(route_path(scope)).inc()
+                app_task.cancel()
+            await messages.put(message)
+
+        watcher = asyncio.create_task(watch())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            if current is not None and current.cancelling():
+                raise
+        finally:
+            watcher.cancel()
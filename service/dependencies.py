@@ -1,5 +1,7 @@
 import jwt
 
+from contextlib import asynccontextmanager
+
 from jwt.exceptions import InvalidTokenError
 
 from typing import Annotated, AsyncIterator
@@ -8,19 +10,28 @@ from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import models
-from service.config import async_session_factory
+from . import models, schemas
+from service.config import get_session_factory, get_shard_session_factory
 from service.utils import verify_password
 from service.config import settings
+from service.deadlines import DEADLINE_KEY, apply_deadline
 from service.errors import AuthenticationFailedError
+from service.cache import principals_cache
+from service.sharding import shard_map
+from service.singleflight import users_flight
+from service.tracing import span, traced
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/login", auto_error=False)
 
 
-async def get_db_session() -> AsyncIterator[AsyncSession]:
-    async with async_session_factory() as session:
-        yield session
+async def get_db_session(request: Request) -> AsyncIterator[AsyncSession]:
+    # Spans the session's lifetime, so it must not be the parent of the
+    # request's other spans.
+    with span('get_db_session', current=False):
+        async with get_session_factory()() as session:
+            with apply_deadline(request, session):
+                yield session
 
 
 DBSession = Annotated[AsyncSession, Depends(get_db_session)]
@@ -37,6 +48,7 @@ async def get_user_from_form(
     raise AuthenticationFailedError(detail='Incorrect username or password')
 
 
+@traced
 async def validate_access_token(
     request: Request,
 ) -> str:
@@ -56,12 +68,42 @@ async def validate_access_token(
     raise AuthenticationFailedError()
 
 
+@traced
 async def get_user_from_token(
     username: Annotated[str, Depends(validate_access_token)],
     db: DBSession
 ) -> models.User:
-    user = await models.User.get_by_username(session=db, username=username)
-    if user:
-        return user
+    async def load_principal() -> dict | None:
+        user = await users_flight.do(
+            username, lambda: models.User.get_by_username(session=db, username=username)
+        )
+        return schemas.Principal.model_validate(user).model_dump(mode='json') if user else None
+
+    principal = await principals_cache.get_or_set(username, load_principal)
+    if principal:
+        return models.User(**schemas.Principal.model_validate(principal).model_dump())
 
     raise AuthenticationFailedError()
+
+
+@asynccontextmanager
+async def open_shard_session(shard: int, db: AsyncSession) -> AsyncIterator[AsyncSession]:
+    if shard == 0:
+        yield db
+        return
+    with span('get_shard_session', current=False):
+        async with get_shard_session_factory(shard)() as session:
+            session.info[DEADLINE_KEY] = db.info.get(DEADLINE_KEY)
+            yield session
+
+
+async def get_shard_session(
+    user: Annotated[models.User, Depends(get_user_from_token)],
+    db: DBSession
+) -> AsyncIterator[AsyncSession]:
+    async with open_shard_session(await shard_map.shard_for_user(user.id), db) as session:
+        yield session
+
+
+# The session of the database the authenticated user's checks are on.
+ShardSession = Annotated[AsyncSession, Depends(get_shard_session)]
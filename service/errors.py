@@ -31,3 +31,24 @@ class InsufficientPaymentError(HTTPException):
     status_code: ClassVar[int] = status.HTTP_400_BAD_REQUEST
     detail="Insufficient payment amount"
     headers: dict | None = None
+
+
+@dataclass
+class ShardMovingError(HTTPException):
+    status_code: ClassVar[int] = status.HTTP_503_SERVICE_UNAVAILABLE
+    detail: str = 'Checks of this user are being moved, try again later'
+    headers: dict = field(default_factory=lambda: {'Retry-After': '30'})
+
+
+@dataclass
+class DeadlineExceededError(HTTPException):
+    status_code: ClassVar[int] = status.HTTP_504_GATEWAY_TIMEOUT
+    detail: str = 'The request took too long, try again later'
+    headers: dict | None = None
+
+
+@dataclass
+class RequestTimeoutError(HTTPException):
+    status_code: ClassVar[int] = status.HTTP_408_REQUEST_TIMEOUT
+    detail: str = 'The request body was not received in time'
+    headers: dict | None = None
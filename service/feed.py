@@ -0,0 +1,284 @@
+"""Pushes new checks to their users as they are created.
+
+A trigger on `checks` records inserted checks in `check_feed` and sends
+their user ids on the `new_checks` channel. Each API worker keeps one LISTEN
+connection per database (opened when the first client subscribes) and wakes
+up the subscriptions of that user, which then read whatever is past their
+cursor. Entries are in the order of the transactions that inserted them and
+only read once no older transaction can still commit (see
+`models.CheckFeedEntry`), so nothing is missed while a client reconnects or
+is between long-polls, even when checks commit out of order. Subscriptions
+held back that way are woken by their worker, which checks every
+`FEED_HELD_BACK_RETRY_SECONDS`, with one query per database, whether the
+transactions holding them back have ended.
+
+Cursors are opaque: the database and the entry's position, encrypted and
+authenticated with `AUTH_SECRET_KEY`, so they reveal nothing about ids or
+volumes. Transaction ids only compare within a database, so a cursor from
+before the user's bucket was moved starts over at the user's first entry on
+the new one; moves copy checks without adding them to the feed. A cursor
+older than `FEED_RETENTION_HOURS` may miss checks pruned since.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import secrets
+import struct
+import time
+
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import partial
+from typing import AsyncIterator
+
+import asyncpg
+
+from fastapi.exceptions import RequestValidationError
+
+from . import models, schemas
+from service.config import get_shard_session_factory, get_shard_url, settings
+from service.logger import logger
+from service.metrics import feed_notifications, feed_subscribers
+
+
+Position = tuple[int, int]  # the xact_id and check_id of a check_feed entry
+Cursor = tuple[int, Position]  # and the shard it is on
+
+CURSOR = struct.Struct('>Hqq')
+NONCE_SIZE, TAG_SIZE = 8, 12
+
+
+def _keyed_hash(data: bytes, person: bytes, size: int) -> bytes:
+    key = hashlib.sha256(settings.auth_secret_key.encode()).digest()
+    return hashlib.blake2b(data, key=key, person=person, digest_size=size).digest()
+
+
+def encode_cursor(shard: int, position: Position) -> str:
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    stream = _keyed_hash(nonce, b'feed-cursor', CURSOR.size)
+    sealed = bytes(a ^ b for a, b in zip(CURSOR.pack(shard, *position), stream))
+    tag = _keyed_hash(nonce + sealed, b'feed-cursor-tag', TAG_SIZE)
+    return base64.urlsafe_b64encode(nonce + sealed + tag).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Cursor | None:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except ValueError:
+        return None
+    if len(raw) != NONCE_SIZE + CURSOR.size + TAG_SIZE:
+        return None
+    nonce, sealed, tag = raw[:NONCE_SIZE], raw[NONCE_SIZE:-TAG_SIZE], raw[-TAG_SIZE:]
+    if not hmac.compare_digest(tag, _keyed_hash(nonce + sealed, b'feed-cursor-tag', TAG_SIZE)):
+        return None
+    stream = _keyed_hash(nonce, b'feed-cursor', CURSOR.size)
+    shard, xact_id, check_id = CURSOR.unpack(bytes(a ^ b for a, b in zip(sealed, stream)))
+    return shard, (xact_id, check_id)
+
+
+def parse_cursor(cursor: str | None, loc: tuple[str, str]) -> Cursor | None:
+    if cursor is None:
+        return None
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        raise RequestValidationError(
+            [{'type': 'value_error', 'loc': loc, 'msg': 'Value error, not a cursor of this feed', 'input': cursor}]
+        )
+    return decoded
+
+
+def resume_position(cursor: Cursor, shard: int) -> Position:
+    cursor_shard, position = cursor
+    return position if cursor_shard == shard else (0, 0)
+
+
+@dataclass
+class FeedBatch:
+    events: list[tuple[str, schemas.CheckListItem]]  # each with the cursor just past it
+    position: Position  # past every entry read, including those of archived checks
+    full: bool
+    held_back: int | None  # the xact_id of the first entry held back
+
+
+class Subscription:
+
+    def __init__(self, feed: 'CheckFeed', user_id: int, shard: int):
+        self.feed = feed
+        self.user_id = user_id
+        self.shard = shard
+        self._woken = asyncio.Event()
+
+    def wake(self) -> None:
+        self._woken.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits up to `timeout` for new checks of the user; False if there were none."""
+        await self.feed.listen(self.shard)
+        try:
+            await asyncio.wait_for(self._woken.wait(), timeout)
+        except TimeoutError:
+            return False
+        self._woken.clear()
+        return True
+
+    def hold(self, xact_id: int) -> None:
+        """Has the feed wake the subscription once no transaction up to `xact_id` is running any more."""
+        self.feed.hold(self, xact_id)
+
+    async def read(self, position: Position) -> FeedBatch:
+        """The user's checks after `position`, oldest first."""
+        async with get_shard_session_factory(self.shard)() as session:
+            entries, held_back = await models.CheckFeedEntry.get_after(
+                session, user_id=self.user_id, after=position, limit=settings.feed_batch_size
+            )
+        return FeedBatch(
+            events=[
+                (encode_cursor(self.shard, entry), schemas.CheckListItem.from_check(check, schemas.FEED_FIELDS))
+                for entry, check in entries
+                if check is not None
+            ],
+            position=entries[-1][0] if entries else position,
+            full=len(entries) == settings.feed_batch_size,
+            held_back=held_back
+        )
+
+    async def start_position(self) -> Position:
+        async with get_shard_session_factory(self.shard)() as session:
+            return await models.CheckFeedEntry.get_start(session)
+
+
+class CheckFeed:
+
+    def __init__(self):
+        self._listeners: dict[int, asyncpg.Connection] = {}
+        self._connecting: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._subscriptions: dict[int, set[Subscription]] = defaultdict(set)
+        self._held: dict[int, dict[Subscription, int]] = defaultdict(dict)  # by shard
+        self._watchers: dict[int, asyncio.Task] = {}
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int, shard: int) -> AsyncIterator[Subscription]:
+        subscription = Subscription(self, user_id=user_id, shard=shard)
+        # Listening before the first read, so that no insert falls in between.
+        await self.listen(shard)
+        self._subscriptions[user_id].add(subscription)
+        feed_subscribers.inc()
+        try:
+            yield subscription
+        finally:
+            feed_subscribers.dec()
+            self._held[shard].pop(subscription, None)
+            self._subscriptions[user_id].discard(subscription)
+            if not self._subscriptions[user_id]:
+                del self._subscriptions[user_id]
+
+    async def listen(self, shard: int) -> None:
+        if shard in self._listeners:
+            return
+        async with self._connecting[shard]:
+            if shard in self._listeners:
+                return
+            url = get_shard_url(shard)
+            connection = await asyncpg.connect(
+                host=url.host, port=url.port, user=url.username, password=url.password, database=url.database
+            )
+            await connection.add_listener(models.NEW_CHECKS_CHANNEL, partial(self._notify, shard))
+            connection.add_termination_listener(partial(self._lost, shard))
+            self._listeners[shard] = connection
+
+    def hold(self, subscription: Subscription, xact_id: int) -> None:
+        self._held[subscription.shard][subscription] = xact_id
+        if subscription.shard not in self._watchers:
+            self._watchers[subscription.shard] = asyncio.create_task(self._watch(subscription.shard))
+
+    async def _watch(self, shard: int) -> None:
+        # One query for every held back subscription of the shard, rather
+        # than each re-reading its entries until they are final.
+        held = self._held[shard]
+        try:
+            while held:
+                await asyncio.sleep(settings.feed_held_back_retry_seconds)
+                await self.listen(shard)
+                xmin = await self._listeners[shard].fetchval(f'SELECT {models.SNAPSHOT_XMIN_SQL}')
+                for subscription, xact_id in list(held.items()):
+                    if xact_id < xmin:
+                        del held[subscription]
+                        subscription.wake()
+        except Exception:
+            logger.exception('Failed to check the held back feed entries of shard %s', shard)
+            for subscription in held:
+                subscription.wake()  # to read again, and hold again
+            held.clear()
+        finally:
+            del self._watchers[shard]
+
+    def _notify(self, shard: int, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        feed_notifications.labels(shard).inc()
+        for subscription in self._subscriptions.get(int(payload), ()):
+            subscription.wake()
+
+    def _lost(self, shard: int, connection: asyncpg.Connection) -> None:
+        if self._listeners.get(shard) is not connection:
+            return
+        del self._listeners[shard]
+        logger.warning('Lost the new checks listener of shard %s', shard)
+        # Whatever was sent in the meantime is gone; everyone re-reads and
+        # the next wait connects again.
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                if subscription.shard == shard:
+                    subscription.wake()
+
+    async def close(self) -> None:
+        for watcher in list(self._watchers.values()):
+            watcher.cancel()
+        listeners, self._listeners = self._listeners, {}
+        for connection in listeners.values():
+            await connection.close()
+
+
+check_feed = CheckFeed()
+
+
+def format_event(cursor: str, item: schemas.CheckListItem) -> str:
+    data = item.model_dump_json(by_alias=True, exclude_unset=True)
+    return f'id: {cursor}\nevent: check\ndata: {data}\n\n'
+
+
+async def stream_checks(user_id: int, shard: int, cursor: Cursor | None) -> AsyncIterator[str]:
+    """Server-sent events of the checks after `cursor` (or from now on), then of new ones as they come."""
+    async with check_feed.subscribe(user_id, shard) as subscription:
+        position = resume_position(cursor, shard) if cursor else await subscription.start_position()
+        while True:
+            batch = await subscription.read(position)
+            position = batch.position
+            for event_cursor, item in batch.events:
+                yield format_event(event_cursor, item)
+            if batch.full:
+                continue
+            if batch.held_back is not None:
+                subscription.hold(batch.held_back)
+            while not await subscription.wait(settings.feed_heartbeat_seconds):
+                yield ': keep-alive\n\n'
+
+
+async def poll_checks(user_id: int, shard: int, cursor: Cursor | None, wait: float) -> schemas.CheckChanges:
+    """The checks after `cursor` (or from now on), waiting up to `wait` seconds for one if there are none yet."""
+    async with check_feed.subscribe(user_id, shard) as subscription:
+        position = resume_position(cursor, shard) if cursor else await subscription.start_position()
+        give_up_at = time.monotonic() + wait
+        while True:
+            batch = await subscription.read(position)
+            position = batch.position
+            remaining = give_up_at - time.monotonic()
+            if batch.events or remaining <= 0:
+                break
+            if batch.full:
+                continue
+            if batch.held_back is not None:
+                subscription.hold(batch.held_back)
+            if not await subscription.wait(remaining):
+                break
+    return schemas.CheckChanges(items=[item for _, item in batch.events], cursor=encode_cursor(shard, position))
@@ -0,0 +1,193 @@
+import asyncio
+import pickle
+import tempfile
+import time
+
+from contextlib import aclosing
+from decimal import Decimal
+from typing import Any, AsyncIterator, Iterator, Self
+
+import ijson
+
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from . import schemas
+from service.errors import RequestTimeoutError
+from service.utils import round_money
+
+
+SPOOL_MEMORY_BYTES = 8 * 1024 ** 2
+
+
+def make_error(type: str, loc: tuple, msg: str, input: Any = None) -> dict:
+    return {'type': type, 'loc': loc, 'msg': msg, 'input': input}
+
+
+def prefix_errors(exc: ValidationError, loc: tuple) -> list[dict]:
+    return [
+        {**error, 'loc': (*loc, *error['loc'])}
+        for error in exc.errors(include_url=False)
+    ]
+
+
+class CheckStream:
+    """A `CheckIn` body that is parsed and validated while it is being received.
+
+    `receive` pushes the body through a single ijson event parser as it
+    arrives. Products are validated in chunks and spooled to a temporary file,
+    in memory up to `SPOOL_MEMORY_BYTES`, so only one chunk is held at a time
+    and the database is not touched until the whole body is in; the total is
+    accumulated on the way. `payment` may come before or after the products,
+    so it and `rest` are only final once `receive` has returned.
+
+    The client has `idle_timeout` seconds for each piece of the body and
+    `timeout` for all of it, after which the request fails with a 408.
+    """
+
+    def __init__(self, body: AsyncIterator[bytes], chunk_size: int, idle_timeout: float, timeout: float):
+        self._body = body
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.payment: schemas.Payment | None = None
+        self.products_count = 0
+        self.total: Decimal | int = 0
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._spool.close()
+
+    @property
+    def rest(self) -> Decimal | int:
+        assert self.payment is not None
+        return round_money(self.payment.amount - self.total)
+
+    def _validate_products(self, chunk: list[Any]) -> list[schemas.Product]:
+        try:
+            products = schemas.ProductList.validate_python(chunk)
+        except ValidationError as exc:
+            raise RequestValidationError([
+                {**error, 'loc': ('body', 'products', self.products_count + error['loc'][0], *error['loc'][1:])}
+                for error in exc.errors(include_url=False)
+            ])
+        self.products_count += len(products)
+        self.total = round_money(self.total + sum(product.total for product in products))
+        return products
+
+    async def _receive_body(self) -> AsyncIterator[bytes]:
+        give_up_at = time.monotonic() + self.timeout
+        pieces = aiter(self._body)
+        while True:
+            try:
+                async with asyncio.timeout(min(self.idle_timeout, give_up_at - time.monotonic())):
+                    data = await anext(pieces)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                raise RequestTimeoutError()
+            yield data
+
+    async def _parse(self) -> AsyncIterator[list]:
+        # The body is pushed into the parser piece by piece rather than pulled
+        # by it, so each piece is handled before the next one is received.
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=False)
+        try:
+            async with aclosing(self._receive_body()) as body:
+                async for data in body:
+                    if not data:
+                        continue  # an empty send means end of input to the parser
+                    parser.send(data)
+                    yield events
+                    del events[:]
+            parser.close()
+        except ijson.JSONError as exc:
+            raise RequestValidationError(
+                [make_error('json_invalid', ('body', 0), 'JSON decode error', {}) | {'ctx': {'error': str(exc)}}]
+            )
+        yield events
+
+    async def product_chunks(self) -> AsyncIterator[list[schemas.Product]]:
+        chunk: list[Any] = []
+        payment: ijson.ObjectBuilder | None = None
+        product: ijson.ObjectBuilder | None = None
+        seen_products = False
+
+        async with aclosing(self._parse()) as pieces:
+            async for events in pieces:
+                for prefix, event, value in events:
+                    if prefix == 'products.item' or prefix.startswith('products.item.'):
+                        if product is None and event not in ('start_map', 'start_array'):
+                            chunk.append(value)  # not an object, for validation to reject
+                            continue
+                        product = product or ijson.ObjectBuilder()
+                        product.event(event, value)
+                        if prefix == 'products.item' and event in ('end_map', 'end_array'):
+                            chunk.append(product.value)
+                            product = None
+                    elif prefix == 'payment' or prefix.startswith('payment.'):
+                        payment = payment or ijson.ObjectBuilder()
+                        payment.event(event, value)
+                    elif prefix == 'products':
+                        if event == 'start_array':
+                            seen_products = True
+                        elif event != 'end_array':
+                            raise RequestValidationError(
+                                [make_error('list_type', ('body', 'products'), 'Input should be a valid list', value)]
+                            )
+                    elif event == 'map_key':
+                        if value not in ('products', 'payment'):
+                            raise RequestValidationError(
+                                [make_error('extra_forbidden', ('body', value), 'Extra inputs are not permitted')]
+                            )
+                    elif event not in ('start_map', 'end_map'):
+                        raise RequestValidationError([make_error(
+                            'model_attributes_type', ('body',),
+                            'Input should be a valid dictionary or object to extract fields from'
+                        )])
+
+                while len(chunk) >= self.chunk_size:
+                    yield self._validate_products(chunk[:self.chunk_size])
+                    del chunk[:self.chunk_size]
+
+        if chunk:
+            yield self._validate_products(chunk)
+
+        errors = []
+        if not seen_products:
+            errors.append(make_error('missing', ('body', 'products'), 'Field required'))
+        elif not self.products_count:
+            errors.append(make_error(
+                'too_short', ('body', 'products'), 'List should have at least 1 item after validation, not 0', []
+            ))
+        if payment is None:
+            errors.append(make_error('missing', ('body', 'payment'), 'Field required'))
+        else:
+            try:
+                self.payment = schemas.Payment.model_validate(payment.value)
+            except ValidationError as exc:
+                errors.extend(prefix_errors(exc, ('body', 'payment')))
+        if errors:
+            raise RequestValidationError(errors)
+
+    async def receive(self) -> None:
+        """Reads and validates the whole body, keeping the products for `spooled_chunks`."""
+        async with aclosing(self.product_chunks()) as chunks:
+            async for products in chunks:
+                pickle.dump(
+                    [(product.name, product.price, product.quantity) for product in products],
+                    self._spool, protocol=pickle.HIGHEST_PROTOCOL
+                )
+
+    def spooled_chunks(self) -> Iterator[list[tuple[str, Decimal | int, Decimal | int]]]:
+        """The name, price and quantity of the received products, in chunks."""
+        self._spool.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._spool)
+            except EOFError:
+                return
@@ -0,0 +1,199 @@
+"""Background jobs, queued in the `jobs` table of each database and run by a worker.
+
+    python -m service.jobs --concurrency 10
+
+Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+them can run against the same database. A job runs in its own transaction,
+which also deletes it, and must be idempotent: the job of a worker that
+dies is run again once its visibility timeout has passed, and failed
+attempts are retried with an exponential backoff.
+
+Workers also prune the `check_feed` entries older than FEED_RETENTION_HOURS.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import signal
+import time
+
+from contextlib import suppress
+from dataclasses import asdict
+from typing import Awaitable, Callable
+
+from prometheus_client import start_http_server
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from . import models, schemas
+from service.cache import get_cache_backend, list_counts_cache, receipts_cache
+from service.config import get_shard_engine, get_shard_session_factory, get_shards, settings
+from service.logger import logger
+from service.metrics import (
+    get_registry, job_duration, job_queue_depth, jobs_enqueued, jobs_processed, mark_process_dead
+)
+from service.utils import make_digest
+
+
+Handler = Callable[[AsyncSession, dict], Awaitable[None]]
+
+handlers: dict[str, Handler] = {}
+
+DEPTH_REPORT_INTERVAL = 15
+FEED_PRUNE_INTERVAL = 300
+
+
+def job(kind: str) -> Callable[[Handler], Handler]:
+    def register(handler: Handler) -> Handler:
+        handlers[kind] = handler
+        return handler
+    return register
+
+
+def enqueue(session: AsyncSession, kind: str, payload: dict, delay: float = 0) -> None:
+    """Adds the job to the session's transaction; it is queued when that commits."""
+    models.Job.enqueue(session, kind=kind, payload=payload, delay=delay)
+    jobs_enqueued.labels(kind).inc()
+
+
+def enqueue_check_created(session: AsyncSession, check: models.Check) -> bool:
+    # Only worth it with a cache the API processes share with the worker.
+    if not (settings.jobs_enabled and settings.cache_url):
+        return False
+    enqueue(session, 'render_receipt', {'public_id': check.public_id})
+    enqueue(session, 'warm_list_count', {'user_id': check.user_id})
+    return True
+
+
+@job('render_receipt')
+async def render_receipt(session: AsyncSession, payload: dict) -> None:
+    db_check = await models.Check.get_by_id(session=session, public_id=payload['public_id'])
+    if db_check is None:
+        return  # archived in the meantime
+    check = schemas.CheckOut.model_validate(db_check)
+    for width in settings.receipt_prerender_widths:
+        await receipts_cache.set(f'{check.public_id}:{width}', f'{check:{width}}')
+
+
+@job('warm_list_count')
+async def warm_list_count(session: AsyncSession, payload: dict) -> None:
+    user_id = payload['user_id']
+    params = schemas.CheckListParams(filters=schemas.CheckListFilters())
+    await list_counts_cache.get_or_set(
+        make_digest(asdict(params.filters)),
+        lambda: models.Check.get_count(session=session, user_id=user_id, params=params),
+        scope=user_id
+    )
+
+
+class Worker:
+
+    def __init__(self, shard: int, concurrency: int, poll_interval: float, visibility_timeout: float):
+        self.shard = shard
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+
+    @property
+    def session_factory(self) -> async_sessionmaker[AsyncSession]:
+        return get_shard_session_factory(self.shard)
+
+    async def run_once(self) -> int:
+        async with self.session_factory() as session:
+            jobs = await models.Job.claim(session, limit=self.concurrency, visibility_timeout=self.visibility_timeout)
+            await session.commit()
+        await asyncio.gather(*(self._run(job) for job in jobs))
+        return len(jobs)
+
+    async def _run(self, job: models.Job) -> None:
+        started = time.perf_counter()
+        try:
+            handler = handlers.get(job.kind)
+            if handler is None:
+                raise LookupError(f'No handler for {job.kind!r} jobs')
+            async with self.session_factory() as session:
+                # Past the timeout the job may already be running elsewhere.
+                await asyncio.wait_for(handler(session, job.payload), self.visibility_timeout)
+                await models.Job.complete(session, job.id)
+                await session.commit()
+        except Exception as exc:
+            backoff = settings.job_retry_backoff_seconds * 2 ** (job.attempts - 1)
+            async with self.session_factory() as session:
+                retried = await models.Job.retry_or_fail(session, job, error=repr(exc), backoff=backoff)
+                await session.commit()
+            jobs_processed.labels(job.kind, 'retry' if retried else 'failed').inc()
+            logger.warning(
+                'Job %s (%s) attempt %s/%s failed: %r', job.id, job.kind, job.attempts, job.max_attempts, exc,
+                exc_info=not retried
+            )
+        else:
+            jobs_processed.labels(job.kind, 'ok').inc()
+        finally:
+            job_duration.labels(job.kind).observe(time.perf_counter() - started)
+
+    async def report_depth(self) -> None:
+        async with self.session_factory() as session:
+            depth = await models.Job.get_depth(session)
+        for state, count in depth.items():
+            job_queue_depth.labels(self.shard, state).set(count)
+
+    async def prune_feed(self) -> None:
+        async with self.session_factory() as session:
+            pruned = await models.CheckFeedEntry.prune(
+                session, older_than=datetime.timedelta(hours=settings.feed_retention_hours)
+            )
+            await session.commit()
+        if pruned:
+            logger.info('Pruned %s check feed entries of shard %s', pruned, self.shard)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        reported_at = pruned_at = 0.0
+        while not stop.is_set():
+            try:
+                claimed = await self.run_once()
+                if time.monotonic() - reported_at >= DEPTH_REPORT_INTERVAL:
+                    await self.report_depth()
+                    reported_at = time.monotonic()
+                if time.monotonic() - pruned_at >= FEED_PRUNE_INTERVAL:
+                    await self.prune_feed()
+                    pruned_at = time.monotonic()
+            except Exception:
+                logger.exception('Job worker for shard %s failed to poll', self.shard)
+                claimed = 0
+            if claimed < self.concurrency:
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(stop.wait(), self.poll_interval)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shard', type=int, action='append', choices=list(get_shards()), help='default: all')
+    parser.add_argument('--concurrency', type=int, default=settings.job_concurrency)
+    parser.add_argument('--poll-interval', type=float, default=settings.job_poll_interval)
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.metrics_port:
+        start_http_server(args.metrics_port, registry=get_registry())
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+
+    shards = args.shard or list(get_shards())
+    logger.info('Job worker started for shards %s', shards)
+    # In-flight jobs are finished on shutdown, no new ones are claimed.
+    await asyncio.gather(*(
+        Worker(
+            shard, concurrency=args.concurrency, poll_interval=args.poll_interval,
+            visibility_timeout=settings.job_visibility_timeout
+        ).run(stop)
+        for shard in shards
+    ))
+    await get_cache_backend().close()
+    for shard in shards:
+        await get_shard_engine(shard).dispose()
+    mark_process_dead()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
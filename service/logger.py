@@ -29,7 +29,8 @@ class InjectingFormatter(ColourizedFormatter):
             'request_id': click.style(request.state.id, italic=True) if request else 'N/A',
             'method': request.method if request else '',
             'path': request.scope['path'] if request else '',
-            'bind_params': cls.format_bind_params(request.state.logger_bind_params) if request else ''
+            'bind_params': cls.format_bind_params(request.state.logger_bind_params) if request else '',
+            'db_stats': str(request.state.query_stats) if request else ''
         }
 
     @classmethod
@@ -1,18 +1,119 @@
-from typing import cast
+import asyncio
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import AsyncIterator, cast
 
 from fastapi import FastAPI, HTTPException
 import fastapi.routing
 
+from sqlalchemy.ext.asyncio import AsyncEngine
 from starlette.types import ExceptionHandler
 
-from service.utils import LogRequestMiddleware, http_exception_logger, request_response_logger
+from service import models, schemas
+from service.cache import get_cache_backend
+from service.compression import CompressionMiddleware
+from service.config import get_db_engine, get_session_factory, get_shard_engine, get_shards, settings
+from service.deadlines import CancelOnDisconnectMiddleware
+from service.feed import check_feed
+from service.logger import logger
+from service.metrics import make_metrics_app, mark_process_dead
+from service.money_columns import check_storage
+from service.profiling import ProfilingMiddleware
+from service.tracing import TracingMiddleware, setup_tracing, shutdown_tracing
+from service.utils import LogRequestMiddleware, http_exception_logger, request_response_logger, password_hasher
 from service.routers import users, checks
 
 
-fastapi.routing.run_endpoint_function = request_response_logger
+WARMUP_CHECK = {
+    'public_id': 'ch_0000000000000000000000',
+    'created_at': datetime(2025, 1, 1, tzinfo=timezone.utc),
+    'total': '10.00',
+    'rest': '0.00',
+    'payment': {'type': 'cash', 'amount': '10.00'},
+    'products': [{'name': 'warm-up', 'price': '10.00', 'quantity': '1.000'}],
+}
+# Verification takes its cost parameters from the hash, so this exercises the
+# argon2 bindings without spending a real hash's time and memory at startup.
+WARMUP_PASSWORD_HASH = '$argon2id$v=19$m=8,t=1,p=1$Ekn4gwYe7zOXuqLfjrDlKg$ejXp9fZyJ2j8wIlG7re/LR4UH1GESzvcDbrfraYBXFs'
+
+
+async def warm_up_pool(engine: AsyncEngine, connections: int) -> None:
+    async def open_connection() -> None:
+        async with engine.connect():
+            pass
+
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
+    async with get_session_factory()() as session:
+        await models.User.get_by_username(session=session, username='')
+        await models.Check.get_by_id(session=session, public_id='')
+
+
+def warm_up_schemas() -> None:
+    schemas.CheckIn.model_validate(
+        {key: WARMUP_CHECK[key] for key in ('payment', 'products')}
+    ).model_dump()
+    check = schemas.CheckOut.model_validate(WARMUP_CHECK)
+    check.model_dump(mode='json', by_alias=True)
+    format(check, '32')
+
+
+def warm_up_password_hasher() -> None:
+    password_hasher.verify('warm-up', WARMUP_PASSWORD_HASH)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    engine = get_db_engine()
+    # Reading BIGINT columns as NUMERIC, or the other way round, would be off by a factor of 100 or 1000.
+    for shard in get_shards():
+        await check_storage(shard)
+    if settings.startup_warmup:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            warm_up_pool(engine, settings.db_pool_warmup_connections),
+            loop.run_in_executor(None, warm_up_schemas),
+            loop.run_in_executor(None, warm_up_password_hasher),
+        )
+        logger.info('Worker warmed up')
+    try:
+        yield
+    finally:
+        await check_feed.close()
+        await get_cache_backend().close()
+        for shard in get_shards():
+            await get_shard_engine(shard).dispose()
+        shutdown_tracing()
+        mark_process_dead()
+
+
+def create_app() -> FastAPI:
+    fastapi.routing.run_endpoint_function = request_response_logger
+    if settings.tracing_otlp_file:
+        from service.otlp_file import OTLPFileSpanExporter
+        setup_tracing(OTLPFileSpanExporter(settings.tracing_otlp_file))
 
-app = FastAPI(title='Checkbox Take Home')
-app.include_router(users.router)
-app.include_router(checks.router)
-app.add_middleware(LogRequestMiddleware)  # type: ignore
-app.add_exception_handler(HTTPException, cast(ExceptionHandler, http_exception_logger))
+    app = FastAPI(title='Checkbox Take Home', lifespan=lifespan)
+    app.include_router(users.router)
+    app.include_router(checks.router)
+    if settings.metrics_token:
+        app.mount('/metrics', make_metrics_app(settings.metrics_token))
+    app.add_middleware(
+        CompressionMiddleware,  # type: ignore
+        minimum_size=settings.compression_minimum_size,
+        gzip_level=settings.gzip_compresslevel,
+        brotli_quality=settings.brotli_quality
+    )
+    if settings.profiling_secret or settings.profiling_sample_rate:
+        app.add_middleware(
+            ProfilingMiddleware,  # type: ignore
+            directory=settings.profiling_dir,
+            sample_rate=settings.profiling_sample_rate,
+            secret=settings.profiling_secret,
+            interval_ms=settings.profiling_interval_ms
+        )
+    app.add_middleware(TracingMiddleware)  # type: ignore
+    app.add_middleware(LogRequestMiddleware)  # type: ignore
+    app.add_middleware(CancelOnDisconnectMiddleware)  # type: ignore
+    app.add_exception_handler(HTTPException, cast(ExceptionHandler, http_exception_logger))
+    return app
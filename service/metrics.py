@@ -0,0 +1,153 @@
+import hmac
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, make_asgi_app, multiprocess
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+singleflight_calls = Counter(
+    'singleflight_calls_total',
+    'Lookups that went through a single-flight group',
+    ['group']
+)
+singleflight_coalesced = Counter(
+    'singleflight_coalesced_total',
+    'Lookups that were served by an identical in-flight call',
+    ['group']
+)
+
+conditional_requests = Counter(
+    'http_conditional_requests_total',
+    'Conditional list requests by outcome (not_modified means a 304 was returned)',
+    ['result']
+)
+compression_bytes_in = Counter(
+    'http_compression_bytes_in_total',
+    'Response bytes before compression',
+    ['encoding']
+)
+compression_bytes_out = Counter(
+    'http_compression_bytes_out_total',
+    'Response bytes after compression',
+    ['encoding']
+)
+
+write_batch_size = Histogram(
+    'check_write_batch_size',
+    'Number of checks inserted per group commit',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250)
+)
+write_batch_fallbacks = Counter(
+    'check_write_batch_fallbacks_total',
+    'Group commits that were retried item by item after a database error'
+)
+
+archived_check_reads = Counter(
+    'archived_check_reads_total',
+    'Check lookups that missed the hot tables and were served from the archive'
+)
+
+db_statement_duration = Histogram(
+    'db_statement_duration_seconds',
+    'Execution time of single SQL statements',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+)
+request_db_statements = Histogram(
+    'http_request_db_statements',
+    'SQL statements run per request',
+    ['route'],
+    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100)
+)
+request_db_duration = Histogram(
+    'http_request_db_duration_seconds',
+    'Time spent in SQL statements per request',
+    ['route'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+
+cache_requests = Counter(
+    'cache_requests_total',
+    'Cache lookups by namespace and result',
+    ['namespace', 'result']
+)
+
+jobs_enqueued = Counter(
+    'jobs_enqueued_total',
+    'Background jobs queued',
+    ['kind']
+)
+jobs_processed = Counter(
+    'jobs_processed_total',
+    'Background job attempts by outcome (retry and failed are errors, failed means out of attempts)',
+    ['kind', 'result']
+)
+job_duration = Histogram(
+    'job_duration_seconds',
+    'Run time of background job attempts',
+    ['kind'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+)
+job_queue_depth = Gauge(
+    'job_queue_depth',
+    'Background jobs in the queue by state, as last seen by a worker',
+    ['shard', 'state'],
+    multiprocess_mode='mostrecent'
+)
+
+feed_subscribers = Gauge(
+    'check_feed_subscribers',
+    'Open check stream and long-poll requests',
+    multiprocess_mode='livesum'
+)
+feed_notifications = Counter(
+    'check_feed_notifications_total',
+    'New-check notifications received from the database',
+    ['shard']
+)
+
+requests_cancelled = Counter(
+    'http_requests_cancelled_total',
+    'Requests cancelled because the client disconnected before the response was complete',
+    ['route']
+)
+requests_deadline_exceeded = Counter(
+    'http_request_deadline_exceeded_total',
+    'Requests answered with 504 because a SQL statement outlived the request deadline',
+    ['route']
+)
+
+
+def get_registry() -> CollectorRegistry:
+    """The metrics of every process writing to PROMETHEUS_MULTIPROC_DIR if it is set, else of this one.
+
+    The directory has to be emptied before the processes start, as the
+    Dockerfile's entrypoint does; files left by earlier runs would be added in.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def mark_process_dead() -> None:
+    """Drops this process's share of the live gauges, for when a worker exits."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def make_metrics_app(token: str) -> ASGIApp:
+    metrics_app = make_asgi_app(registry=get_registry())
+    expected = f'Bearer {token}'
+
+    async def app(scope: Scope, receive: Receive, send: Send) -> None:
+        authorization = Headers(scope=scope).get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), expected.encode()):
+            response = PlainTextResponse('Unauthorized', status_code=401, headers={'WWW-Authenticate': 'Bearer'})
+            await response(scope, receive, send)
+            return
+        await metrics_app(scope, receive, send)
+
+    return app
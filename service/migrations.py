@@ -0,0 +1,224 @@
+"""Helpers for migrations that run against a live database.
+
+    alembic -x lock_timeout=2s upgrade head
+    alembic -x dry_run=true upgrade head
+
+A migration waiting for a lock on a busy table makes every later query on it
+wait as well, so migrations run with a `lock_timeout` (5s unless given) and
+fail instead of stalling writes; just run them again later. Large tables get
+their indexes with `create_index_concurrently`, their data changes with
+`backfill` and their constraints checked with `validate_constraint` and
+`set_not_null`, which commit outside the migration's transaction.
+
+A dry run applies the migrations in a transaction that is rolled back, under
+the same lock timeout, and only estimates the concurrent index builds,
+backfills and validations from the table statistics instead of running them.
+"""
+import logging
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator, Sequence
+
+from alembic import op
+from sqlalchemy import Connection, text
+
+
+log = logging.getLogger('alembic.online')
+
+# Rough rates for the dry-run estimates; a concurrent build scans the table twice.
+INDEX_BUILD_BYTES_PER_SECOND = 64 * 1024 ** 2
+BACKFILL_ROWS_PER_SECOND = 20_000
+PROGRESS_INTERVAL = 10
+
+PROGRESS_TABLE = 'alembic_backfill'
+
+
+@dataclass
+class Options:
+    dry_run: bool = False
+    lock_timeout: str = '5s'
+
+
+options = Options()
+
+
+def configure(connection: Connection, x_arguments: dict[str, str]) -> None:
+    """Reads the `-x` arguments and sets the lock timeout of the migration connection; called by env.py."""
+    options.dry_run = x_arguments.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    options.lock_timeout = x_arguments.get('lock_timeout', options.lock_timeout)
+    set_lock_timeout(connection, options.lock_timeout)
+    connection.commit()
+
+
+def set_lock_timeout(connection: Connection, value: str) -> None:
+    connection.execute(text("SELECT set_config('lock_timeout', :value, false)"), {'value': value})
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02}m{seconds:02}s' if hours else f'{minutes}m{seconds:02}s'
+
+
+def table_stats(table_name: str) -> tuple[int, int]:
+    """Estimated rows and size in bytes, as of the last ANALYZE."""
+    rows, size = op.get_bind().execute(text(
+        'SELECT greatest(reltuples, 0)::bigint, pg_table_size(oid) FROM pg_class WHERE oid = to_regclass(:table)'
+    ), {'table': table_name}).one()
+    return rows, size
+
+
+@contextmanager
+def outside_transaction(lock_timeout: str | None = None) -> Iterator[Connection]:
+    """Commits the migration so far and runs the block in autocommit mode, optionally with another lock timeout."""
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        if lock_timeout is not None:
+            set_lock_timeout(bind, lock_timeout)
+        try:
+            yield bind
+        finally:
+            if lock_timeout is not None:
+                set_lock_timeout(bind, options.lock_timeout)
+
+
+def create_index_concurrently(
+        index_name: str, table_name: str, columns: Sequence[Any], **kwargs: Any
+) -> None:
+    """`op.create_index` without blocking writes to the table; safe to run again after a failed build."""
+    if options.dry_run:
+        rows, size = table_stats(table_name)
+        log.info(
+            'Dry run: would build index %s on %s (%d rows, %d MB) concurrently, about %s',
+            index_name, table_name, rows, size // 1024 ** 2, format_duration(2 * size / INDEX_BUILD_BYTES_PER_SECOND)
+        )
+        return
+    # Only SHARE UPDATE EXCLUSIVE is taken, which writes do not wait for, but
+    # the build itself waits for every older transaction to finish.
+    with outside_transaction(lock_timeout='0') as bind:
+        # A failed concurrent build leaves an invalid index behind.
+        invalid = bind.scalar(text(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'
+        ), {'name': index_name})
+        if invalid:
+            log.info('Dropping invalid index %s left by an earlier build', index_name)
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+        op.create_index(index_name, table_name, columns, postgresql_concurrently=True, if_not_exists=True, **kwargs)
+
+
+def drop_index_concurrently(index_name: str, table_name: str) -> None:
+    if options.dry_run:
+        log.info('Dry run: would drop index %s concurrently', index_name)
+        return
+    with outside_transaction(lock_timeout='0'):
+        op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+
+
+def validate_constraint(table_name: str, constraint_name: str) -> None:
+    """Validates a constraint added `NOT VALID`, scanning the table under a lock that writes do not wait for."""
+    if options.dry_run:
+        rows, size = table_stats(table_name)
+        log.info(
+            'Dry run: would validate %s on %s (%d rows, %d MB), about %s',
+            constraint_name, table_name, rows, size // 1024 ** 2,
+            format_duration(size / INDEX_BUILD_BYTES_PER_SECOND)
+        )
+        return
+    with outside_transaction():
+        op.execute(f'ALTER TABLE {table_name} VALIDATE CONSTRAINT {constraint_name}')
+
+
+def set_not_null(table_name: str, column_name: str) -> None:
+    """`ALTER COLUMN .. SET NOT NULL` without scanning the table while holding its exclusive lock.
+
+    A validated `CHECK (column IS NOT NULL)` proves the column has no NULLs,
+    so the SET NOT NULL that follows it skips the scan.
+    """
+    if options.dry_run:
+        validate_constraint(table_name, f'NOT NULL of {column_name}')
+        return
+    constraint_name = f'{table_name}_{column_name}_not_null_check'
+    op.create_check_constraint(
+        constraint_name, table_name, f'{column_name} IS NOT NULL', postgresql_not_valid=True
+    )
+    validate_constraint(table_name, constraint_name)
+    op.alter_column(table_name, column_name, nullable=False)
+    op.drop_constraint(constraint_name, table_name, type_='check')
+
+
+def backfill(
+        name: str, table_name: str, set_: str, where: str = 'true', key: str = 'id',
+        batch_size: int = 1000, pause: float = 0.05
+) -> int:
+    """Runs `UPDATE table_name SET set_ WHERE where` in batches of `batch_size` rows in `key` order.
+
+    Every batch commits on its own, followed by a `pause` to let replicas and
+    autovacuum keep up. Progress is kept in the `alembic_backfill` table under
+    `name`, so an interrupted backfill goes on from its last batch.
+    """
+    if options.dry_run:
+        rows, _ = table_stats(table_name)
+        plan = op.get_bind().execute(text(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM {table_name} WHERE {where}')).scalar()
+        matching = plan[0]['Plan']['Plan Rows']
+        batches = -(-rows // batch_size)
+        log.info(
+            'Dry run: would backfill %s, about %d of %d rows of %s in %d batches, about %s',
+            name, matching, rows, table_name, batches,
+            format_duration(matching / BACKFILL_ROWS_PER_SECOND + batches * pause)
+        )
+        return 0
+
+    with outside_transaction() as bind:
+        bind.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (name VARCHAR PRIMARY KEY, '
+            'last_key BIGINT NOT NULL, updated_rows BIGINT NOT NULL, updated_at TIMESTAMP NOT NULL)'
+        ))
+        progress = bind.execute(
+            text(f'SELECT last_key, updated_rows FROM {PROGRESS_TABLE} WHERE name = :name'), {'name': name}
+        ).first()
+        min_key, max_key = bind.execute(text(f'SELECT min({key}), max({key}) FROM {table_name}')).one()
+        if progress:
+            last_key, updated = tuple(progress)
+            log.info('Backfill %s resumes after %s=%s', name, key, last_key)
+        else:
+            last_key, updated = (min_key - 1 if min_key is not None else 0), 0
+
+        # One statement per batch, so the rows and the progress commit together.
+        batch_stmt = text(f"""
+            WITH batch AS (
+                SELECT {key} AS batch_key FROM {table_name}
+                WHERE {key} > :after ORDER BY {key} LIMIT :limit
+            ), updated AS (
+                UPDATE {table_name} SET {set_} FROM batch
+                WHERE {table_name}.{key} = batch.batch_key AND ({where})
+                RETURNING 1
+            ), counts AS (
+                SELECT (SELECT max(batch_key) FROM batch) AS last_key, (SELECT count(*) FROM updated) AS updated_rows
+            ), progress AS (
+                INSERT INTO {PROGRESS_TABLE} (name, last_key, updated_rows, updated_at)
+                SELECT :name, last_key, :updated + updated_rows, timezone('utc', now())
+                FROM counts WHERE last_key IS NOT NULL
+                ON CONFLICT (name) DO UPDATE SET
+                    last_key = excluded.last_key, updated_rows = excluded.updated_rows, updated_at = excluded.updated_at
+            )
+            SELECT last_key, updated_rows FROM counts
+        """)
+        started = reported_at = time.monotonic()
+        while True:
+            batch_last_key, rows = bind.execute(
+                batch_stmt, {'after': last_key, 'limit': batch_size, 'name': name, 'updated': updated}
+            ).one()
+            if batch_last_key is None:
+                break
+            last_key, updated = batch_last_key, updated + rows
+            if time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                log.info('Backfill %s: %d rows updated, at %s=%s of %s', name, updated, key, last_key, max_key)
+                reported_at = time.monotonic()
+            time.sleep(pause)
+
+        bind.execute(text(f'DELETE FROM {PROGRESS_TABLE} WHERE name = :name'), {'name': name})
+    log.info('Backfill %s done: %d rows updated in %s', name, updated, format_duration(time.monotonic() - started))
+    return updated
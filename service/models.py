@@ -1,23 +1,60 @@
 import datetime
+import json
+import secrets
+import uuid
+import zlib
 
-from typing import Sequence, Self, cast, get_args
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Iterable, Sequence, Self, cast, get_args
 from decimal import Decimal
 
-from sqlalchemy import ForeignKey, select, Select, and_, \
-    Numeric, Index, CHAR, String, Enum, func
-from sqlalchemy.sql import ColumnExpressionArgument
+from sqlalchemy import ForeignKey, Row, select, Select, and_, \
+    Numeric, BigInteger, SmallInteger, LargeBinary, Index, CHAR, String, Text, Enum, func, insert, update, delete, event, \
+    DDL, Dialect, URL, case, literal, literal_column, any_, text, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as pg_insert
+from sqlalchemy.types import TypeDecorator, TypeEngine
+from sqlalchemy.sql import ColumnElement, ColumnExpressionArgument
 from sqlalchemy.sql.operators import eq, asc_op, desc_op, ge, le, OperatorType
-from sqlalchemy.orm import Mapped, DeclarativeBase, mapped_column, relationship
+from sqlalchemy.orm import Mapped, DeclarativeBase, Session, SessionTransaction, mapped_column, relationship, \
+    noload, load_only, column_property, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import schemas
-from service.utils import UtcNow, generate_base62uuid
+from service.config import settings
+from service.utils import UtcNow, generate_check_id, escape_like, to_minor_units, format_fixed, hash_token, \
+    utcnow
+
+if TYPE_CHECKING:
+    from service.ingest import CheckStream
 
 
 class Base(DeclarativeBase):
     pass
 
 
+class FixedPoint(TypeDecorator):
+    """NUMERIC(precision, scale), or a BIGINT count of 10**-scale units with MONEY_MINOR_UNITS."""
+
+    impl = Numeric
+    cache_ok = True
+
+    def __init__(self, precision: int, scale: int):
+        super().__init__(precision, scale)
+        self.scale = scale
+
+    def load_dialect_impl(self, dialect: Dialect) -> TypeEngine:
+        if settings.money_minor_units:
+            return dialect.type_descriptor(BigInteger())
+        return super().load_dialect_impl(dialect)
+
+    def process_bind_param(self, value, dialect):
+        # Query parameters such as the total filters stay Decimal in both modes.
+        if settings.money_minor_units and isinstance(value, Decimal):
+            return to_minor_units(value, self.scale)
+        return value
+
+
 class User(Base):
 
     __tablename__ = 'users'
@@ -44,15 +81,202 @@ class User(Base):
         )
 
 
+class RefreshToken(Base):
+    """An opaque refresh token, stored as its SHA-256 digest.
+
+    Tokens are single use: refreshing rotates to a new token in the same
+    family. Presenting a rotated token again revokes the whole family.
+    """
+
+    __tablename__ = 'refresh_tokens'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    token_hash: Mapped[str] = mapped_column(CHAR(64), unique=True, index=True)
+    family_id: Mapped[str] = mapped_column(CHAR(32), index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), index=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(default=UtcNow())
+    expires_at: Mapped[datetime.datetime]
+    used_at: Mapped[datetime.datetime | None]
+    revoked_at: Mapped[datetime.datetime | None]
+
+    @classmethod
+    def issue(cls, session: AsyncSession, user_id: int, family_id: str | None = None) -> str:
+        token = secrets.token_urlsafe(32)
+        session.add(cls(
+            token_hash=hash_token(token),
+            family_id=family_id or uuid.uuid4().hex,
+            user_id=user_id,
+            expires_at=utcnow() + datetime.timedelta(days=settings.refresh_token_expire_days)
+        ))
+        return token
+
+    @classmethod
+    async def get_for_update(cls, session: AsyncSession, token: str) -> Self | None:
+        return await session.scalar(
+            select(cls)
+            .where(cls.token_hash == hash_token(token))
+            .with_for_update()
+        )
+
+    @classmethod
+    async def revoke_family(cls, session: AsyncSession, family_id: str) -> None:
+        await session.execute(
+            update(cls)
+            .where(cls.family_id == family_id, cls.revoked_at.is_(None))
+            .values(revoked_at=UtcNow())
+        )
+
+    def is_active(self) -> bool:
+        return self.revoked_at is None and self.expires_at > utcnow()
+
+
+class ProductIdCache:
+    """Product ids by database and name, limited to ids known to be committed.
+
+    Ids a session looks up only get in once it commits: a name inserted by a
+    transaction or savepoint that is rolled back has no row to refer to.
+    """
+
+    SESSION_KEY = 'product_ids'
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._ids: OrderedDict[tuple[URL, str], int] = OrderedDict()
+
+    def get_many(self, database: URL, names: Iterable[str]) -> dict[str, int]:
+        found = {}
+        for name in names:
+            key = (database, name)
+            if (product_id := self._ids.get(key)) is not None:
+                self._ids.move_to_end(key)
+                found[name] = product_id
+        return found
+
+    def stage(self, session: AsyncSession, database: URL, ids: Iterable[tuple[int, str]]) -> None:
+        session.info.setdefault(self.SESSION_KEY, {}).update(((database, name), product_id) for product_id, name in ids)
+
+    def commit(self, staged: dict[tuple[URL, str], int]) -> None:
+        self._ids.update(staged)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+
+product_ids = ProductIdCache(max_entries=settings.product_id_cache_max_entries)
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_product_ids(session: Session) -> None:
+    # Releasing a savepoint commits nothing yet.
+    if session.in_nested_transaction():
+        return
+    if staged := session.info.pop(ProductIdCache.SESSION_KEY, None):
+        product_ids.commit(staged)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_product_ids(session: Session, previous_transaction: SessionTransaction) -> None:
+    session.info.pop(ProductIdCache.SESSION_KEY, None)
+
+
+class Product(Base):
+    """Product names, stored once and referred to by `check_products`."""
+
+    __tablename__ = 'products'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(255), unique=True)
+
+    @classmethod
+    async def get_ids(cls, session: AsyncSession, names: Iterable[str]) -> dict[str, int]:
+        """Ids of `names`, adding the ones that are new, in one statement for all of them that are not cached."""
+        database, names = session.get_bind().url, set(names)
+        ids = product_ids.get_many(database, names)
+        # Sorted, so that concurrent inserts of the same new names take their locks in the same order.
+        missing = sorted(names - ids.keys())
+        while missing:
+            wanted = select(func.unnest(literal(missing, ARRAY(String))).label('name')).cte('wanted')
+            inserted = pg_insert(cls).from_select(['name'], select(wanted.c.name)) \
+                .on_conflict_do_nothing(index_elements=[cls.name]) \
+                .returning(cls.id, cls.name) \
+                .cte('inserted')
+            rows = (await session.execute(
+                select(inserted.c.id, inserted.c.name)
+                .union_all(select(cls.id, cls.name).join(wanted, cls.name == wanted.c.name))
+            )).tuples().all()
+            product_ids.stage(session, database, rows)
+            ids.update((name, product_id) for product_id, name in rows)
+            # A name committed by someone else after this statement's snapshot
+            # was taken is neither inserted nor seen; the next round finds it.
+            missing = [name for name in missing if name not in ids]
+        return ids
+
+
 class CheckProduct(Base):
 
     __tablename__ = "check_products"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    check_id: Mapped[int] = mapped_column(ForeignKey('checks.id'))
-    name: Mapped[str] = mapped_column(String(255))
-    price: Mapped[Decimal] = mapped_column(Numeric(10, 2))
-    quantity: Mapped[Decimal] = mapped_column(Numeric(10, 3))
+    check_id: Mapped[int] = mapped_column(ForeignKey('checks.id'), index=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey('products.id'))
+    price: Mapped[Decimal] = mapped_column(FixedPoint(10, 2))
+    quantity: Mapped[Decimal] = mapped_column(FixedPoint(10, 3))
+
+    name: Mapped[str] = column_property(
+        select(Product.name).where(Product.id == product_id).scalar_subquery()
+    )
+
+
+class ProductRow:
+    __slots__ = ('name', 'price', 'quantity')
+
+    def __init__(self, name: str, price: Decimal | int, quantity: Decimal | int):
+        self.name = name
+        self.price = price
+        self.quantity = quantity
+
+
+class CheckRow:
+    """A check as read by `Check.fetch_rows`: plain values, no ORM state.
+
+    It has the attributes `schemas.CheckOut` is validated from and is turned
+    into JSON by `schemas.dump_check_row`.
+    """
+
+    __slots__ = ('public_id', 'created_at', 'total', 'rest', 'payment_type', 'payment_amount', 'products')
+
+    def __init__(
+            self,
+            public_id: str,
+            created_at: datetime.datetime,
+            total: Decimal | int,
+            rest: Decimal | int,
+            payment_type: schemas.CheckTypeChoices,
+            payment_amount: Decimal | int,
+            products: list[ProductRow]
+    ):
+        self.public_id = public_id
+        self.created_at = created_at
+        self.total = total
+        self.rest = rest
+        self.payment_type = payment_type
+        self.payment_amount = payment_amount
+        self.products = products
+
+    @property
+    def payment(self) -> dict:
+        return {'type': self.payment_type, 'amount': self.payment_amount}
+
+
+def public_ids_param(public_ids: Sequence[str]) -> ColumnElement:
+    """The ids as a single array parameter, for `public_id = ANY(...)`.
+
+    It stays one prepared statement however many ids there are, and has the
+    column's type so that its index is used.
+    """
+    return literal(list(public_ids), ARRAY(CHAR(25)))
 
 
 class Check(Base):
@@ -62,11 +286,11 @@ class Check(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     public_id: Mapped[str] = mapped_column(
         CHAR(25), unique=True, index=True,
-        default=lambda: f'ch_{generate_base62uuid()}'
+        default=lambda context: generate_check_id(context.get_current_parameters()['user_id'])
     )
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), index=True)
-    total: Mapped[Decimal] = mapped_column(Numeric(12, 2))
-    rest: Mapped[Decimal] = mapped_column(Numeric(12, 2))
+    total: Mapped[Decimal] = mapped_column(FixedPoint(12, 2))
+    rest: Mapped[Decimal] = mapped_column(FixedPoint(12, 2))
     created_at: Mapped[datetime.datetime] = mapped_column(default=UtcNow())
 
     payment_type: Mapped[schemas.CheckTypeChoices] = mapped_column(Enum(
@@ -75,13 +299,13 @@ class Check(Base):
         create_constraint=True,
         validate_string=True
     ))
-    payment_amount: Mapped[Decimal] = mapped_column(Numeric(12, 2))
+    payment_amount: Mapped[Decimal] = mapped_column(FixedPoint(12, 2))
 
     products: Mapped[list[CheckProduct]] = relationship(lazy='selectin')
 
     @property
-    def payment(self) -> schemas.Payment:
-        return schemas.Payment.model_validate(
+    def payment(self) -> schemas.PaymentOut:
+        return schemas.PaymentOut.model_validate(
             {'type': self.payment_type, 'amount': self.payment_amount}
         )
 
@@ -98,48 +322,197 @@ class Check(Base):
         )
         session.add(db_check)
         await session.flush()
+        ids = await Product.get_ids(session, (product.name for product in check.products))
         session.add_all(
             CheckProduct(
                 check_id=db_check.id,
-                name=product.name,
+                product_id=ids[product.name],
                 price=product.price,
                 quantity=product.quantity
             )
             for product in check.products
         )
-        await session.commit()
+        # Committed by the caller, together with whatever else belongs to the check.
+        await session.flush()
         await session.refresh(db_check)
         return db_check
 
     @classmethod
-    async def get_by_id(cls, session: AsyncSession, public_id: str, user_id: int | None = None) -> Self | None:
+    async def create_many(
+            cls,
+            session: AsyncSession,
+            checks: Sequence[tuple[int, schemas.CheckIn]]
+    ) -> list[Self]:
+        db_checks = (await session.scalars(
+            insert(cls).returning(cls, sort_by_parameter_order=True).options(noload(cls.products)),
+            [
+                {
+                    **check.model_dump(exclude={'products', 'payment'}),
+                    'payment_type': check.payment.type,
+                    'payment_amount': check.payment.amount,
+                    'user_id': user_id
+                }
+                for user_id, check in checks
+            ]
+        )).all()
+        ids = await Product.get_ids(session, (product.name for _, check in checks for product in check.products))
+        db_products = (await session.scalars(
+            insert(CheckProduct).returning(CheckProduct, sort_by_parameter_order=True),
+            [
+                {
+                    'check_id': db_check.id,
+                    'product_id': ids[product.name],
+                    'price': product.price,
+                    'quantity': product.quantity
+                }
+                for db_check, (_, check) in zip(db_checks, checks)
+                for product in check.products
+            ]
+        )).all()
+
+        names = [product.name for _, check in checks for product in check.products]
+        products_by_check: dict[int, list[CheckProduct]] = {db_check.id: [] for db_check in db_checks}
+        for db_product, name in zip(db_products, names):
+            # RETURNING only has the table's columns.
+            set_committed_value(db_product, 'name', name)
+            products_by_check[db_product.check_id].append(db_product)
+        for db_check in db_checks:
+            set_committed_value(db_check, 'products', products_by_check[db_check.id])
+        return list(db_checks)
+
+    @classmethod
+    async def create_from_stream(cls, session: AsyncSession, user_id: int, check: 'CheckStream') -> Self:
+        """Inserts a check that `check` has received in full, copying its spooled products in chunks."""
+        db_check = cls(user_id=user_id, total=check.total, rest=check.rest, payment=check.payment.model_dump())
+        session.add(db_check)
+        await session.flush()
+
+        connection = await (await session.connection()).get_raw_connection()
+        for products in check.spooled_chunks():
+            ids = await Product.get_ids(session, (name for name, _, _ in products))
+            await connection.driver_connection.copy_records_to_table(
+                CheckProduct.__tablename__,
+                columns=['check_id', 'product_id', 'price', 'quantity'],
+                records=[(db_check.id, ids[name], price, quantity) for name, price, quantity in products]
+            )
+        return db_check
+
+    @classmethod
+    def build_by_id_stmt(cls, public_id: str, user_id: int | None = None) -> Select:
         stmt = select(cls).where(cls.public_id == public_id)
         if user_id:
             stmt = stmt.where(cls.user_id == user_id)
-        return await session.scalar(stmt)
+        return stmt
 
     @classmethod
-    async def get_list(
-            cls,
-            session: AsyncSession,
-            user_id: int,
-            params: schemas.CheckListParams
-    ) -> tuple[Sequence[Self], int | None]:
+    async def get_by_id(cls, session: AsyncSession, public_id: str, user_id: int | None = None) -> Self | None:
+        return await session.scalar(cls.build_by_id_stmt(public_id=public_id, user_id=user_id))
+
+    @classmethod
+    async def get_row_by_id(cls, session: AsyncSession, public_id: str, user_id: int | None = None) -> CheckRow | None:
+        rows = await cls.fetch_rows(session, cls.build_by_id_stmt(public_id=public_id, user_id=user_id))
+        return rows[0] if rows else None
+
+    @classmethod
+    async def get_rows_by_ids(cls, session: AsyncSession, public_ids: Sequence[str], user_id: int) -> list[CheckRow]:
+        stmt = select(cls).where(cls.public_id == any_(public_ids_param(public_ids)), cls.user_id == user_id)
+        return await cls.fetch_rows(session, stmt)
+
+    @classmethod
+    async def fetch_rows(cls, session: AsyncSession, stmt: Select) -> list[CheckRow]:
+        """Runs a select of checks for just the columns `CheckOut` needs, plus one query for the products.
+
+        Rows come back as tuples and go straight into `CheckRow`s, skipping
+        ORM instances, the identity map and relationship loading.
+        """
+        checks, products = cls.__table__.c, CheckProduct.__table__.c
+        rows = (await session.execute(stmt.with_only_columns(
+            checks.id, checks.public_id, checks.created_at, checks.total, checks.rest,
+            checks.payment_type, checks.payment_amount
+        ))).all()
+        if not rows:
+            return []
+
+        check_products: dict[int, list[ProductRow]] = {row[0]: [] for row in rows}
+        names = Product.__table__.c
+        product_rows = await session.execute(
+            select(products.check_id, names.name, products.price, products.quantity)
+            .join_from(CheckProduct.__table__, Product.__table__, products.product_id == names.id)
+            .where(products.check_id.in_(list(check_products)))
+            .order_by(products.id)
+        )
+        for check_id, name, price, quantity in product_rows:
+            check_products[check_id].append(ProductRow(name, price, quantity))
+        return [
+            CheckRow(public_id, created_at, total, rest, payment_type, payment_amount, check_products[check_id])
+            for check_id, public_id, created_at, total, rest, payment_type, payment_amount in rows
+        ]
+
+    @classmethod
+    async def get_latest_marker(cls, session: AsyncSession, user_id: int) -> tuple[int, datetime.datetime] | None:
+        row = (await session.execute(
+            select(cls.id, cls.created_at)
+            .where(cls.user_id == user_id)
+            .order_by(cls.id.desc())
+            .limit(1)
+        )).first()
+        return tuple(row) if row else None
+
+    @classmethod
+    def build_list_stmt(cls, user_id: int, params: schemas.CheckListParams) -> Select:
         init_stmt = select(cls) \
             .where(cls.user_id == user_id)
 
-        page_stmt = cls.ListStmtBuilder(init_stmt=init_stmt, params=params) \
+        return cls.ListStmtBuilder(init_stmt=init_stmt, params=params, user_id=user_id) \
             .add_filters().add_order().add_pagination() \
             .build()
 
-        res = await session.scalars(page_stmt)
-        items = res.all()
-        total = await session.scalar(
+    @classmethod
+    def list_load_options(cls, fields: Sequence[schemas.CheckField]) -> list:
+        columns = {
+            'id': [cls.public_id],
+            'created_at': [cls.created_at],
+            'total': [cls.total],
+            'rest': [cls.rest],
+            'payment': [cls.payment_type, cls.payment_amount],
+            'public_url': [cls.public_id],
+        }
+        options = [load_only(cls.id, *{column for field in fields for column in columns.get(field, [])})]
+        if 'products' not in fields:
+            options.append(noload(cls.products))
+        return options
+
+    @classmethod
+    async def get_page(cls, session: AsyncSession, user_id: int, params: schemas.CheckListParams) -> Sequence[Self]:
+        stmt = cls.build_list_stmt(user_id=user_id, params=params)
+        if params.check_fields != schemas.CHECK_FIELDS:
+            stmt = stmt.options(*cls.list_load_options(params.check_fields))
+        res = await session.scalars(stmt)
+        return res.all()
+
+    @classmethod
+    async def get_page_rows(cls, session: AsyncSession, user_id: int, params: schemas.CheckListParams) -> list[CheckRow]:
+        return await cls.fetch_rows(session, cls.build_list_stmt(user_id=user_id, params=params))
+
+    @classmethod
+    async def get_count(cls, session: AsyncSession, user_id: int, params: schemas.CheckListParams) -> int | None:
+        page_stmt = cls.build_list_stmt(user_id=user_id, params=params)
+        return await session.scalar(
             select(func.count()).select_from(
                 page_stmt.order_by(None).limit(None).offset(None)
                 .subquery()
             )
         )
+
+    @classmethod
+    async def get_list(
+            cls,
+            session: AsyncSession,
+            user_id: int,
+            params: schemas.CheckListParams
+    ) -> tuple[Sequence[Self], int | None]:
+        items = await cls.get_page(session=session, user_id=user_id, params=params)
+        total = await cls.get_count(session=session, user_id=user_id, params=params)
         return items, total
 
     class ListStmtBuilder:
@@ -149,9 +522,10 @@ class Check(Base):
             '_end': le,
         }
 
-        def __init__(self, init_stmt: Select, params: schemas.CheckListParams):
+        def __init__(self, init_stmt: Select, params: schemas.CheckListParams, user_id: int):
             self.stmt = init_stmt
             self.params = params
+            self.user_id = user_id
 
         def _extract_field_and_operator(self, field_name: str) -> tuple[str, OperatorType]:
             for suffix, op in self.RANGE_SUFFIXES.items():
@@ -160,11 +534,29 @@ class Check(Base):
 
             return field_name, eq
 
+        def _product_condition(self, value: str) -> ColumnExpressionArgument[bool]:
+            # The names are searched once and the user's check products hash
+            # joined to the matches; an EXISTS per check looked up the product
+            # of every line by id instead.
+            user_checks = aliased(Check)
+            matching = select(Product.id).where(Product.name.ilike(f'%{escape_like(value)}%', escape='\\'))
+            return Check.id.in_(
+                select(CheckProduct.check_id)
+                .join(user_checks, user_checks.id == CheckProduct.check_id)
+                .where(user_checks.user_id == self.user_id, CheckProduct.product_id.in_(matching))
+            )
+
+        CUSTOM_FILTERS = {
+            'product': _product_condition,
+        }
+
         def add_filters(self) -> Self:
             filters = self.params.filters
 
             conditions = [
-                getattr(Check, field).operate(op, value)
+                self.CUSTOM_FILTERS[raw_field](self, value)
+                if raw_field in self.CUSTOM_FILTERS
+                else getattr(Check, field).operate(op, value)
                 for raw_field, value in vars(filters).items()
                 if value is not None
                 for field, op in [self._extract_field_and_operator(raw_field)]
@@ -192,4 +584,317 @@ class Check(Base):
             return self.stmt
 
 
+class ArchivedCheck(Base):
+    """A check moved out of the hot tables by `service.archive`.
+
+    Everything but the lookup columns is kept in `payload`: zlib-compressed
+    JSON with the products stored column by column and amounts as decimal
+    strings, so it does not depend on MONEY_MINOR_UNITS.
+    """
+
+    __tablename__ = 'archived_checks'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    public_id: Mapped[str] = mapped_column(CHAR(25), unique=True, index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), index=True)
+    created_at: Mapped[datetime.datetime]
+    archived_at: Mapped[datetime.datetime] = mapped_column(default=UtcNow())
+    payload: Mapped[bytes] = mapped_column(LargeBinary)
+
+    @classmethod
+    def pack(cls, check: Row, products: Sequence[Row]) -> dict:
+        payload = {
+            'total': format_fixed(check.total, 2),
+            'rest': format_fixed(check.rest, 2),
+            'payment': {'type': check.payment_type, 'amount': format_fixed(check.payment_amount, 2)},
+            'products': {
+                'name': [product.name for product in products],
+                'price': [format_fixed(product.price, 2) for product in products],
+                'quantity': [format_fixed(product.quantity, 3) for product in products],
+            },
+        }
+        return {
+            'id': check.id,
+            'public_id': check.public_id,
+            'user_id': check.user_id,
+            'created_at': check.created_at,
+            'payload': zlib.compress(json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()),
+        }
+
+    def unpack(self) -> schemas.CheckOut:
+        payload = json.loads(zlib.decompress(self.payload))
+        columns = payload['products']
+        products = schemas.ProductList.validate_python([
+            {'name': name, 'price': price, 'quantity': quantity}
+            for name, price, quantity in zip(columns['name'], columns['price'], columns['quantity'])
+        ])
+        return schemas.CheckOut.model_validate({
+            'public_id': self.public_id,
+            'created_at': self.created_at,
+            'total': schemas.MoneyAdapter.validate_python(payload['total']),
+            'rest': schemas.MoneyAdapter.validate_python(payload['rest']),
+            'payment': schemas.Payment.model_validate(payload['payment']).model_dump(),
+            'products': [product.model_dump(exclude={'total'}) for product in products],
+        })
+
+    @classmethod
+    async def get_by_id(
+            cls, session: AsyncSession, public_id: str, user_id: int | None = None
+    ) -> schemas.CheckOut | None:
+        stmt = select(cls).where(cls.public_id == public_id)
+        if user_id:
+            stmt = stmt.where(cls.user_id == user_id)
+        archived = await session.scalar(stmt)
+        return archived.unpack() if archived else None
+
+    @classmethod
+    async def get_by_ids(cls, session: AsyncSession, public_ids: Sequence[str], user_id: int) -> list[schemas.CheckOut]:
+        stmt = select(cls).where(cls.public_id == any_(public_ids_param(public_ids)), cls.user_id == user_id)
+        return [archived.unpack() for archived in await session.scalars(stmt)]
+
+    @classmethod
+    async def archive_older_than(cls, session: AsyncSession, cutoff: datetime.datetime, limit: int) -> list[int]:
+        """Moves up to `limit` of the oldest checks created before `cutoff`; returns their users' ids."""
+        # Core statements on the tables: going through the ORM (and its
+        # identity map) made up most of the time spent per batch.
+        checks_table, products_table = Check.__table__, CheckProduct.__table__
+        checks = (await session.execute(
+            select(checks_table)
+            .where(checks_table.c.created_at < cutoff)
+            .order_by(checks_table.c.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )).all()
+        if not checks:
+            return []
+
+        ids = [check.id for check in checks]
+        products_by_check: dict[int, list[Row]] = {check_id: [] for check_id in ids}
+        name = select(Product.name).where(Product.id == products_table.c.product_id).scalar_subquery()
+        for product in sorted(
+            await session.execute(delete(products_table).where(products_table.c.check_id.in_(ids))
+                                  .returning(products_table, name.label('name'))),
+            key=lambda product: product.id
+        ):
+            products_by_check[product.check_id].append(product)
+        await session.execute(delete(checks_table).where(checks_table.c.id.in_(ids)))
+        await session.execute(
+            insert(cls.__table__), [cls.pack(check, products_by_check[check.id]) for check in checks]
+        )
+        return [check.user_id for check in checks]
+
+
+class ShardBucket(Base):
+    """Which shard the users of a bucket keep their checks on, see `service.sharding`."""
+
+    __tablename__ = 'shard_map'
+
+    bucket: Mapped[int] = mapped_column(SmallInteger, primary_key=True, autoincrement=False)
+    shard: Mapped[int] = mapped_column(SmallInteger)
+    moving: Mapped[bool] = mapped_column(default=False)
+
+    @classmethod
+    async def get_all(cls, session: AsyncSession) -> Sequence[Self]:
+        return (await session.scalars(select(cls))).all()
+
+    @classmethod
+    async def assign(cls, session: AsyncSession, buckets: Sequence[int], shard: int, moving: bool) -> None:
+        stmt = pg_insert(cls).values([{'bucket': bucket, 'shard': shard, 'moving': moving} for bucket in buckets])
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[cls.bucket], set_={'shard': stmt.excluded.shard, 'moving': stmt.excluded.moving}
+        ))
+
+    @classmethod
+    async def mark_moving(cls, session: AsyncSession, buckets: Sequence[int]) -> dict[int, int]:
+        """Flags the buckets as moving and returns the shard each of them is on now."""
+        current = {
+            bucket.bucket: bucket.shard
+            for bucket in await session.scalars(select(cls).where(cls.bucket.in_(buckets)).with_for_update())
+        }
+        await session.execute(
+            pg_insert(cls).values([
+                {'bucket': bucket, 'shard': current.get(bucket, 0), 'moving': True} for bucket in buckets
+            ]).on_conflict_do_update(index_elements=[cls.bucket], set_={'moving': True})
+        )
+        return {bucket: current.get(bucket, 0) for bucket in buckets}
+
+
+class Job(Base):
+    """Deferred work for `service.jobs`, deleted once done.
+
+    A claimed job's `run_at` is pushed past the visibility timeout, so it is
+    picked up again if its worker dies; a failed one is rescheduled with a
+    backoff and kept with `failed_at` set when out of attempts.
+    """
+
+    __tablename__ = 'jobs'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(50))
+    payload: Mapped[dict] = mapped_column(JSONB)
+    run_at: Mapped[datetime.datetime] = mapped_column(default=UtcNow())
+    attempts: Mapped[int] = mapped_column(default=0)
+    max_attempts: Mapped[int]
+    locked_at: Mapped[datetime.datetime | None]
+    failed_at: Mapped[datetime.datetime | None]
+    last_error: Mapped[str | None] = mapped_column(Text)
+    created_at: Mapped[datetime.datetime] = mapped_column(default=UtcNow())
+
+    @classmethod
+    def enqueue(cls, session: AsyncSession, kind: str, payload: dict, delay: float = 0) -> None:
+        session.add(cls(
+            kind=kind,
+            payload=payload,
+            run_at=utcnow() + datetime.timedelta(seconds=delay),
+            max_attempts=settings.job_max_attempts
+        ))
+
+    @classmethod
+    async def claim(cls, session: AsyncSession, limit: int, visibility_timeout: float) -> Sequence[Self]:
+        ready = (
+            select(cls.id)
+            .where(cls.failed_at.is_(None), cls.run_at <= UtcNow())
+            .order_by(cls.run_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        return (await session.scalars(
+            update(cls)
+            .where(cls.id.in_(ready.scalar_subquery()))
+            .values(
+                run_at=UtcNow() + datetime.timedelta(seconds=visibility_timeout),
+                locked_at=UtcNow(),
+                attempts=cls.attempts + 1
+            )
+            .returning(cls),
+            execution_options={'synchronize_session': False}
+        )).all()
+
+    @classmethod
+    async def complete(cls, session: AsyncSession, job_id: int) -> None:
+        await session.execute(delete(cls).where(cls.id == job_id))
+
+    @classmethod
+    async def retry_or_fail(cls, session: AsyncSession, job: Self, error: str, backoff: float) -> bool:
+        """Reschedules the job after `backoff` seconds, or marks it failed; returns whether it is retried."""
+        retry = job.attempts < job.max_attempts
+        await session.execute(
+            update(cls)
+            .where(cls.id == job.id)
+            .values(
+                run_at=UtcNow() + datetime.timedelta(seconds=backoff),
+                locked_at=None,
+                failed_at=None if retry else UtcNow(),
+                last_error=error
+            )
+        )
+        return retry
+
+    @classmethod
+    async def get_depth(cls, session: AsyncSession) -> dict[str, int]:
+        now = UtcNow()
+        state = case(
+            (cls.failed_at.is_not(None), 'failed'),
+            (cls.run_at <= now, 'ready'),
+            (cls.locked_at.is_not(None), 'running'),
+            else_='scheduled'
+        )
+        counts = dict((await session.execute(select(state, func.count()).group_by(state))).tuples().all())
+        return {name: counts.get(name, 0) for name in ('ready', 'running', 'scheduled', 'failed')}
+
+
+# The id of the inserting transaction, as a bigint; xid8 never wraps around.
+CURRENT_XACT_ID = text('pg_current_xact_id()::text::bigint')
+# Every transaction below it has committed or rolled back.
+SNAPSHOT_XMIN_SQL = 'pg_snapshot_xmin(pg_current_snapshot())::text::bigint'
+SNAPSHOT_XMIN = literal_column(SNAPSHOT_XMIN_SQL, BigInteger)
+
+
+class CheckFeedEntry(Base):
+    """A new check of a user, recorded by the trigger on `checks` for `service.feed`.
+
+    Check ids are taken when a check is inserted but become visible when its
+    transaction commits, in whatever order that happens. Entries are ordered
+    by the id of the inserting transaction instead, and only read below the
+    oldest transaction still running, so every entry before a cursor is
+    final. Entries are pruned after `FEED_RETENTION_HOURS`.
+    """
+
+    __tablename__ = 'check_feed'
+
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    xact_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, server_default=CURRENT_XACT_ID)
+    check_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(server_default=UtcNow())
+
+    @classmethod
+    async def get_start(cls, session: AsyncSession) -> tuple[int, int]:
+        """The position before every check that has not been committed yet."""
+        return await session.scalar(select(SNAPSHOT_XMIN)), 0
+
+    @classmethod
+    async def get_after(
+            cls, session: AsyncSession, user_id: int, after: tuple[int, int], limit: int
+    ) -> tuple[list[tuple[tuple[int, int], Check | None]], int | None]:
+        """The user's entries after `after` with their checks (None once archived), and the first one held back.
+
+        Entries of transactions at or above the snapshot's xmin may still be
+        joined by ones of older transactions, so they are held back; the
+        xact_id of the first is returned, for waiting until xmin passes it.
+        """
+        rows = (await session.execute(
+            select(cls.xact_id, cls.check_id, cls.xact_id < SNAPSHOT_XMIN, Check)
+            .outerjoin(Check, Check.id == cls.check_id)
+            .options(*Check.list_load_options(schemas.FEED_FIELDS))
+            .where(cls.user_id == user_id, tuple_(cls.xact_id, cls.check_id) > tuple_(*after))
+            .order_by(cls.xact_id, cls.check_id)
+            .limit(limit)
+        )).all()
+        entries = [((xact_id, check_id), check) for xact_id, check_id, final, check in rows if final]
+        return entries, rows[len(entries)].xact_id if len(entries) < len(rows) else None
+
+    @classmethod
+    async def prune(cls, session: AsyncSession, older_than: datetime.timedelta) -> int:
+        result = await session.execute(delete(cls).where(cls.created_at < UtcNow() - older_than))
+        return result.rowcount
+
+
+async def skip_check_feed(session: AsyncSession) -> None:
+    """Keeps the checks the session's transaction inserts out of the feed, for copies of existing ones."""
+    await session.execute(text(f"SELECT set_config('{SKIP_CHECK_FEED_SETTING}', 'on', true)"))
+
+
 Index("idx_checks_created_at_desc", Check.created_at.desc())
+Index("idx_checks_user_id_id_desc", Check.user_id, Check.id.desc())
+Index(
+    "idx_products_name_trgm", Product.name,
+    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}
+)
+
+Index("idx_jobs_run_at", Job.run_at, postgresql_where=Job.failed_at.is_(None))
+Index("idx_check_feed_created_at", CheckFeedEntry.created_at, postgresql_using='brin')
+
+event.listen(Base.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
+# Records inserted checks in `check_feed` and tells the LISTENing API workers
+# (service.feed) whose they are, once per user and statement; the
+# notifications go out on commit. Transactions that copy existing checks
+# (bucket moves, seeding) turn it off with `skip_check_feed`.
+NEW_CHECKS_CHANNEL = 'new_checks'
+SKIP_CHECK_FEED_SETTING = 'checkbox.skip_check_feed'
+event.listen(Check.__table__, 'after_create', DDL(f"""
+CREATE OR REPLACE FUNCTION notify_new_checks() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF current_setting('{SKIP_CHECK_FEED_SETTING}', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO check_feed (user_id, check_id) SELECT user_id, id FROM new_checks;
+    PERFORM pg_notify('{NEW_CHECKS_CHANNEL}', user_id::text) FROM (SELECT DISTINCT user_id FROM new_checks) AS users;
+    RETURN NULL;
+END
+$$
+"""))
+event.listen(Check.__table__, 'after_create', DDL("""
+CREATE TRIGGER checks_notify_new AFTER INSERT ON checks
+REFERENCING NEW TABLE AS new_checks FOR EACH STATEMENT EXECUTE FUNCTION notify_new_checks()
+"""))
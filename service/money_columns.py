@@ -0,0 +1,114 @@
+"""The storage of the money and quantity columns of checks and check_products.
+
+The migrations create them NUMERIC. With MONEY_MINOR_UNITS the service reads
+and writes them as BIGINT kopecks and thousandths instead, so they have to be
+converted before the setting is turned on, and back before it is turned off:
+
+    python -m service.money_columns status
+    python -m service.money_columns convert --to minor-units
+    python -m service.money_columns convert --to numeric --shard 1
+
+A conversion rewrites both tables in one transaction under an ACCESS
+EXCLUSIVE lock, which blocks every read and write of checks until it commits,
+so stop the service first. Workers refuse to start while the columns of any
+database do not match the setting.
+"""
+import argparse
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from service.config import get_shard_engine, get_shards, settings
+
+
+MONEY_COLUMNS = {
+    'checks': [('total', 12, 2), ('rest', 12, 2), ('payment_amount', 12, 2)],
+    'check_products': [('price', 10, 2), ('quantity', 10, 3)],
+}
+
+MINOR_UNITS, NUMERIC = 'bigint', 'numeric'
+
+
+async def get_storage(connection: AsyncConnection) -> set[str]:
+    """The data types of the money columns: {'bigint'}, {'numeric'}, or empty before the migrations ran."""
+    rows = await connection.execute(text(
+        'SELECT DISTINCT data_type FROM information_schema.columns '
+        'WHERE table_schema = current_schema() AND (table_name, column_name) IN ('
+        + ', '.join(f"('{table}', '{name}')" for table, columns in MONEY_COLUMNS.items() for name, _, _ in columns)
+        + ')'
+    ))
+    return set(rows.scalars())
+
+
+async def check_storage(shard: int) -> None:
+    """Raises unless the money columns of the shard's database are what MONEY_MINOR_UNITS reads them as."""
+    expected = MINOR_UNITS if settings.money_minor_units else NUMERIC
+    async with get_shard_engine(shard).connect() as connection:
+        storage = await get_storage(connection)
+    if storage and storage != {expected}:
+        raise RuntimeError(
+            f'MONEY_MINOR_UNITS is {settings.money_minor_units}, but the money columns of shard {shard} are '
+            f'{", ".join(sorted(storage))}; convert them with '
+            f'`python -m service.money_columns convert --to {"minor-units" if settings.money_minor_units else "numeric"}'
+            f'{f" --shard {shard}" if shard else ""}` first'
+        )
+
+
+def conversion_statements(to: str) -> list[str]:
+    if to == MINOR_UNITS:
+        return [
+            f'ALTER TABLE {table} ' + ', '.join(
+                f'ALTER COLUMN {name} TYPE BIGINT USING round({name} * {10 ** scale})::bigint'
+                for name, _, scale in columns
+            )
+            for table, columns in MONEY_COLUMNS.items()
+        ]
+    return [
+        f'ALTER TABLE {table} ' + ', '.join(
+            f'ALTER COLUMN {name} TYPE NUMERIC({precision}, {scale}) USING {name} / {10 ** scale}::numeric'
+            for name, precision, scale in columns
+        )
+        for table, columns in MONEY_COLUMNS.items()
+    ]
+
+
+async def convert(shard: int, to: str, lock_timeout: str = '5s') -> bool:
+    """Converts the money columns of the shard's database to `to`; False if they already were."""
+    async with get_shard_engine(shard).begin() as connection:
+        storage = await get_storage(connection)
+        if not storage:
+            raise RuntimeError(f'Shard {shard} has no money columns, run the migrations first')
+        if storage == {to}:
+            return False
+        await connection.execute(text("SELECT set_config('lock_timeout', :value, true)"), {'value': lock_timeout})
+        for statement in conversion_statements(to):
+            await connection.execute(text(statement))
+    return True
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status')
+    convert_parser = commands.add_parser('convert')
+    convert_parser.add_argument('--to', choices=['minor-units', 'numeric'], required=True)
+    convert_parser.add_argument('--shard', type=int, choices=list(get_shards()), default=0)
+    convert_parser.add_argument('--lock-timeout', default='5s', help='how long to wait for the tables to be free')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        for shard in get_shards():
+            async with get_shard_engine(shard).connect() as connection:
+                storage = await get_storage(connection)
+            print(f'shard {shard}: {", ".join(sorted(storage)) or "not migrated"}')
+    else:
+        to = MINOR_UNITS if args.to == 'minor-units' else NUMERIC
+        converted = await convert(args.shard, to, lock_timeout=args.lock_timeout)
+        print(f'Shard {args.shard}: money columns {"converted to" if converted else "already"} {to}')
+    for shard in get_shards():
+        await get_shard_engine(shard).dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
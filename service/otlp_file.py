@@ -0,0 +1,40 @@
+import base64
+import json
+import threading
+
+from pathlib import Path
+from typing import Sequence
+
+from google.protobuf.json_format import MessageToDict
+from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+
+ID_FIELDS = ('traceId', 'spanId', 'parentSpanId')
+
+
+def hex_ids(value):
+    # OTLP/JSON spells ids in hex where the protobuf JSON mapping uses base64.
+    if isinstance(value, dict):
+        return {
+            key: base64.b64decode(item).hex() if key in ID_FIELDS and isinstance(item, str) else hex_ids(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [hex_ids(item) for item in value]
+    return value
+
+
+class OTLPFileSpanExporter(SpanExporter):
+    """Appends each batch as a line of OTLP/JSON, like the collector's file exporter."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        line = json.dumps(hex_ids(MessageToDict(encode_spans(spans))), separators=(',', ':'))
+        with self._lock, self.path.open('a', encoding='utf-8') as file:
+            file.write(line + '\n')
+        return SpanExportResult.SUCCESS
@@ -0,0 +1,112 @@
+"""Opt-in CPU profiles of single requests.
+
+A request is profiled when it carries a valid `X-Profile-Token` header or is
+picked by PROFILING_SAMPLE_RATE. The profile is written to PROFILING_DIR as
+`<request id>.html`. A token is made with
+
+    python -m service.profiling --ttl 600
+"""
+import argparse
+import hashlib
+import hmac
+import random
+import time
+import uuid
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from service.config import settings
+from service.logger import logger
+
+if TYPE_CHECKING:
+    from pyinstrument import Profiler
+
+
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+
+def sign_profile_token(secret: str, expires: str) -> str:
+    return hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+
+
+def make_profile_token(secret: str, ttl: float) -> str:
+    expires = str(int(time.time() + ttl))
+    return f'{expires}.{sign_profile_token(secret, expires)}'
+
+
+def verify_profile_token(secret: str, token: str) -> bool:
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, sign_profile_token(secret, expires))
+
+
+class ProfilingMiddleware:
+    """Only added to the app when profiling is configured, so it costs nothing otherwise.
+
+    It sits inside `LogRequestMiddleware` to name profiles by its request id,
+    and outside compression so that rendering the response is included.
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            directory: str,
+            sample_rate: float = 0.0,
+            secret: str | None = None,
+            interval_ms: float = 1.0
+    ) -> None:
+        self.app = app
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.interval = interval_ms / 1000
+
+    def should_profile(self, scope: Scope) -> bool:
+        token = Headers(scope=scope).get(PROFILE_TOKEN_HEADER)
+        if token is not None and self.secret:
+            return verify_profile_token(self.secret, token)
+        return random.random() < self.sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+
+        # In async mode the time the request's task spends awaiting (the
+        # database, mostly) is attributed to the awaiting frame.
+        profiler = Profiler(interval=self.interval, async_mode='enabled')
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            request_id = scope.get('state', {}).get('id') or str(uuid.uuid4())
+            path = await run_in_threadpool(self.save, profiler, request_id)
+            logger.info('Request profile saved to %s', path)
+
+    def save(self, profiler: 'Profiler', request_id: str) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{request_id}.html'
+        path.write_text(profiler.output_html(), encoding='utf-8')
+        return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ttl', type=float, default=600, help='seconds the token stays valid')
+    args = parser.parse_args()
+    if not settings.profiling_secret:
+        parser.error('PROFILING_SECRET is not set')
+    print(f'{PROFILE_TOKEN_HEADER}: {make_profile_token(settings.profiling_secret, args.ttl)}')
+
+
+if __name__ == '__main__':
+    main()
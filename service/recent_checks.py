@@ -0,0 +1,133 @@
+"""The latest checks of each user, kept in process to answer the default page of GET /checks/.
+
+Most list requests are page 1 of a user's checks, newest first, with no
+filters. Each worker keeps the newest `RECENT_CHECKS_PER_USER` of them, dumped,
+for up to `RECENT_CHECKS_MAX_USERS` users, and answers those requests without
+going to the database.
+
+A user's ring is tagged with the `list_counts_cache` generation it was read
+at and served only while that is still the current one. Every change to a
+user's checks swaps the generation, in whichever worker makes it, so a ring
+is retired the moment it may be out of date. The worker that commits a new
+check swaps the generation itself and learns which one it replaced; when its
+ring was tagged with that one, nothing else changed in between and the check
+is put into it, which moves the ring on to the new generation.
+
+This relies on the generations being shared, so rings are only kept when
+`CACHE_URL` is set.
+"""
+import datetime
+
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any
+
+from service import schemas
+from service.cache import Cache, list_counts_cache
+from service.config import settings
+from service.metrics import cache_requests
+
+
+class RecentRing:
+    __slots__ = ('generation', 'latest', 'total', 'items')
+
+    def __init__(
+            self,
+            generation: str,
+            latest: tuple[int, datetime.datetime] | None,
+            total: int,
+            items: list[tuple[datetime.datetime, dict[str, Any]]]
+    ):
+        self.generation = generation
+        self.latest = latest
+        self.total = total
+        self.items = items  # newest first, with their created_at
+
+    def covers(self, page_size: int) -> bool:
+        return len(self.items) >= min(page_size, self.total)
+
+    def page(self, page_size: int) -> list[dict[str, Any]]:
+        return [item for _, item in self.items[:page_size]]
+
+
+class RecentChecks:
+
+    namespace = 'recent_checks'
+
+    def __init__(self, size: int, max_users: int, generations: Cache):
+        self.size = size
+        self.max_users = max_users
+        self.generations = generations
+        self._rings: OrderedDict[int, RecentRing] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and bool(settings.cache_url)
+
+    def serves(self, params: schemas.CheckListParams) -> bool:
+        return (
+            self.enabled
+            and params.page == 1
+            and params.order == '-created_at'
+            and params.page_size <= self.size
+            and params.check_fields == schemas.CHECK_FIELDS
+            and all(value is None for value in asdict(params.filters).values())
+        )
+
+    def get(self, user_id: int, generation: str, page_size: int) -> RecentRing | None:
+        ring = self._rings.get(user_id)
+        if ring is not None and ring.generation != generation:
+            del self._rings[user_id]
+            ring = None
+        if ring is None or not ring.covers(page_size):
+            cache_requests.labels(self.namespace, 'miss').inc()
+            return None
+        self._rings.move_to_end(user_id)
+        cache_requests.labels(self.namespace, 'hit').inc()
+        return ring
+
+    def fill(
+            self,
+            user_id: int,
+            generation: str,
+            latest: tuple[int, datetime.datetime] | None,
+            total: int,
+            items: list[tuple[datetime.datetime, dict[str, Any]]]
+    ) -> None:
+        """Keeps a page of dumped checks read for `generation`, which has to have been read before the page was."""
+        self._rings[user_id] = RecentRing(generation, latest, total, items[:self.size])
+        self._rings.move_to_end(user_id)
+        while len(self._rings) > self.max_users:
+            self._rings.popitem(last=False)
+
+    async def add(self, user_id: int, check: Any) -> None:
+        """Records a check of the user that has just been committed, in place of invalidating the list counts."""
+        previous, current = await self.generations.invalidate(scope=user_id)
+        ring = self._rings.get(user_id)
+        if ring is None:
+            return
+        if ring.generation != previous:
+            del self._rings[user_id]
+            return
+
+        ring.generation = current
+        item = schemas.dump_check_row(check)
+        if all(existing['id'] != item['id'] for _, existing in ring.items):  # unless the ring was read after it
+            position = next(
+                (i for i, (created_at, _) in enumerate(ring.items) if created_at <= check.created_at), len(ring.items)
+            )
+            ring.items.insert(position, (check.created_at, item))
+            del ring.items[self.size:]
+            ring.total += 1
+        if ring.latest is None or ring.latest[0] < check.id:
+            ring.latest = (check.id, check.created_at)
+
+    def clear(self) -> None:
+        self._rings.clear()
+
+
+recent_checks = RecentChecks(
+    size=settings.recent_checks_per_user,
+    max_users=settings.recent_checks_max_users,
+    generations=list_counts_cache
+)
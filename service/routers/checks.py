@@ -1,12 +1,30 @@
 from typing import Annotated
 from dataclasses import asdict
 
-from fastapi import APIRouter, Depends, status, Query
-from fastapi.responses import PlainTextResponse
+from fastapi import APIRouter, Depends, Header, Request, Response, status, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic_core import to_json
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import schemas, models
-from service.dependencies import DBSession, get_user_from_token
-from service.errors import NotFoundError, AuthenticationFailedError, InsufficientPaymentError
+from service.batching import get_check_writer
+from service.cache import list_counts_cache, receipts_cache
+from service.config import get_shard_session_factory, settings
+from service.deadlines import restart_deadline
+from service.dependencies import DBSession, ShardSession, get_user_from_token, open_shard_session
+from service.errors import (
+    NotFoundError, AuthenticationFailedError, InsufficientPaymentError, ShardMovingError, DeadlineExceededError,
+    RequestTimeoutError
+)
+from service.feed import parse_cursor, poll_checks, stream_checks
+from service.ingest import CheckStream
+from service.jobs import enqueue_check_created
+from service.metrics import archived_check_reads, conditional_requests
+from service.recent_checks import recent_checks
+from service.sharding import shard_map
+from service.singleflight import checks_flight
+from service.tracing import span
+from service.utils import etag_matches, make_digest, make_weak_etag
 
 
 router = APIRouter(
@@ -15,10 +33,36 @@ router = APIRouter(
 )
 
 
+async def get_check(
+        session: AsyncSession, public_id: str, user_id: int | None = None
+) -> models.CheckRow | schemas.CheckOut | None:
+    check = await models.Check.get_row_by_id(session=session, public_id=public_id, user_id=user_id)
+    if check is None:
+        check = await models.ArchivedCheck.get_by_id(session=session, public_id=public_id, user_id=user_id)
+        if check is not None:
+            archived_check_reads.inc()
+    return check
+
+
+async def find_check(db: AsyncSession, public_id: str) -> models.CheckRow | schemas.CheckOut | None:
+    for shard in await shard_map.shards_for_check(public_id):
+        if shard == 0:
+            check = await get_check(session=db, public_id=public_id)
+        else:
+            async with get_shard_session_factory(shard)() as session:
+                check = await get_check(session=session, public_id=public_id)
+        if check is not None:
+            return check
+    return None
+
+
 @router.post(
     "/",
     status_code=status.HTTP_201_CREATED,
-    responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError, InsufficientPaymentError]},
+    responses={
+        exc.status_code: {'model': exc}
+        for exc in [AuthenticationFailedError, InsufficientPaymentError, ShardMovingError]
+    },
     response_model=schemas.CheckOut,
     response_model_by_alias=True
 )
@@ -30,28 +74,229 @@ async def create_check(
     if check.rest < 0:
         raise InsufficientPaymentError()
 
-    db_check = await models.Check.create(session=db, user_id=user.id, check=check)
+    # The coalesced write brings its own session, so the shard's is only opened otherwise.
+    shard = await shard_map.shard_for_user(user.id, write=True)
+    if settings.check_write_coalescing:
+        return await get_check_writer(shard).submit(user_id=user.id, check=check)
+
+    async with open_shard_session(shard, db) as session:
+        db_check = await models.Check.create(session=session, user_id=user.id, check=check)
+        enqueue_check_created(session, db_check)
+        await session.commit()
+    await recent_checks.add(user.id, db_check)
     return db_check
 
 
+@router.post(
+    "/large",
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        exc.status_code: {'model': exc}
+        for exc in [
+            AuthenticationFailedError, InsufficientPaymentError, RequestTimeoutError, ShardMovingError,
+            DeadlineExceededError
+        ]
+    },
+    response_model=schemas.CheckSummary,
+    response_model_by_alias=True,
+    openapi_extra={'requestBody': {
+        'required': True,
+        'content': {'application/json': {'schema': {'$ref': '#/components/schemas/CheckIn'}}}
+    }}
+)
+async def create_large_check(
+    request: Request,
+    db: DBSession,
+    user: Annotated[models.User, Depends(get_user_from_token)]
+):
+    # Give back the connection of the user lookup while the body comes in,
+    # however slowly, and go to the database only once all of it is in.
+    await db.close()
+    with CheckStream(
+        request.stream(),
+        chunk_size=settings.large_check_chunk_size,
+        idle_timeout=settings.large_check_idle_timeout_seconds,
+        timeout=settings.large_check_upload_timeout_seconds
+    ) as check:
+        await check.receive()
+        if check.rest < 0:
+            raise InsufficientPaymentError()
+
+        restart_deadline(request, db)
+        async with open_shard_session(await shard_map.shard_for_user(user.id, write=True), db) as session:
+            db_check = await models.Check.create_from_stream(session=session, user_id=user.id, check=check)
+            enqueue_check_created(session, db_check)
+            await session.commit()
+    await list_counts_cache.invalidate(scope=user.id)
+    return schemas.CheckSummary(
+        public_id=db_check.public_id,
+        created_at=db_check.created_at,
+        total=check.total,
+        rest=check.rest,
+        payment=check.payment.model_dump(),
+        products_count=check.products_count
+    )
+
+
 @router.get(
     "/",
     status_code=status.HTTP_200_OK,
-    responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]},
+    responses={
+        status.HTTP_304_NOT_MODIFIED: {'description': 'Not Modified'},
+        **{exc.status_code: {'model': exc} for exc in [AuthenticationFailedError, DeadlineExceededError]}
+    },
     response_model=schemas.PageSchema,
     response_model_by_alias=True
 )
 async def list_checks(
     query_params: Annotated[schemas.CheckListParams, Depends()],
-    db: DBSession,
+    db: ShardSession,
+    user: Annotated[models.User, Depends(get_user_from_token)],
+    if_none_match: Annotated[str | None, Header()] = None
+):
+    # Read first: whatever is read after it is at least as new, which is what
+    # lets the default page be kept under it in `recent_checks`.
+    generation = await list_counts_cache.generation(user.id)
+    recent = recent_checks.serves(query_params)
+    ring = recent_checks.get(user.id, generation, query_params.page_size) if recent else None
+    latest = ring.latest if ring else await models.Check.get_latest_marker(session=db, user_id=user.id)
+    # Archiving removes old checks without touching the latest one, so the
+    # counts generation (swapped on every change) is part of the tag as well.
+    etag = make_weak_etag(user.id, latest, generation, asdict(query_params))
+    cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag_matches(if_none_match, etag):
+        conditional_requests.labels('not_modified').inc()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    if if_none_match:
+        conditional_requests.labels('modified').inc()
+
+    if ring:
+        with span('serialize response'):
+            content = schemas.DumpedPageSchema.model_construct(
+                items=ring.page(query_params.page_size),
+                page=query_params.page,
+                page_size=query_params.page_size,
+                total=ring.total
+            ).model_dump_json()
+        return Response(content=content, media_type='application/json', headers=cache_headers)
+
+    fields = query_params.check_fields
+    if fields == schemas.CHECK_FIELDS:
+        rows = await models.Check.get_page_rows(session=db, user_id=user.id, params=query_params)
+    else:
+        items = await models.Check.get_page(session=db, user_id=user.id, params=query_params)
+    total = await list_counts_cache.get_or_set(
+        make_digest(asdict(query_params.filters)),
+        lambda: models.Check.get_count(session=db, user_id=user.id, params=query_params),
+        scope=user.id
+    )
+
+    # Both kinds of page skip the response model: full items are dumped
+    # straight from their rows, partial ones leave out whatever was not asked for.
+    with span('serialize response'):
+        if fields == schemas.CHECK_FIELDS:
+            dumped = [schemas.dump_check_row(row) for row in rows]
+            if recent:
+                recent_checks.fill(
+                    user.id, generation, latest, total, [(row.created_at, item) for row, item in zip(rows, dumped)]
+                )
+            content = schemas.DumpedPageSchema.model_construct(
+                items=dumped,
+                page=query_params.page,
+                page_size=query_params.page_size,
+                total=total
+            ).model_dump_json()
+        else:
+            content = schemas.SparsePageSchema(
+                **asdict(query_params),
+                items=[schemas.CheckListItem.from_check(item, fields) for item in items],
+                total=total
+            ).model_dump_json(by_alias=True, exclude_unset=True)
+    return Response(content=content, media_type='application/json', headers=cache_headers)
+
+
+@router.get(
+    "/stream",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {'content': {'text/event-stream': {}}, 'description': 'A `check` event per new check'},
+        **{exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]}
+    },
+    response_class=StreamingResponse
+)
+async def stream_new_checks(
+    user: Annotated[models.User, Depends(get_user_from_token)],
+    since: Annotated[str | None, Query()] = None,
+    last_event_id: Annotated[str | None, Header()] = None
+):
+    # A reconnecting EventSource sends the id of the last event it got.
+    if since is not None:
+        cursor = parse_cursor(since, ('query', 'since'))
+    else:
+        cursor = parse_cursor(last_event_id, ('header', 'last-event-id'))
+    shard = await shard_map.shard_for_user(user.id)
+    return StreamingResponse(
+        stream_checks(user_id=user.id, shard=shard, cursor=cursor),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@router.get(
+    "/changes",
+    status_code=status.HTTP_200_OK,
+    responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]},
+    response_model=schemas.CheckChanges
+)
+async def poll_new_checks(
+    user: Annotated[models.User, Depends(get_user_from_token)],
+    since: Annotated[str | None, Query()] = None,
+    wait: Annotated[float, Query(ge=0, le=settings.feed_max_wait_seconds)] = 30
+):
+    cursor = parse_cursor(since, ('query', 'since'))
+    shard = await shard_map.shard_for_user(user.id)
+    changes = await poll_checks(user_id=user.id, shard=shard, cursor=cursor, wait=wait)
+    return Response(
+        content=changes.model_dump_json(by_alias=True, exclude_unset=True),
+        media_type='application/json',
+        headers={'Cache-Control': 'no-store'}
+    )
+
+
+@router.post(
+    "/lookup",
+    status_code=status.HTTP_200_OK,
+    responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]},
+    response_model=schemas.CheckLookupOut,
+    response_model_by_alias=True
+)
+async def lookup_checks(
+    lookup: schemas.CheckLookupIn,
+    db: ShardSession,
     user: Annotated[models.User, Depends(get_user_from_token)]
 ):
-    items, total = await models.Check.get_list(session=db, user_id=user.id, params=query_params)
-    return {
-        **asdict(query_params),
-        'items': items,
-        'total': total
-    }
+    public_ids = list(dict.fromkeys(lookup.ids))
+    rows = {row.public_id: row for row in await models.Check.get_rows_by_ids(
+        session=db, public_ids=public_ids, user_id=user.id
+    )}
+    archived: dict[str, schemas.CheckOut] = {}
+    if len(rows) < len(public_ids):
+        archived = {check.public_id: check for check in await models.ArchivedCheck.get_by_ids(
+            session=db, public_ids=[public_id for public_id in public_ids if public_id not in rows], user_id=user.id
+        )}
+        archived_check_reads.inc(len(archived))
+
+    with span('serialize response'):
+        items, missing = [], []
+        for public_id in public_ids:
+            if public_id in rows:
+                items.append(schemas.dump_check_row(rows[public_id]))
+            elif public_id in archived:
+                items.append(archived[public_id].model_dump(mode='json', by_alias=True))
+            else:
+                missing.append(public_id)
+        content = to_json({'items': items, 'missing': missing})
+    return Response(content=content, media_type='application/json')
 
 
 @router.get(
@@ -63,13 +308,20 @@ async def list_checks(
 )
 async def retrieve_check(
     check_id: str,
-    db: DBSession,
+    db: ShardSession,
     user: Annotated[models.User, Depends(get_user_from_token)]
 ):
-    check = await models.Check.get_by_id(session=db, user_id=user.id, public_id=check_id)
+    check = await checks_flight.do(
+        (check_id, user.id),
+        lambda: get_check(session=db, user_id=user.id, public_id=check_id)
+    )
     if not check:
         raise NotFoundError(detail=f"Check with id '{check_id}' not found")
-    return check
+    if isinstance(check, schemas.CheckOut):  # archived
+        return check
+    with span('serialize response'):
+        content = to_json(schemas.dump_check_row(check))
+    return Response(content=content, media_type='application/json')
 
 
 @router.get(
@@ -82,10 +334,17 @@ async def view_check(
     db: DBSession,
     width: int = Query(default=32, ge=20, le=80)
 ) -> PlainTextResponse:
-    check_db = await models.Check.get_by_id(session=db, public_id=check_id)
-    if not check_db:
-        raise NotFoundError(detail=f"Check with id '{check_id}' not found")
+    async def render_receipt() -> str | None:
+        check_db = await checks_flight.do(
+            (check_id, None),
+            lambda: find_check(db=db, public_id=check_id)
+        )
+        if not check_db:
+            return None
+        check = schemas.CheckOut.model_validate(check_db)
+        return f'{check:{width}}'
 
-    check = schemas.CheckOut.model_validate(check_db)
-    content = f'{check:{width}}'
+    content = await receipts_cache.get_or_set(f'{check_id}:{width}', render_receipt)
+    if content is None:
+        raise NotFoundError(detail=f"Check with id '{check_id}' not found")
     return PlainTextResponse(content=content)
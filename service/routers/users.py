@@ -1,16 +1,13 @@
-import jwt
-
-from datetime import datetime, timedelta, timezone
 from typing import Annotated
 from asyncpg.exceptions import UniqueViolationError
 from sqlalchemy.exc import IntegrityError
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Response, status
 
 from .. import schemas, models
 from service.dependencies import DBSession, get_user_from_form
-from service.config import settings
-from service.utils import get_password_hash
+from service.sharding import mirror_user
+from service.utils import create_access_token, get_password_hash, utcnow
 from service.errors import AlreadyExistsError, AuthenticationFailedError
 
 
@@ -40,6 +37,7 @@ async def register_user(
             raise AlreadyExistsError(detail=f"A user with the username '{user.username}' already exists.")
         raise e
 
+    await mirror_user(db_user)
     return db_user
 
 
@@ -50,11 +48,52 @@ async def register_user(
     responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]},
 )
 async def login_user(
-    user: Annotated[models.User, Depends(get_user_from_form)]
+    user: Annotated[models.User, Depends(get_user_from_form)],
+    db: DBSession
+):
+    refresh_token = models.RefreshToken.issue(session=db, user_id=user.id)
+    await db.commit()
+    return {'access_token': create_access_token(user.username), 'refresh_token': refresh_token}
+
+
+@router.post(
+    "/token/refresh",
+    status_code=status.HTTP_200_OK,
+    response_model=schemas.Token,
+    responses={exc.status_code: {'model': exc} for exc in [AuthenticationFailedError]},
+)
+async def refresh_access_token(
+    body: schemas.RefreshTokenIn,
+    db: DBSession
+):
+    refresh_token = await models.RefreshToken.get_for_update(session=db, token=body.refresh_token)
+    if not refresh_token or not refresh_token.is_active():
+        raise AuthenticationFailedError(detail='Invalid refresh token')
+    if refresh_token.used_at is not None:
+        # A rotated token was presented again, so it has leaked: end the whole session.
+        await models.RefreshToken.revoke_family(session=db, family_id=refresh_token.family_id)
+        await db.commit()
+        raise AuthenticationFailedError(detail='Invalid refresh token')
+
+    user = await db.get_one(models.User, refresh_token.user_id)
+    refresh_token.used_at = utcnow()
+    new_refresh_token = models.RefreshToken.issue(
+        session=db, user_id=user.id, family_id=refresh_token.family_id
+    )
+    await db.commit()
+    return {'access_token': create_access_token(user.username), 'refresh_token': new_refresh_token}
+
+
+@router.post(
+    "/token/revoke",
+    status_code=status.HTTP_204_NO_CONTENT,
+    response_class=Response,
+)
+async def revoke_refresh_token(
+    body: schemas.RefreshTokenIn,
+    db: DBSession
 ):
-    payload = {
-        'sub': f'username:{user.username}',
-        'exp': datetime.now(timezone.utc) + timedelta(minutes=settings.access_token_expire_minutes)
-    }
-    access_token = jwt.encode(payload, settings.auth_secret_key, settings.jwt_algorithm)
-    return {'access_token': access_token}
+    refresh_token = await models.RefreshToken.get_for_update(session=db, token=body.refresh_token)
+    if refresh_token:
+        await models.RefreshToken.revoke_family(session=db, family_id=refresh_token.family_id)
+        await db.commit()
@@ -1,18 +1,20 @@
 import textwrap
 
 from datetime import datetime, time, date
-from typing import Annotated, Literal, Self
+from functools import cache, cached_property, partial
+from typing import Annotated, Any, Iterable, Literal, Self, get_args
 from decimal import Decimal
 from math import ceil
 
-from pydantic import BaseModel, Field, StringConstraints, WrapSerializer, \
-    computed_field, AnyUrl, SecretStr, model_validator, AfterValidator
+from pydantic import BaseModel, Field, StringConstraints, WrapSerializer, PlainSerializer, BeforeValidator, \
+    WithJsonSchema, computed_field, AnyUrl, SecretStr, model_validator, AfterValidator, TypeAdapter
 from pydantic.dataclasses import dataclass
 from fastapi.exceptions import RequestValidationError
 from fastapi import Query, Depends
 
-from service.utils import wrap_datetime, quantize_money
+from service.utils import wrap_datetime, to_minor_units, format_minor_units, format_fixed, line_total, round_money
 from service.config import settings
+from service.tracing import span
 
 
 TrimmedStr = Annotated[str, StringConstraints(strip_whitespace=True)]
@@ -31,6 +33,40 @@ OrderChoices = Literal[
     'total', '-total'
 ]
 
+CheckField = Literal['id', 'created_at', 'total', 'rest', 'payment', 'products', 'public_url']
+CHECK_FIELDS: tuple[CheckField, ...] = get_args(CheckField)
+FEED_FIELDS: tuple[CheckField, ...] = tuple(field for field in CHECK_FIELDS if field != 'products')
+
+
+def minor_units(scale: int, parse: bool) -> Any:
+    value = Annotated[
+        int,
+        PlainSerializer(partial(format_minor_units, scale=scale), return_type=str, when_used='json'),
+        WithJsonSchema({'type': 'string'}, mode='serialization'),
+    ]
+    if not parse:
+        return value
+    return Annotated[
+        value,
+        BeforeValidator(partial(to_minor_units, scale=scale)),
+        Field(ge=0),
+        WithJsonSchema({'anyOf': [{'type': 'number'}, {'type': 'string'}]}, mode='validation'),
+    ]
+
+
+# With MONEY_MINOR_UNITS amounts are held as integer kopecks and quantities as
+# thousandths, read from and written as the same decimal strings. `Money` and
+# `Quantity` parse client input; the `*Value` types hold values that are in the
+# internal representation already, e.g. the ones loaded from the database.
+if settings.money_minor_units:
+    Money, MoneyValue = minor_units(2, parse=True), minor_units(2, parse=False)
+    Quantity, QuantityValue = minor_units(3, parse=True), minor_units(3, parse=False)
+    dump_money, dump_quantity = partial(format_minor_units, scale=2), partial(format_minor_units, scale=3)
+else:
+    Money = MoneyValue = Annotated[Decimal, Field(ge=0.00, decimal_places=2)]
+    Quantity = QuantityValue = Annotated[Decimal, Field(ge=0, decimal_places=3)]
+    dump_money = dump_quantity = str
+
 
 class UserBase(BaseModel):
     full_name: Annotated[TrimmedStr, Field(min_length=1, max_length=255)]
@@ -45,27 +81,40 @@ class UserOut(UserBase, from_attributes=True):
     created_at: Annotated[datetime, WrapSerializer(wrap_datetime, return_type=str, when_used='json')]
 
 
+class Principal(BaseModel, from_attributes=True):
+    id: int
+    username: str
+    full_name: str
+    created_at: datetime
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    refresh_token: str
+
+
+class RefreshTokenIn(BaseModel, extra='forbid'):
+    refresh_token: str
 
 
 class Product(BaseModel, from_attributes=True, extra='forbid'):
     name: Annotated[TrimmedStr, Field(min_length=1, max_length=255)]
-    price: Annotated[Decimal, Field(ge=0.00, decimal_places=2)]
-    quantity: Annotated[Decimal, Field(ge=0, decimal_places=3)]
+    price: Money
+    quantity: Quantity
 
     @computed_field
-    @property
-    def total(self) -> Decimal:
-        return quantize_money(self.price * self.quantity)
+    @cached_property
+    def total(self) -> MoneyValue:
+        return line_total(self.price, self.quantity)
 
     def __format__(self, format_spec: str) -> str:
             width = int(format_spec) if format_spec else 40
-            qty_price = f'{self.quantity:.3f} x {self.price:,.2f}'.ljust(width).rstrip()
+            qty_price = f'{format_fixed(self.quantity, 3)} x {format_fixed(self.price, 2, grouping=True)}'
+            qty_price = qty_price.ljust(width).rstrip()
 
             name_lines = textwrap.wrap(self.name.capitalize(), width=width)
-            total_str = f'{self.total:,.2f}'
+            total_str = format_fixed(self.total, 2, grouping=True)
 
             last_name = name_lines[-1]
             space_remaining = width - len(last_name)
@@ -76,14 +125,23 @@ class Product(BaseModel, from_attributes=True, extra='forbid'):
             return "\n".join([qty_price, *name_lines])
 
 
+class ProductOut(Product):
+    price: MoneyValue
+    quantity: QuantityValue
+
+
 class Payment(BaseModel, extra='forbid'):
     type: CheckTypeChoices
-    amount: Annotated[Decimal, Field(ge=0.00, decimal_places=2)]
+    amount: Money
 
     def __format__(self, format_spec: str) -> str:
         width = int(format_spec) if format_spec else 40
         right = lambda label, val: f'{label}{val.rjust(width - len(label))}'
-        return right(CheckTypeUkrMap[self.type].capitalize(), f'{self.amount:,.2f}')
+        return right(CheckTypeUkrMap[self.type].capitalize(), format_fixed(self.amount, 2, grouping=True))
+
+
+class PaymentOut(Payment):
+    amount: MoneyValue
 
 
 class CheckBase(BaseModel):
@@ -93,34 +151,44 @@ class CheckBase(BaseModel):
 
 class CheckIn(CheckBase, extra='forbid'):
     @computed_field
-    @property
-    def total(self) -> Decimal:
-        total = sum(product.total for product in self.products)
-        return quantize_money(total) if total else Decimal('0.00')
+    @cached_property
+    def total(self) -> MoneyValue:
+        return round_money(sum(product.total for product in self.products))
 
     @computed_field
-    @property
-    def rest(self) -> Decimal:
-        return quantize_money(self.payment.amount - self.total)
+    @cached_property
+    def rest(self) -> MoneyValue:
+        return round_money(self.payment.amount - self.total)
+
+
+ProductList = TypeAdapter(list[Product])
+MoneyAdapter = TypeAdapter(Money)
+
+
+def make_public_url(public_id: str) -> AnyUrl:
+    return AnyUrl.build(
+        scheme=settings.host_url.scheme,
+        host=settings.host_url.host,  # type: ignore
+        port=settings.host_port,
+        path=f'checks/{public_id}/view'
+    )
 
 
 class CheckOut(CheckBase, from_attributes=True):
+    products: Annotated[list[ProductOut], Field(min_length=1)]
+    payment: PaymentOut
     public_id: Annotated[str, Field(serialization_alias='id')]
     created_at: Annotated[datetime, WrapSerializer(wrap_datetime, return_type=str, when_used='json')]
-    total: Annotated[Decimal, Field(ge=0.00, decimal_places=2)]
-    rest: Annotated[Decimal, Field(ge=0.00, decimal_places=2)]
+    total: MoneyValue
+    rest: MoneyValue
 
     @computed_field
     @property
     def public_url(self) -> AnyUrl:
-        return AnyUrl.build(
-            scheme=settings.host_url.scheme,
-            host=settings.host_url.host,  # type: ignore
-            port=settings.host_port,
-            path=f'checks/{self.public_id}/view'
-        )
+        return make_public_url(self.public_id)
 
     def __format__(self, format_spec: str) -> str:
+        with span('CheckOut.__format__'):
             width = int(format_spec) if format_spec else 40
             bold_delim = '=' * width
             delim = '-' * width
@@ -134,9 +202,9 @@ class CheckOut(CheckBase, from_attributes=True):
                     for product in self.products
                 ),
                 bold_delim,
-                right('СУМА', f'{self.total:,.2f}'),
+                right('СУМА', format_fixed(self.total, 2, grouping=True)),
                 f'{self.payment:{format_spec}}',
-                right('Решта', f'{self.rest:,.2f}'),
+                right('Решта', format_fixed(self.rest, 2, grouping=True)),
                 bold_delim,
                 center(self.created_at.strftime('%d.%m.%Y %H:%M')),
                 center(THANK_YOU_MSG),
@@ -144,6 +212,48 @@ class CheckOut(CheckBase, from_attributes=True):
             return '\n'.join(lines)
 
 
+@cache
+def public_url_parts() -> tuple[str, str]:
+    prefix, _, suffix = str(make_public_url('PUBLICID')).partition('PUBLICID')
+    return prefix, suffix
+
+
+def dump_check_row(check: Any) -> dict[str, Any]:
+    """What `CheckOut.model_dump(mode='json', by_alias=True)` gives for a `models.CheckRow`, without building one."""
+    url_prefix, url_suffix = public_url_parts()
+    return {
+        'products': [
+            {
+                'name': product.name,
+                'price': dump_money(product.price),
+                'quantity': dump_quantity(product.quantity),
+                'total': dump_money(line_total(product.price, product.quantity)),
+            }
+            for product in check.products
+        ],
+        'payment': {'type': check.payment_type, 'amount': dump_money(check.payment_amount)},
+        'id': check.public_id,
+        'created_at': f'{check.created_at.isoformat()}Z',
+        'total': dump_money(check.total),
+        'rest': dump_money(check.rest),
+        'public_url': f'{url_prefix}{check.public_id}{url_suffix}',
+    }
+
+
+class CheckSummary(BaseModel):
+    public_id: Annotated[str, Field(serialization_alias='id')]
+    created_at: Annotated[datetime, WrapSerializer(wrap_datetime, return_type=str, when_used='json')]
+    total: MoneyValue
+    rest: MoneyValue
+    payment: PaymentOut
+    products_count: int
+
+    @computed_field
+    @property
+    def public_url(self) -> AnyUrl:
+        return make_public_url(self.public_id)
+
+
 @dataclass
 class CheckListFilters:
     payment_type: Annotated[CheckTypeChoices | None, Query()] = None
@@ -161,6 +271,7 @@ class CheckListFilters:
     ] = None
     total_start: Annotated[Decimal | None, Query(ge=0.00, decimal_places=2)] = None
     total_end: Annotated[Decimal | None, Query(ge=0.00, decimal_places=2)] = None
+    product: Annotated[TrimmedStr | None, Query(min_length=3, max_length=255)] = None
 
     @model_validator(mode='after')
     def validate_ranges(self) -> Self:
@@ -188,12 +299,29 @@ class CheckListFilters:
             errors.append(self.make_error(('query', field_name), msg))
 
 
+def split_fields(value: Any) -> Any:
+    if isinstance(value, str):
+        value = [value]
+    if isinstance(value, list):
+        return [field.strip() for item in value for field in str(item).split(',') if field.strip()]
+    return value
+
+
 @dataclass
 class CheckListParams:
     filters: CheckListFilters = Depends()
     order: Annotated[OrderChoices, Query()] = '-created_at'
     page: Annotated[int, Query(ge=1)] = 1
     page_size: Annotated[int, Query(ge=1, le=100)] = 25
+    fields: Annotated[list[CheckField] | None, BeforeValidator(split_fields), Query(min_length=1)] = None
+    include_products: Annotated[bool, Query()] = True
+
+    @property
+    def check_fields(self) -> tuple[CheckField, ...]:
+        fields = set(self.fields or CHECK_FIELDS)
+        if not self.include_products:
+            fields.discard('products')
+        return tuple(field for field in CHECK_FIELDS if field in fields)
 
 
 class PageSchema(BaseModel):
@@ -217,3 +345,56 @@ class PageSchema(BaseModel):
     @property
     def has_prev(self) -> bool:
         return self.page > 1
+
+
+class CheckListItem(BaseModel):
+    """A `CheckOut` cut down to the fields asked for; dump it with `exclude_unset` to leave out the rest."""
+
+    public_id: Annotated[str | None, Field(serialization_alias='id')] = None
+    created_at: Annotated[
+        datetime | None, WrapSerializer(wrap_datetime, return_type=str, when_used='json-unless-none')
+    ] = None
+    total: MoneyValue | None = None
+    rest: MoneyValue | None = None
+    payment: PaymentOut | None = None
+    products: list[ProductOut] | None = None
+    public_url: AnyUrl | None = None
+
+    @classmethod
+    def from_check(cls, check: Any, fields: Iterable[CheckField]) -> Self:
+        values: dict[str, Any] = {}
+        for field in fields:
+            if field == 'id':
+                values['public_id'] = check.public_id
+            elif field == 'public_url':
+                values['public_url'] = make_public_url(check.public_id)
+            else:
+                values[field] = getattr(check, field)
+        return cls.model_validate(values)
+
+
+class SparsePageSchema(PageSchema):
+    items: list[CheckListItem]  # type: ignore[assignment]
+
+
+class DumpedPageSchema(PageSchema):
+    """A page of items dumped already, e.g. by `dump_check_row`; build it with `model_construct`."""
+
+    items: list[dict[str, Any]]  # type: ignore[assignment]
+
+
+class CheckLookupIn(BaseModel, extra='forbid'):
+    ids: Annotated[
+        list[Annotated[str, StringConstraints(min_length=1, max_length=25)]],
+        Field(min_length=1, max_length=settings.check_lookup_max_ids)
+    ]
+
+
+class CheckLookupOut(BaseModel):
+    items: list[CheckOut]
+    missing: list[str]
+
+
+class CheckChanges(BaseModel):
+    items: list[CheckListItem]
+    cursor: str
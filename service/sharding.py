@@ -0,0 +1,276 @@
+"""Spreads checks over several databases by user.
+
+Users are hashed into `SHARD_BUCKETS` buckets and the `shard_map` table of
+the main database assigns buckets to shards: 0 is the main database, 1.. are
+the `DATABASE_SHARDS`. Unassigned buckets stay on the main database, which
+also keeps users, tokens and the map itself. Check ids start with their
+user's bucket, so a check can be found by id alone; ids minted before that
+are looked for on every shard.
+
+    python -m service.sharding status
+    python -m service.sharding move --buckets 0-511 --to 1
+
+A move flags the buckets, so that writes to them fail with 503, waits for
+every process to reload the map, copies the checks of the buckets' users to
+the target shard, switches the buckets over and then deletes the old rows.
+An interrupted move can simply be run again. Moves need CACHE_URL, so that
+the API workers' list totals and ETags change with them.
+"""
+import argparse
+import asyncio
+import time
+
+from typing import Sequence
+
+from baseconv import base62
+from sqlalchemy import Row, delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from service.cache import list_counts_cache, require_shared_cache
+from service.config import get_session_factory, get_shard_engine, get_shard_session_factory, get_shards, settings
+from service.errors import ShardMovingError
+from service.singleflight import SingleFlight
+
+
+def bucket_of_user(user_id: int) -> int:
+    return user_id % settings.shard_buckets
+
+
+def bucket_of_check(public_id: str) -> int | None:
+    if len(public_id) != 25:
+        return None
+    try:
+        bucket = int(base62.decode(public_id[3:5]))
+    except ValueError:
+        return None
+    return bucket if bucket < settings.shard_buckets else None
+
+
+class ShardMap:
+    """The bucket assignment of the main database, reloaded every `SHARD_MAP_REFRESH_SECONDS`."""
+
+    def __init__(self):
+        self._shards: dict[int, int] = {}
+        self._moving: frozenset[int] = frozenset()
+        self._loaded_at: float | None = None
+        self._flight = SingleFlight('shard_map')
+
+    async def _load(self) -> None:
+        async with get_session_factory()() as session:
+            buckets = await models.ShardBucket.get_all(session)
+        self._shards = {bucket.bucket: bucket.shard for bucket in buckets}
+        self._moving = frozenset(bucket.bucket for bucket in buckets if bucket.moving)
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self, force: bool = False) -> None:
+        if not force and self._loaded_at is not None \
+                and time.monotonic() - self._loaded_at < settings.shard_map_refresh_seconds:
+            return
+        await self._flight.do('load', self._load)
+
+    async def shard_for_user(self, user_id: int, write: bool = False) -> int:
+        if not settings.database_shards:
+            return 0
+        await self.refresh()
+        bucket = bucket_of_user(user_id)
+        if write and bucket in self._moving:
+            raise ShardMovingError()
+        return self._shards.get(bucket, 0)
+
+    async def shards_for_check(self, public_id: str) -> list[int]:
+        """The shard the check id points at, followed by the others."""
+        if not settings.database_shards:
+            return [0]
+        await self.refresh()
+        bucket = bucket_of_check(public_id)
+        first = self._shards.get(bucket, 0) if bucket is not None else 0
+        return [first, *(shard for shard in get_shards() if shard != first)]
+
+
+shard_map = ShardMap()
+
+
+async def mirror_users(session: AsyncSession, users: Sequence[Row | models.User]) -> None:
+    # Checks reference their user, so a shard keeps a copy of the users whose
+    # checks it holds. Only the main database's copy is used for logging in.
+    if users:
+        await session.execute(pg_insert(models.User).values([
+            {
+                'id': user.id,
+                'username': user.username,
+                'full_name': user.full_name,
+                'password_hash': '',
+                'created_at': user.created_at
+            }
+            for user in users
+        ]).on_conflict_do_nothing())
+
+
+async def mirror_user(user: models.User) -> None:
+    shard = await shard_map.shard_for_user(user.id)
+    if shard:
+        async with get_shard_session_factory(shard)() as session:
+            await mirror_users(session, [user])
+            await session.commit()
+
+
+async def delete_user_checks(session: AsyncSession, user_ids: Sequence[int]) -> None:
+    checks, products, archived = models.Check.__table__, models.CheckProduct.__table__, models.ArchivedCheck.__table__
+    await session.execute(delete(products).where(
+        products.c.check_id.in_(select(checks.c.id).where(checks.c.user_id.in_(user_ids)))
+    ))
+    await session.execute(delete(checks).where(checks.c.user_id.in_(user_ids)))
+    await session.execute(delete(archived).where(archived.c.user_id.in_(user_ids)))
+
+
+def without_id(row: Row) -> dict:
+    return {key: value for key, value in row._asdict().items() if key != 'id'}
+
+
+async def copy_user_checks(user_id: int, source: int, target: int, batch_size: int) -> int:
+    checks, products, archived = models.Check.__table__, models.CheckProduct.__table__, models.ArchivedCheck.__table__
+    names = models.Product.__table__
+    copied, last_id = 0, 0
+    while True:
+        async with get_shard_session_factory(source)() as session:
+            batch = (await session.execute(
+                select(checks).where(checks.c.user_id == user_id, checks.c.id > last_id)
+                .order_by(checks.c.id).limit(batch_size)
+            )).all()
+            if not batch:
+                break
+            batch_products = (await session.execute(
+                select(products.c.check_id, names.c.name, products.c.price, products.c.quantity)
+                .join_from(products, names, products.c.product_id == names.c.id)
+                .where(products.c.check_id.in_([check.id for check in batch]))
+                .order_by(products.c.id)
+            )).all()
+
+        # Ids come from each shard's own sequences, so rows get new ones, and
+        # products are looked up by name in the target's own dictionary.
+        async with get_shard_session_factory(target)() as session:
+            await models.skip_check_feed(session)  # copies, not new checks
+            new_ids = (await session.scalars(
+                insert(checks).returning(checks.c.id, sort_by_parameter_order=True),
+                [without_id(check) for check in batch]
+            )).all()
+            check_ids = {check.id: new_id for check, new_id in zip(batch, new_ids)}
+            if batch_products:
+                product_ids = await models.Product.get_ids(session, (product.name for product in batch_products))
+                await session.execute(insert(products), [
+                    {
+                        'check_id': check_ids[product.check_id],
+                        'product_id': product_ids[product.name],
+                        'price': product.price,
+                        'quantity': product.quantity
+                    }
+                    for product in batch_products
+                ])
+            await session.commit()
+        copied += len(batch)
+        last_id = batch[-1].id
+
+    async with get_shard_session_factory(source)() as session:
+        archived_rows = (await session.execute(select(archived).where(archived.c.user_id == user_id))).all()
+    if archived_rows:
+        async with get_shard_session_factory(target)() as session:
+            ids = (await session.scalars(
+                select(func.nextval(func.pg_get_serial_sequence(checks.name, 'id')))
+                .select_from(func.generate_series(1, len(archived_rows)))
+            )).all()
+            await session.execute(insert(archived), [
+                {**row._asdict(), 'id': new_id} for row, new_id in zip(archived_rows, ids)
+            ])
+            await session.commit()
+    return copied + len(archived_rows)
+
+
+async def move_buckets(buckets: Sequence[int], target: int, batch_size: int, grace_seconds: float) -> int:
+    require_shared_cache('Moving buckets')
+    async with get_session_factory()() as session:
+        sources = await models.ShardBucket.mark_moving(session, buckets)
+        await session.commit()
+    await asyncio.sleep(grace_seconds)
+
+    moving = [bucket for bucket in buckets if sources[bucket] != target]
+    async with get_session_factory()() as session:
+        users = (await session.execute(
+            select(models.User.__table__)
+            .where((models.User.id % settings.shard_buckets).in_(moving))
+            .order_by(models.User.id)
+        )).all()
+
+    moved = 0
+    if users:
+        async with get_shard_session_factory(target)() as session:
+            await mirror_users(session, users)
+            await delete_user_checks(session, [user.id for user in users])  # left over by an interrupted move
+            await session.commit()
+        for user in users:
+            moved += await copy_user_checks(user.id, sources[bucket_of_user(user.id)], target, batch_size)
+
+    async with get_session_factory()() as session:
+        await models.ShardBucket.assign(session, buckets, shard=target, moving=False)
+        await session.commit()
+    # Requests that read the old map may still be reading the old rows.
+    await asyncio.sleep(grace_seconds)
+
+    for source in {sources[bucket] for bucket in moving}:
+        user_ids = [user.id for user in users if sources[bucket_of_user(user.id)] == source]
+        if user_ids:
+            async with get_shard_session_factory(source)() as session:
+                await delete_user_checks(session, user_ids)
+                await session.commit()
+    for user in users:
+        await list_counts_cache.invalidate(scope=user.id)
+    return moved
+
+
+def parse_buckets(value: str) -> list[int]:
+    buckets = []
+    for part in value.split(','):
+        start, _, end = part.partition('-')
+        buckets.extend(range(int(start), int(end or start) + 1))
+    if not all(0 <= bucket < settings.shard_buckets for bucket in buckets):
+        raise argparse.ArgumentTypeError(f'buckets are 0 to {settings.shard_buckets - 1}')
+    return buckets
+
+
+async def print_status() -> None:
+    async with get_session_factory()() as session:
+        buckets = await models.ShardBucket.get_all(session)
+    assigned = {bucket.bucket: bucket for bucket in buckets}
+    for shard in get_shards():
+        on_shard = [b for b in range(settings.shard_buckets) if getattr(assigned.get(b), 'shard', 0) == shard]
+        moving = sum(1 for b in on_shard if b in assigned and assigned[b].moving)
+        print(f'shard {shard} ({get_shard_engine(shard).url.render_as_string()}): '
+              f'{len(on_shard)} buckets' + (f', {moving} moving' if moving else ''))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status')
+    move = commands.add_parser('move')
+    move.add_argument('--buckets', type=parse_buckets, required=True, help='e.g. 0-511 or 3,7,9-12')
+    move.add_argument('--to', type=int, choices=list(get_shards()), required=True)
+    move.add_argument('--batch-size', type=int, default=1000)
+    move.add_argument(
+        '--grace-seconds', type=float, default=settings.shard_map_refresh_seconds + 5,
+        help='time for every process to reload the shard map'
+    )
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        await print_status()
+    else:
+        moved = await move_buckets(args.buckets, args.to, batch_size=args.batch_size, grace_seconds=args.grace_seconds)
+        print(f'Moved {len(args.buckets)} buckets with {moved} checks to shard {args.to}')
+    for shard in get_shards():
+        await get_shard_engine(shard).dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from service.metrics import singleflight_calls, singleflight_coalesced
+
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        singleflight_calls.labels(self.name).inc()
+        while (future := self._calls.get(key)) is not None:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The leader was cancelled (e.g. its client went away), so the
+                # followers retry instead of failing with it.
+                if not future.cancelled():
+                    raise
+                continue
+            singleflight_coalesced.labels(self.name).inc()
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._consume_exception)
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+    @staticmethod
+    def _consume_exception(future: asyncio.Future) -> Any:
+        if not future.cancelled():
+            future.exception()
+
+
+users_flight = SingleFlight('users')
+checks_flight = SingleFlight('checks')
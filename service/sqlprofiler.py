@@ -0,0 +1,92 @@
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, ExecutionContext
+
+from service.config import settings
+from service.logger import logger
+from service.metrics import db_statement_duration
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    duration: float = 0.0
+    slowest_duration: float = 0.0
+    slowest_statement: str | None = None
+    statements: Counter[str] = field(default_factory=Counter)
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+        if duration >= self.slowest_duration:
+            self.slowest_duration = duration
+            self.slowest_statement = statement
+
+    @property
+    def most_repeated(self) -> tuple[str, int] | None:
+        return self.statements.most_common(1)[0] if self.statements else None
+
+    def __str__(self) -> str:
+        return f'db: {self.count}q {self.duration * 1000:.1f}ms, slowest {self.slowest_duration * 1000:.1f}ms'
+
+
+# Every collector active in the current context gets each statement, so a
+# test's budget and the request's own stats can be counted at the same time.
+ctx_query_stats: ContextVar[tuple[QueryStats, ...]] = ContextVar('query_stats', default=())
+
+
+@contextmanager
+def collect_queries() -> Iterator[QueryStats]:
+    stats = QueryStats()
+    token = ctx_query_stats.set((*ctx_query_stats.get(), stats))
+    try:
+        yield stats
+    finally:
+        ctx_query_stats.reset(token)
+
+
+@contextmanager
+def query_budget(max_queries: int) -> Iterator[QueryStats]:
+    """Fails when the block runs more than `max_queries` statements; meant for tests."""
+    with collect_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        statements = '\n'.join(f'{n} x {one_line(statement)}' for statement, n in stats.statements.most_common())
+        raise AssertionError(f'Expected at most {max_queries} queries, {stats.count} were run:\n{statements}')
+
+
+def one_line(statement: str) -> str:
+    return ' '.join(statement.split())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(
+        conn: Connection, cursor: Any, statement: str, parameters: Any,
+        context: ExecutionContext | None, executemany: bool
+) -> None:
+    if context is not None:
+        context.query_started = time.perf_counter()  # type: ignore[attr-defined]
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement(
+        conn: Connection, cursor: Any, statement: str, parameters: Any,
+        context: ExecutionContext | None, executemany: bool
+) -> None:
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    db_statement_duration.observe(duration)
+    for stats in ctx_query_stats.get():
+        stats.record(statement, duration)
+    if settings.sql_slow_query_ms is not None and duration * 1000 >= settings.sql_slow_query_ms:
+        logger.warning('Slow query (%.1f ms): %s', duration * 1000, one_line(statement))
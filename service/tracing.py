@@ -0,0 +1,169 @@
+"""OpenTelemetry spans for requests, dependencies, SQL, validation and rendering.
+
+Tracing is off until `setup_tracing` is called (the app does it when
+TRACING_OTLP_FILE is set); until then `span` and `traced` only cost a check
+and the SDK is not imported.
+"""
+import functools
+import inspect
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Iterator, ParamSpec, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SpanExporter
+    from opentelemetry.trace import Span, Tracer
+
+
+P = ParamSpec('P')
+T = TypeVar('T')
+
+_tracer: 'Tracer | None' = None
+_provider: 'TracerProvider | None' = None
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def span(name: str, current: bool = True, **attributes: Any) -> Iterator['Span | None']:
+    """A child of the current span; `current=False` keeps it from becoming the parent of later spans."""
+    if _tracer is None:
+        yield None
+    elif current:
+        with _tracer.start_as_current_span(name, attributes=attributes) as current_span:
+            yield current_span
+    else:
+        with _tracer.start_span(name, attributes=attributes) as detached_span:
+            yield detached_span
+
+
+def traced(fn: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+    # functools.wraps keeps the signature visible to FastAPI's dependency injection
+    assert inspect.iscoroutinefunction(fn)
+
+    @functools.wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        with span(fn.__name__):
+            return await fn(*args, **kwargs)
+    return wrapper
+
+
+class TracingMiddleware:
+    """Opens the request span; added inside `LogRequestMiddleware` to link it to the request id."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or _tracer is None:
+            await self.app(scope, receive, send)
+            return
+
+        from opentelemetry.trace import StatusCode, format_trace_id
+
+        state = scope.setdefault('state', {})
+        with span(
+            f"{scope['method']} {scope['path']}",
+            **{'http.request.method': scope['method'], 'url.path': scope['path'], 'request.id': state.get('id', '')}
+        ) as request_span:
+            assert request_span is not None
+            if 'logger_bind_params' in state:
+                state['logger_bind_params']['trace_id'] = format_trace_id(request_span.get_span_context().trace_id)
+
+            async def send_with_status(message: Message) -> None:
+                if message['type'] == 'http.response.start':
+                    request_span.set_attribute('http.response.status_code', message['status'])
+                    if message['status'] >= 500:
+                        request_span.set_status(StatusCode.ERROR)
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                if route := getattr(scope.get('route'), 'path', None):
+                    request_span.update_name(f"{scope['method']} {route}")
+                    request_span.set_attribute('http.route', route)
+
+
+def _start_statement_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    if _tracer is not None and context is not None:
+        context.otel_span = _tracer.start_span(  # type: ignore[attr-defined]
+            statement.split(None, 1)[0],
+            attributes={'db.system': 'postgresql', 'db.statement': ' '.join(statement.split())}
+        )
+
+
+def _end_statement_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    if (statement_span := getattr(context, 'otel_span', None)) is not None:
+        statement_span.end()
+
+
+def _fail_statement_span(exception_context) -> None:
+    context = exception_context.execution_context
+    if (statement_span := getattr(context, 'otel_span', None)) is not None and statement_span.is_recording():
+        from opentelemetry.trace import StatusCode
+        statement_span.record_exception(exception_context.original_exception)
+        statement_span.set_status(StatusCode.ERROR)
+        statement_span.end()
+
+
+_STATEMENT_LISTENERS = [
+    ('before_cursor_execute', _start_statement_span),
+    ('after_cursor_execute', _end_statement_span),
+    ('handle_error', _fail_statement_span),
+]
+
+
+def _instrument_validation() -> None:
+    # Request bodies are validated in request_body_to_args and responses in
+    # serialize_response; both are looked up as module globals by FastAPI.
+    import fastapi.dependencies.utils
+    import fastapi.routing
+
+    def wrap(module: Any, name: str, span_name: str) -> None:
+        original = getattr(module, name)
+        if getattr(original, '__traced__', False):
+            return
+
+        @functools.wraps(original)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(span_name):
+                return await original(*args, **kwargs)
+        wrapper.__traced__ = True  # type: ignore[attr-defined]
+        setattr(module, name, wrapper)
+
+    wrap(fastapi.dependencies.utils, 'request_body_to_args', 'validate request body')
+    wrap(fastapi.routing, 'serialize_response', 'serialize response')
+
+
+def setup_tracing(exporter: 'SpanExporter', batch: bool = True) -> 'TracerProvider':
+    global _tracer, _provider
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+
+    shutdown_tracing()
+    _provider = TracerProvider(resource=Resource.create({'service.name': 'checkbox-service'}))
+    _provider.add_span_processor(BatchSpanProcessor(exporter) if batch else SimpleSpanProcessor(exporter))
+    _tracer = _provider.get_tracer('service')
+    for identifier, listener in _STATEMENT_LISTENERS:
+        event.listen(Engine, identifier, listener)
+    _instrument_validation()
+    return _provider
+
+
+def shutdown_tracing() -> None:
+    global _tracer, _provider
+    if _provider is None:
+        return
+    for identifier, listener in _STATEMENT_LISTENERS:
+        event.remove(Engine, identifier, listener)
+    _provider.shutdown()
+    _tracer = _provider = None
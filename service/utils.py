@@ -1,8 +1,12 @@
+import re
 import uuid
+import hashlib
+import jwt
 
 from typing import Any
 from dataclasses import is_dataclass
 from baseconv import base62
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_HALF_UP
 
 from fastapi import HTTPException, Request, Response
@@ -14,10 +18,15 @@ from sqlalchemy.sql import expression
 from sqlalchemy.types import DateTime
 from sqlalchemy.ext.compiler import compiles
 from pydantic import SerializerFunctionWrapHandler, BaseModel
+from pydantic_core import PydanticCustomError
 from pwdlib import PasswordHash
 from pwdlib.hashers.argon2 import Argon2Hasher
 
+from service.config import settings
 from service.logger import ctx_request, logger
+from service.metrics import request_db_duration, request_db_statements
+from service.sqlprofiler import collect_queries, one_line
+from service.tracing import span
 
 
 password_hasher = PasswordHash(hashers=[Argon2Hasher()])
@@ -31,10 +40,95 @@ def verify_password(password, password_hash) -> bool:
     return password_hasher.verify(password, password_hash)
 
 
+def hash_token(token: str) -> str:
+    # Refresh tokens are random and long, so a fast unsalted hash is enough.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_access_token(username: str) -> str:
+    payload = {
+        'sub': f'username:{username}',
+        'exp': datetime.now(timezone.utc) + timedelta(minutes=settings.access_token_expire_minutes)
+    }
+    return jwt.encode(payload, settings.auth_secret_key, settings.jwt_algorithm)
+
+
+def utcnow() -> datetime:
+    """Naive UTC, like the timestamps the database stores."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def quantize_money(value: Decimal) -> Decimal:
     return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
 
+FIXED_POINT_RE = re.compile(r'\s*([+-]?)(\d*)(?:\.(\d*))?\s*')
+
+
+def to_minor_units(value: Decimal | int | float | str, scale: int) -> int:
+    """Converts an amount to a whole number of 10**-scale units, rejecting finer amounts."""
+    if isinstance(value, bool):
+        raise PydanticCustomError(
+            'decimal_type', 'Decimal input should be an integer, float, string or Decimal object'
+        )
+    if isinstance(value, int):
+        return value * 10 ** scale
+    if isinstance(value, float):
+        value = repr(value)
+    if isinstance(value, str) and (match := FIXED_POINT_RE.fullmatch(value)) and any(match.groups()[1:]):
+        sign, whole, fraction = match.groups()
+        fraction = (fraction or '').rstrip('0')
+        if len(fraction) > scale:
+            raise PydanticCustomError(
+                'decimal_max_places',
+                'Decimal input should have no more than {decimal_places} decimal places',
+                {'decimal_places': scale}
+            )
+        units = int(whole or '0') * 10 ** scale + int(fraction.ljust(scale, '0') or '0')
+        return -units if sign == '-' else units
+
+    try:
+        value = Decimal(value)
+    except (ArithmeticError, TypeError, ValueError):
+        raise PydanticCustomError('decimal_parsing', 'Input should be a valid decimal')
+    if not value.is_finite():
+        raise PydanticCustomError('finite_number', 'Input should be a finite number')
+    if -value.normalize().as_tuple().exponent > scale:  # type: ignore
+        raise PydanticCustomError(
+            'decimal_max_places',
+            'Decimal input should have no more than {decimal_places} decimal places',
+            {'decimal_places': scale}
+        )
+    return int(value.scaleb(scale))
+
+
+def from_minor_units(value: int, scale: int) -> Decimal:
+    return Decimal(value).scaleb(-scale)
+
+
+def format_minor_units(value: int, scale: int) -> str:
+    whole, fraction = divmod(abs(value), 10 ** scale)
+    return f'{"-" if value < 0 else ""}{whole}.{fraction:0{scale}d}'
+
+
+def round_money(value: Decimal | int) -> Decimal | int:
+    # Integer amounts are kopecks already; only Decimal ones can carry fractions of them.
+    return value if isinstance(value, int) else quantize_money(value)
+
+
+def line_total(price: Decimal | int, quantity: Decimal | int) -> Decimal | int:
+    if isinstance(price, int):
+        # Kopecks times thousandths, rounded half up to kopecks (both are non-negative).
+        return (price * quantity + 500) // 1000
+    return quantize_money(price * quantity)
+
+
+def format_fixed(value: Decimal | int, scale: int, grouping: bool = False) -> str:
+    if isinstance(value, int):
+        value = from_minor_units(value, scale)
+    return f'{value:,.{scale}f}' if grouping else f'{value:.{scale}f}'
+
+
 def generate_base62uuid() -> str:
     uuid4_as_hex = str(uuid.uuid4()).replace('-', '')
     uuid4_as_int = int(uuid4_as_hex, 16)
@@ -42,8 +136,39 @@ def generate_base62uuid() -> str:
     return base62_str.rjust(22, '0')
 
 
-def generate_check_id() -> str:
-    return f'ch_{generate_base62uuid()}'
+def generate_check_id(user_id: int) -> str:
+    # The first two characters are the user's shard bucket (see service.sharding),
+    # the rest is still random enough to be unguessable.
+    bucket = base62.encode(user_id % settings.shard_buckets).rjust(2, '0')
+    return f'ch_{bucket}{generate_base62uuid()[2:]}'
+
+
+def escape_like(value: str, escape_char: str = '\\') -> str:
+    return (
+        value.replace(escape_char, escape_char * 2)
+        .replace('%', f'{escape_char}%')
+        .replace('_', f'{escape_char}_')
+    )
+
+
+def make_digest(*parts: Any) -> str:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def make_weak_etag(*parts: Any) -> str:
+    return f'W/"{make_digest(*parts)}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    return any(
+        candidate.strip().removeprefix('W/') == opaque_tag
+        for candidate in if_none_match.split(',')
+    )
 
 
 def wrap_datetime(v: Any, nxt: SerializerFunctionWrapHandler) -> str:
@@ -66,7 +191,15 @@ class LogRequestMiddleware(BaseHTTPMiddleware):
         request.state.id = request_id
         request.state.logger_bind_params = {}
         ctx_request.set(request)
-        response = await call_next(request)
+        with collect_queries() as query_stats:
+            request.state.query_stats = query_stats
+            response = await call_next(request)
+
+        route = getattr(request.scope.get('route'), 'path', 'unmatched')
+        request_db_statements.labels(route).observe(query_stats.count)
+        request_db_duration.labels(route).observe(query_stats.duration)
+        if (repeated := query_stats.most_repeated) and repeated[1] >= settings.sql_repeated_statement_threshold:
+            logger.warning('Statement ran %d times in one request, likely N+1: %s', repeated[1], one_line(repeated[0]))
         return response
 
 
@@ -94,6 +227,7 @@ async def request_response_logger(
             request.state.logger_bind_params.update(log_values)
             logger.info('New Request Received')
 
-        return await original_run_endpoint_function(
-            dependant=dependant, values=values, is_coroutine=is_coroutine
-        )
+        with span(f'endpoint {getattr(dependant.call, "__name__", "")}'):
+            return await original_run_endpoint_function(
+                dependant=dependant, values=values, is_coroutine=is_coroutine
+            )
@@ -16,19 +16,38 @@ from tests.consts import ENV_VARS, VIEW_URL
 fake = Faker()
 postgresql_proc = factories.postgresql_proc(port=ENV_VARS['DATABASE_PORT'], dbname=ENV_VARS['DATABASE_NAME'])
 postgresql = factories.postgresql('postgresql_proc', ENV_VARS['DATABASE_NAME'])
+postgresql_shard = factories.postgresql('postgresql_proc', f"{ENV_VARS['DATABASE_NAME']}_shard")
 
 
 with patch.dict(os.environ, ENV_VARS):
-    from service.config import db_engine, async_session_factory
-    from service.main import app
-    from service.models import Base, User, Check, CheckProduct
+    from service.config import db_engine, async_session_factory, get_shard_engine, settings
+    from service.main import create_app
+    from service.models import Base, User, Check, CheckProduct, Product, product_ids
     from service.utils import get_password_hash
+    from service.cache import LocalCacheBackend, set_cache_backend
+    from service.recent_checks import recent_checks as worker_recent_checks
+    from service.sqlprofiler import query_budget as sql_query_budget
 
 
 @pytest.fixture
 async def init_db(postgresql):
     async with db_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    yield
+    await db_engine.dispose()
+
+
+@pytest.fixture
+async def shard(init_db, postgresql_shard, monkeypatch):
+    url = f"postgresql://{ENV_VARS['DATABASE_USER']}@{ENV_VARS['DATABASE_HOST']}:{ENV_VARS['DATABASE_PORT']}/" \
+          f"{ENV_VARS['DATABASE_NAME']}_shard"
+    monkeypatch.setattr(settings, 'database_shards', [url])
+    monkeypatch.setattr(settings, 'shard_map_refresh_seconds', 0)
+    engine = get_shard_engine(1)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield 1
+    await engine.dispose()
 
 
 @pytest.fixture
@@ -37,6 +56,32 @@ async def db_session(init_db):
         yield session
 
 
+@pytest.fixture(autouse=True)
+def cache_backend():
+    backend = LocalCacheBackend()
+    set_cache_backend(backend)
+    yield backend
+    set_cache_backend(None)
+
+
+@pytest.fixture(autouse=True)
+def product_id_cache():
+    # Every test gets a new database, with new product ids.
+    yield product_ids
+    product_ids.clear()
+
+
+@pytest.fixture(autouse=True)
+def recent_checks():
+    yield worker_recent_checks
+    worker_recent_checks.clear()
+
+
+@pytest.fixture
+def query_budget():
+    return sql_query_budget
+
+
 @pytest.fixture(autouse=True)
 def anyio_backend():
     return 'asyncio'
@@ -45,7 +90,7 @@ def anyio_backend():
 @pytest.fixture
 async def client():
     async with AsyncClient(
-            transport=ASGITransport(app=app), base_url="http://"
+            transport=ASGITransport(app=create_app()), base_url="http://"
     ) as ac:
         yield ac
 
@@ -126,10 +171,11 @@ async def add_check_to_db(db_session, user, check_data):
     )
     db_session.add(check)
     await db_session.flush()
+    ids = await Product.get_ids(db_session, (product['name'] for product in check_data['products']))
     products = (
         CheckProduct(
             check_id=check.id,
-            name=product['name'],
+            product_id=ids[product['name']],
             price=product['price'],
             quantity=product['quantity']
         )
@@ -1,9 +1,36 @@
+import asyncio
+import asyncpg
+import datetime
+import json
+import logging
 import pytest
+import time
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
 from decimal import Decimal
 from fastapi.encoders import jsonable_encoder
+from httpx import ASGITransport, AsyncClient
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from prometheus_client import REGISTRY
+from sqlalchemy import func, select, text, update
+from sqlalchemy.exc import IntegrityError
 
-from tests.consts import VIEW_URL, STANDART_CHECK, CHECK_20_WIDTH, CHECK_80_WIDTH
-from tests.conftest import fake
+from benchmarks.db_proxy import DbProxy, Faults
+from benchmarks.seed import Distribution, seed
+from service import feed, jobs, migrations, models, schemas, sharding
+from service.archive import archive_checks
+from service.batching import CheckWriteCoalescer
+from service.cache import list_counts_cache, receipts_cache
+from service.config import get_db_engine, get_db_url, get_session_factory, get_shard_session_factory, settings
+from service.deadlines import CancelOnDisconnectMiddleware
+from service.main import create_app
+from service.models import Check, CheckFeedEntry, CheckProduct, Job, Product, RefreshToken, ShardBucket, User
+from service.otlp_file import OTLPFileSpanExporter
+from service.profiling import ProfilingMiddleware, make_profile_token
+from service.tracing import setup_tracing, shutdown_tracing, span
+from service.utils import line_total, password_hasher, round_money
+from tests.consts import ENV_VARS, VIEW_URL, STANDART_CHECK, CHECK_20_WIDTH, CHECK_80_WIDTH
+from tests.conftest import add_check_to_db, fake
 
 
 class TestUserRegistration:
@@ -48,6 +75,54 @@ class TestUserLogin:
         assert response.json()['detail'] == 'Incorrect username or password'
 
 
+class TestRefreshToken:
+    @pytest.fixture
+    async def refresh_token(self, client, user_data, user):
+        login_data = {'username': user_data['username'], 'password': user_data['password']}
+        response = await client.post('/users/login', data=login_data)
+        return response.json()['refresh_token']
+
+    async def refresh(self, client, refresh_token):
+        return await client.post('/users/token/refresh', json={'refresh_token': refresh_token})
+
+    async def test_refresh_rotates_without_password_hashing(self, client, refresh_token, monkeypatch):
+        def fail(*args, **kwargs):
+            raise AssertionError('password hashing must not be used')
+        monkeypatch.setattr(password_hasher, 'verify', fail)
+
+        response = await self.refresh(client, refresh_token)
+        assert response.status_code == 200
+        resp_data = response.json()
+        assert resp_data['refresh_token'] != refresh_token
+        response = await client.get('/checks/', headers={'Authorization': f"Bearer {resp_data['access_token']}"})
+        assert response.status_code == 200
+
+        response = await self.refresh(client, resp_data['refresh_token'])
+        assert response.status_code == 200
+
+    async def test_reuse_revokes_the_session(self, client, refresh_token):
+        rotated = (await self.refresh(client, refresh_token)).json()['refresh_token']
+
+        response = await self.refresh(client, refresh_token)
+        assert response.status_code == 401
+        assert response.json()['detail'] == 'Invalid refresh token'
+        assert (await self.refresh(client, rotated)).status_code == 401
+
+    async def test_revoke(self, client, refresh_token):
+        response = await client.post('/users/token/revoke', json={'refresh_token': refresh_token})
+        assert response.status_code == 204
+        assert (await self.refresh(client, refresh_token)).status_code == 401
+
+        response = await client.post('/users/token/revoke', json={'refresh_token': 'unknown'})
+        assert response.status_code == 204
+
+    async def test_expired_or_unknown(self, client, refresh_token, db_session):
+        await db_session.execute(update(RefreshToken).values(expires_at=datetime.datetime(2000, 1, 1)))
+        await db_session.commit()
+        assert (await self.refresh(client, refresh_token)).status_code == 401
+        assert (await self.refresh(client, 'unknown')).status_code == 401
+
+
 class TestCheckCreate:
     async def test_auth_fail(self, client, headers, check_data):
         headers['Authorization'] = f'Bearer {fake.pystr()}'
@@ -106,14 +181,133 @@ class TestCheckCreate:
             assert response.json()['detail'][0]['msg'] == "Decimal input should have no more than 3 decimal places"
 
 
+class TestLargeCheckCreate:
+    @pytest.fixture(autouse=True)
+    def small_chunks(self, monkeypatch):
+        monkeypatch.setattr(settings, 'large_check_chunk_size', 2)
+
+    @pytest.fixture
+    def large_check_data(self, check_data):
+        return {'payment': check_data['payment'], 'products': check_data['products'] * 3}
+
+    @staticmethod
+    async def in_pieces(body: bytes, size: int = 7):
+        for start in range(0, len(body), size):
+            yield body[start:start + size]
+
+    async def post(self, client, headers, payload):
+        body = json.dumps(jsonable_encoder(payload)).encode()
+        return await client.post(
+            '/checks/large', content=self.in_pieces(body),
+            headers={**headers, 'Content-Type': 'application/json'}
+        )
+
+    async def test_create_large_check(self, client, headers, large_check_data):
+        large_check_data['payment']['amount'] = Decimal('200.00')
+        response = await self.post(client, headers, large_check_data)
+        assert response.status_code == 201
+        resp_data = response.json()
+        assert resp_data['total'] == '158.31'
+        assert resp_data['rest'] == '41.69'
+        assert resp_data['products_count'] == 6
+        assert resp_data['public_url'] == VIEW_URL.format(check_id=resp_data['id'])
+
+        response = await client.get(f"/checks/{resp_data['id']}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()['total'] == '158.31'
+        assert [p['name'] for p in response.json()['products']] == [p['name'] for p in large_check_data['products']]
+
+    async def test_payment_after_products(self, client, headers, large_check_data):
+        large_check_data['payment']['amount'] = Decimal('158.31')
+        payload = {'products': large_check_data['products'], 'payment': large_check_data['payment']}
+        response = await self.post(client, headers, payload)
+        assert response.status_code == 201
+        assert response.json()['rest'] == '0.00'
+
+    async def test_insufficient_payment(self, client, headers, large_check_data):
+        response = await self.post(client, headers, large_check_data)
+        assert response.status_code == 400
+        assert response.json()['detail'] == 'Insufficient payment amount'
+
+        response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == 0
+
+    async def test_validation_error(self, client, headers, large_check_data, subtests):
+        with subtests.test(msg='test_error_in_later_chunk'):
+            products = [*large_check_data['products']]
+            products[4] = {**products[4], 'quantity': '1.0001'}
+            response = await self.post(client, headers, {**large_check_data, 'products': products})
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['loc'] == ['body', 'products', 4, 'quantity']
+
+        with subtests.test(msg='test_payment_missing'):
+            response = await self.post(client, headers, {'products': large_check_data['products'][:1]})
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['loc'] == ['body', 'payment']
+            assert response.json()['detail'][0]['msg'] == 'Field required'
+
+        with subtests.test(msg='test_extra_field'):
+            response = await self.post(client, headers, {**large_check_data, 'total': 1})
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['type'] == 'extra_forbidden'
+
+        with subtests.test(msg='test_products_not_found'):
+            response = await self.post(client, headers, {**large_check_data, 'products': []})
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['msg'] == 'List should have at least 1 item after validation, not 0'
+
+        with subtests.test(msg='test_invalid_json'):
+            response = await client.post('/checks/large', content=b'{"products": [', headers=headers)
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['type'] == 'json_invalid'
+
+    async def test_no_connection_is_held_while_receiving(self, client, headers, large_check_data):
+        large_check_data['payment']['amount'] = Decimal('200.00')
+        body = json.dumps(jsonable_encoder(large_check_data)).encode()
+        held_by_test = get_db_engine().pool.checkedout()
+        checked_out = []
+
+        async def watched_pieces():
+            async for piece in self.in_pieces(body):
+                checked_out.append(get_db_engine().pool.checkedout())
+                yield piece
+
+        response = await client.post(
+            '/checks/large', content=watched_pieces(), headers={**headers, 'Content-Type': 'application/json'}
+        )
+        assert response.status_code == 201
+        assert set(checked_out[2:]) == {held_by_test}
+
+    async def test_stalled_body(self, client, headers, large_check_data, monkeypatch):
+        monkeypatch.setattr(settings, 'large_check_idle_timeout_seconds', 0.05)
+        body = json.dumps(jsonable_encoder(large_check_data)).encode()
+
+        async def stalling_pieces():
+            yield body[:10]
+            await asyncio.sleep(0.5)
+            yield body[10:]
+
+        response = await client.post(
+            '/checks/large', content=stalling_pieces(), headers={**headers, 'Content-Type': 'application/json'}
+        )
+        assert response.status_code == 408
+
+        monkeypatch.setattr(settings, 'large_check_idle_timeout_seconds', 30)
+        monkeypatch.setattr(settings, 'large_check_upload_timeout_seconds', 0.2)
+        response = await client.post(
+            '/checks/large', content=stalling_pieces(), headers={**headers, 'Content-Type': 'application/json'}
+        )
+        assert response.status_code == 408
+
+
 class TestCheckRetrieve:
     async def test_retrieve_check(self, client, headers, existing_check, check_data):
         response = await client.get(f'/checks/{existing_check.public_id}', headers=headers)
         assert response.status_code == 200
         resp_data = response.json()
         assert resp_data['id'] == existing_check.public_id
-        assert resp_data['total'] == str(existing_check.total)
-        assert resp_data['rest'] == str(existing_check.rest)
+        assert resp_data['total'] == str(check_data['total'])
+        assert resp_data['rest'] == str(check_data['rest'])
         assert resp_data['public_url'] == VIEW_URL.format(check_id=resp_data['id'])
 
     async def test_auth_fail(self, client, headers, existing_check, check_data):
@@ -128,6 +322,34 @@ class TestCheckRetrieve:
         assert response.json()['detail'] == "Check with id 'non_existent_id' not found"
 
 
+class TestCheckLookup:
+    async def test_lookup(self, client, headers, checks_collection, checks_collection_data, query_budget):
+        ids = [check['id'] for check in checks_collection_data]
+        singles = [(await client.get(f'/checks/{check_id}', headers=headers)).json() for check_id in ids]
+        # statement timeout, checks, products, then archived checks for the missing one
+        with query_budget(4):
+            response = await client.post(
+                '/checks/lookup', json={'ids': [ids[2], 'ch_missing', ids[0], ids[2]]}, headers=headers
+            )
+        assert response.status_code == 200
+        assert response.json() == {'items': [singles[2], singles[0]], 'missing': ['ch_missing']}
+
+    async def test_checks_of_other_users_are_missing(self, client, headers, db_session, existing_check):
+        other = User(username=fake.user_name() + '_other', full_name=fake.name(), password_hash='-')
+        db_session.add(other)
+        await db_session.commit()
+        existing_check.user_id = other.id
+        await db_session.commit()
+
+        response = await client.post('/checks/lookup', json={'ids': [existing_check.public_id]}, headers=headers)
+        assert response.json() == {'items': [], 'missing': [existing_check.public_id]}
+
+    async def test_too_many_ids(self, client, headers):
+        ids = [f'ch_{i:022}' for i in range(settings.check_lookup_max_ids + 1)]
+        response = await client.post('/checks/lookup', json={'ids': ids}, headers=headers)
+        assert response.status_code == 422
+
+
 class TestCheckList:
     async def test_list_checks(self, client, headers, checks_collection, checks_collection_data):
         response = await client.get('/checks/', headers=headers)
@@ -136,6 +358,16 @@ class TestCheckList:
         assert len(resp_data['items']) == len(checks_collection_data)
         assert resp_data['total'] == len(checks_collection_data)
 
+    async def test_rows_match_orm(self, db_session, user, checks_collection, query_budget):
+        params = schemas.CheckListParams(filters=schemas.CheckListFilters(), page_size=100)
+        with query_budget(2):
+            rows = await Check.get_page_rows(session=db_session, user_id=user.id, params=params)
+        checks = [schemas.CheckOut.model_validate(check) for check in await Check.get_page(db_session, user.id, params)]
+        assert [schemas.dump_check_row(row) for row in rows] == [
+            check.model_dump(mode='json', by_alias=True) for check in checks
+        ]
+        assert [schemas.CheckOut.model_validate(row) for row in rows] == checks
+
     async def test_auth_fail(self, client, headers, checks_collection, checks_collection_data):
         headers['Authorization'] = f'Bearer {fake.pystr()}'
         response = await client.post('/checks/', headers=headers)
@@ -169,6 +401,24 @@ class TestCheckList:
             for item in resp_data['items']:
                 assert 100 <= Decimal(item['total']) <= 2000
 
+        with subtests.test(msg='test_product_filtering'):
+            response = await client.get('/checks/?product=APPL&payment_type=cashless', headers=headers)
+            assert response.status_code == 200
+            resp_data = response.json()
+            assert resp_data['total'] == 2
+            for item in resp_data['items']:
+                assert item['payment']['type'] == 'cashless'
+                assert any('appl' in product['name'].lower() for product in item['products'])
+
+        with subtests.test(msg='test_product_filtering_no_match'):
+            response = await client.get('/checks/?product=100%25', headers=headers)
+            assert response.status_code == 200
+            assert response.json()['total'] == 0
+
+        with subtests.test(msg='test_product_filter_too_short'):
+            response = await client.get('/checks/?product=ap', headers=headers)
+            assert response.status_code == 422
+
         with subtests.test(msg='test_range_error'):
             response = await client.get('/checks/?total_start=100&total_end=20', headers=headers)
             print(response.content)
@@ -176,6 +426,44 @@ class TestCheckList:
             resp_data = response.json()
             assert response.json()['detail'][0]['msg'] == "'total_start' should be less than or equal to the 'total_end'"
 
+    async def test_conditional_get(self, client, headers, checks_collection, check_data, subtests):
+        response = await client.get('/checks/?page_size=2', headers=headers)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert etag.startswith('W/')
+
+        with subtests.test(msg='test_not_modified'):
+            response = await client.get('/checks/?page_size=2', headers={**headers, 'If-None-Match': etag})
+            assert response.status_code == 304
+            assert response.content == b''
+            assert response.headers['ETag'] == etag
+
+        with subtests.test(msg='test_other_params'):
+            response = await client.get('/checks/?page_size=3', headers={**headers, 'If-None-Match': etag})
+            assert response.status_code == 200
+
+        with subtests.test(msg='test_new_check'):
+            payload = {'products': check_data['products'], 'payment': check_data['payment']}
+            await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+            response = await client.get('/checks/?page_size=2', headers={**headers, 'If-None-Match': etag})
+            assert response.status_code == 200
+            assert response.headers['ETag'] != etag
+
+    async def test_total_after_create(self, client, headers, checks_collection, checks_collection_data, check_data):
+        response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == len(checks_collection_data)
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == len(checks_collection_data) + 1
+
+    @pytest.mark.parametrize("encoding", ['gzip', 'br'])
+    async def test_compression(self, client, headers, checks_collection, encoding):
+        response = await client.get('/checks/', headers={**headers, 'Accept-Encoding': encoding})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == encoding
+        assert len(response.json()['items']) == 3
+
     @pytest.mark.parametrize("page", [1, 2])
     async def test_pagination(self, client, headers, checks_collection, checks_collection_data, page):
         page_size = 2
@@ -189,6 +477,43 @@ class TestCheckList:
         assert resp_data['page'] == page
         assert resp_data['page_size'] == page_size
 
+    async def test_sparse_fields(self, client, headers, checks_collection, checks_collection_data, subtests):
+        with subtests.test(msg='test_without_products'):
+            response = await client.get('/checks/?include_products=false', headers=headers)
+            assert response.status_code == 200
+            items = response.json()['items']
+            assert {item['id'] for item in items} == {item['id'] for item in checks_collection_data}
+            assert {tuple(item) for item in items} == {('id', 'created_at', 'total', 'rest', 'payment', 'public_url')}
+
+        with subtests.test(msg='test_fields'):
+            response = await client.get('/checks/?fields=id,total&fields=payment&order=total', headers=headers)
+            assert response.status_code == 200
+            resp_data = response.json()
+            assert resp_data['total'] == len(checks_collection_data)
+            expected = sorted(checks_collection_data, key=lambda x: x['total'])
+            assert resp_data['items'] == [
+                {
+                    'id': item['id'],
+                    'total': str(item['total']),
+                    'payment': {'type': item['payment']['type'], 'amount': str(item['payment']['amount'])}
+                }
+                for item in expected
+            ]
+
+        with subtests.test(msg='test_fields_with_products'):
+            response = await client.get('/checks/?fields=products', headers=headers)
+            assert response.status_code == 200
+            assert all(set(item) == {'products'} and item['products'] for item in response.json()['items'])
+
+        with subtests.test(msg='test_unknown_field'):
+            response = await client.get('/checks/?fields=id,user_id', headers=headers)
+            assert response.status_code == 422
+
+        with subtests.test(msg='test_etag_differs'):
+            full = await client.get('/checks/', headers=headers)
+            sparse = await client.get('/checks/?include_products=false', headers=headers)
+            assert full.headers['ETag'] != sparse.headers['ETag']
+
 
 class TestCheckView:
     async def test_view_check(self, client, existing_check, subtests):
@@ -216,3 +541,819 @@ class TestCheckView:
         response = await client.get('/checks/non_existent_id/view')
         assert response.status_code == 404
         assert response.json()['detail'] == "Check with id 'non_existent_id' not found"
+
+
+class TestCheckWriteCoalescing:
+    @pytest.fixture
+    def coalescer(self, init_db):
+        return CheckWriteCoalescer(window_ms=20, max_batch=10, session_factory=get_session_factory())
+
+    @pytest.fixture
+    def check_in(self, check_data):
+        return schemas.CheckIn.model_validate({'products': check_data['products'], 'payment': check_data['payment']})
+
+    async def test_concurrent_checks_share_batch(self, coalescer, user, check_in):
+        db_checks = await asyncio.gather(*(coalescer.submit(user_id=user.id, check=check_in) for _ in range(5)))
+        assert len({db_check.public_id for db_check in db_checks}) == 5
+        for db_check in db_checks:
+            assert db_check.user_id == user.id
+            assert db_check.total == check_in.total
+            assert [product.name for product in db_check.products] == [p.name for p in check_in.products]
+
+    async def test_failure_is_isolated(self, coalescer, user, check_in, monkeypatch):
+        invalidate = list_counts_cache.invalidate
+        invalidated = []
+
+        async def recording_invalidate(scope):
+            invalidated.append(scope)
+            return await invalidate(scope=scope)
+        monkeypatch.setattr(list_counts_cache, 'invalidate', recording_invalidate)
+
+        results = await asyncio.gather(
+            coalescer.submit(user_id=user.id, check=check_in),
+            coalescer.submit(user_id=user.id + 1000, check=check_in),
+            coalescer.submit(user_id=user.id, check=check_in),
+            return_exceptions=True
+        )
+        assert results[0].user_id == user.id
+        assert isinstance(results[1], IntegrityError)
+        assert results[2].user_id == user.id
+        # only the lists of users whose checks were committed changed
+        assert set(invalidated) == {user.id}
+
+    async def test_create_check_endpoint(self, client, headers, check_data, monkeypatch):
+        monkeypatch.setattr(settings, 'check_write_coalescing', True)
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        responses = await asyncio.gather(*(
+            client.post('/checks/', json=jsonable_encoder(payload), headers=headers) for _ in range(3)
+        ))
+        for response in responses:
+            assert response.status_code == 201
+            resp_data = response.json()
+            assert resp_data['total'] == str(check_data['total'])
+            assert len(resp_data['products']) == len(check_data['products'])
+
+    async def test_create_check_resolves_the_shard_once(self, client, headers, check_data, monkeypatch):
+        monkeypatch.setattr(settings, 'check_write_coalescing', True)
+        shard_for_user = sharding.shard_map.shard_for_user
+        lookups = []
+
+        async def counting_shard_for_user(user_id, write=False):
+            lookups.append(write)
+            return await shard_for_user(user_id, write=write)
+        monkeypatch.setattr(sharding.shard_map, 'shard_for_user', counting_shard_for_user)
+
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        assert response.status_code == 201
+        assert lookups == [True]
+
+
+class TestLifespan:
+    async def test_warm_up_and_dispose(self, init_db):
+        app = create_app()
+        async with app.router.lifespan_context(app):
+            assert get_db_engine().pool.checkedin() >= settings.db_pool_warmup_connections
+        assert get_db_engine().pool.checkedin() == 0
+
+
+class TestArchive:
+    @pytest.fixture
+    def shared_cache(self, monkeypatch):
+        monkeypatch.setattr(settings, 'cache_url', 'redis://shared')
+
+    async def test_archived_check_is_still_retrievable(
+            self, client, headers, db_session, cache_backend, shared_cache, checks_collection, existing_check,
+            check_data
+    ):
+        old = existing_check.created_at - datetime.timedelta(days=400)
+        await db_session.execute(update(Check).where(Check.id == existing_check.id).values(created_at=old))
+        await db_session.commit()
+
+        retrieved = (await client.get(f'/checks/{check_data["id"]}', headers=headers)).json()
+        receipt = (await client.get(f'/checks/{check_data["id"]}/view')).text
+        listed = await client.get('/checks/', headers=headers)
+        assert listed.json()['total'] == 4
+
+        archived = await archive_checks(
+            cutoff=old + datetime.timedelta(days=1), batch_size=1, session_factory=get_session_factory()
+        )
+        assert archived == 1
+
+        response = await client.get('/checks/', headers={**headers, 'If-None-Match': listed.headers['ETag']})
+        assert response.status_code == 200
+        assert response.json()['total'] == 3
+        assert check_data['id'] not in [item['id'] for item in response.json()['items']]
+
+        response = await client.get(f'/checks/{check_data["id"]}', headers=headers)
+        assert response.status_code == 200
+        assert response.json() == retrieved
+
+        cache_backend.clear()
+        assert (await client.get(f'/checks/{check_data["id"]}/view')).text == receipt
+
+    async def test_refuses_without_shared_cache(self, db_session, existing_check):
+        with pytest.raises(RuntimeError, match='needs CACHE_URL'):
+            await archive_checks(cutoff=datetime.datetime(2100, 1, 1), batch_size=10)
+        assert await db_session.scalar(select(func.count()).select_from(Check)) == 1
+
+
+class TestQueryProfiler:
+    async def test_list_checks_query_budget(
+            self, client, headers, checks_collection, query_budget, recent_checks, monkeypatch
+    ):
+        monkeypatch.setattr(settings, 'cache_url', 'redis://shared')
+        monkeypatch.setattr(recent_checks, 'size', 0)
+        # each includes the statement setting the request's statement_timeout
+        with query_budget(6):
+            response = await client.get('/checks/', headers=headers)
+        assert len(response.json()['items']) == 3
+        # the principal and the count are cached, products are loaded in one statement
+        with query_budget(4):
+            await client.get('/checks/', headers=headers)
+        # products are not loaded at all for a product-less listing
+        with query_budget(3):
+            response = await client.get('/checks/?include_products=false', headers=headers)
+        assert len(response.json()['items']) == 3
+
+    async def test_counts_are_not_cached_per_worker(self, client, headers, checks_collection, query_budget):
+        # without a shared cache another worker's changes could not invalidate them
+        for _ in range(2):
+            with query_budget(10) as stats:
+                await client.get('/checks/', headers=headers)
+            assert any(statement.startswith('SELECT count(*)') for statement in stats.statements)
+
+    async def test_budget_exceeded(self, client, headers, checks_collection, checks_collection_data, query_budget):
+        with pytest.raises(AssertionError, match='Expected at most 2 queries'):
+            with query_budget(2) as stats:
+                for check_data in checks_collection_data:
+                    await client.get(f"/checks/{check_data['id']}", headers=headers)
+        assert stats.most_repeated[1] == 3
+
+    async def test_slow_and_repeated_statements_are_logged(
+            self, client, headers, checks_collection, checks_collection_data, monkeypatch, caplog
+    ):
+        monkeypatch.setattr(settings, 'sql_slow_query_ms', 0)
+        monkeypatch.setattr(settings, 'sql_repeated_statement_threshold', 1)
+        await client.get('/checks/', headers=headers)
+        messages = [record.getMessage() for record in caplog.records]
+        assert any(message.startswith('Slow query') for message in messages)
+        assert any('likely N+1' in message for message in messages)
+
+
+class TestProfiling:
+    @pytest.fixture
+    def profiling_app(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(settings, 'profiling_secret', 'profiling-secret')
+        monkeypatch.setattr(settings, 'profiling_dir', str(tmp_path))
+        return create_app()
+
+    async def test_signed_request_is_profiled(self, profiling_app, tmp_path, headers, checks_collection, subtests):
+        async with AsyncClient(transport=ASGITransport(app=profiling_app), base_url='http://') as client:
+            with subtests.test(msg='test_no_token'):
+                response = await client.get('/checks/', headers=headers)
+                assert response.status_code == 200
+                assert list(tmp_path.iterdir()) == []
+
+            with subtests.test(msg='test_invalid_tokens'):
+                for token in [make_profile_token('other-secret', 60), make_profile_token('profiling-secret', -1), 'x']:
+                    await client.get('/checks/', headers={**headers, 'X-Profile-Token': token})
+                assert list(tmp_path.iterdir()) == []
+
+            with subtests.test(msg='test_valid_token'):
+                token = make_profile_token('profiling-secret', 60)
+                response = await client.get('/checks/', headers={**headers, 'X-Profile-Token': token})
+                assert response.status_code == 200
+                [profile] = tmp_path.iterdir()
+                assert profile.suffix == '.html'
+                assert 'list_checks' in profile.read_text()
+
+    def test_not_installed_when_disabled(self):
+        assert ProfilingMiddleware not in [middleware.cls for middleware in create_app().user_middleware]
+
+
+
+class TestMetrics:
+    async def test_requires_token(self, monkeypatch):
+        monkeypatch.setattr(settings, 'metrics_token', 'metrics-token')
+        async with AsyncClient(transport=ASGITransport(app=create_app()), base_url='http://') as client:
+            for headers in [{}, {'Authorization': 'Bearer other-token'}, {'Authorization': 'metrics-token'}]:
+                assert (await client.get('/metrics/', headers=headers)).status_code == 401
+            response = await client.get('/metrics/', headers={'Authorization': 'Bearer metrics-token'})
+            assert response.status_code == 200
+            assert 'http_request_db_statements' in response.text
+
+    async def test_not_served_when_disabled(self, client):
+        assert (await client.get('/metrics/')).status_code == 404
+
+class TestTracing:
+    @pytest.fixture
+    def spans(self):
+        exporter = InMemorySpanExporter()
+        setup_tracing(exporter, batch=False)
+        yield exporter
+        shutdown_tracing()
+
+    async def test_request_spans(self, client, headers, existing_check, spans):
+        response = await client.get(f'/checks/{existing_check.public_id}', headers=headers)
+        assert response.status_code == 200
+
+        finished = {span.name: span for span in spans.get_finished_spans()}
+        request_span = finished['GET /checks/{check_id}']
+        assert request_span.attributes['http.response.status_code'] == 200
+        assert request_span.attributes['request.id']
+        for name in [
+            'validate_access_token', 'get_user_from_token', 'get_db_session',
+            'endpoint retrieve_check', 'SELECT', 'serialize response'
+        ]:
+            assert finished[name].context.trace_id == request_span.context.trace_id
+            assert finished[name].parent is not None
+        statements = [span.attributes['db.statement'] for span in spans.get_finished_spans() if span.name == 'SELECT']
+        assert any(statement.startswith('SELECT checks.id') for statement in statements)
+
+    async def test_validation_and_rendering_spans(self, client, headers, check_data, spans):
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        response = await client.get(f"/checks/{response.json()['id']}/view")
+        assert response.status_code == 200
+        names = [span.name for span in spans.get_finished_spans()]
+        assert 'validate request body' in names
+        assert 'CheckOut.__format__' in names
+
+    def test_otlp_file_exporter(self, tmp_path):
+        path = tmp_path / 'traces.jsonl'
+        setup_tracing(OTLPFileSpanExporter(path))
+        with span('parent'):
+            with span('child'):
+                pass
+        shutdown_tracing()
+
+        [line] = path.read_text().splitlines()
+        exported = json.loads(line)['resourceSpans'][0]['scopeSpans'][0]['spans']
+        child, parent = exported
+        assert child['parentSpanId'] == parent['spanId']
+        assert len(parent['traceId']) == 32
+
+
+class TestSeed:
+    async def test_seeded_checks_are_consistent(self, db_session):
+        end = datetime.datetime(2026, 1, 1)
+        distribution = Distribution(
+            products_mean=3, products_max=10, cash_share=0.5, start=end - datetime.timedelta(days=30), end=end
+        )
+        plan = await seed(users=3, checks=25, distribution=distribution, workers=0, batch_size=10)
+
+        checks = (await db_session.scalars(select(Check).order_by(Check.id))).all()
+        first_check_id = plan.shards[0].first_check_id
+        assert [check.id for check in checks] == list(range(first_check_id, first_check_id + 25))
+        assert {check.user_id for check in checks} <= set(range(plan.first_user_id, plan.first_user_id + 3))
+        assert all(sharding.bucket_of_check(check.public_id) == sharding.bucket_of_user(check.user_id)
+                   for check in checks)
+        assert [check.created_at for check in checks] == sorted(check.created_at for check in checks)
+        assert {check.payment_type for check in checks} == {'cash', 'cashless'}
+        for check in checks:
+            out = schemas.CheckOut.model_validate(check)
+            assert out.total == round_money(sum(line_total(p.price, p.quantity) for p in out.products))
+            assert out.rest == out.payment.amount - out.total >= 0
+
+    async def test_checks_go_to_their_users_shard(self, db_session, shard):
+        await ShardBucket.assign(db_session, range(0, settings.shard_buckets, 2), shard=1, moving=False)
+        await db_session.commit()
+        end = datetime.datetime(2026, 1, 1)
+        distribution = Distribution(
+            products_mean=2, products_max=5, cash_share=0.5, start=end - datetime.timedelta(days=30), end=end
+        )
+        plan = await seed(users=4, checks=40, distribution=distribution, workers=0, batch_size=10)
+
+        assert sorted(plan.shards) == [0, 1]
+        assert sum(shard_plan.checks for shard_plan in plan.shards.values()) == 40
+        for shard_id, shard_plan in plan.shards.items():
+            async with get_shard_session_factory(shard_id)() as session:
+                checks = (await session.scalars(select(Check))).all()
+            assert len(checks) == shard_plan.checks
+            assert {check.user_id for check in checks} <= set(shard_plan.user_ids)
+            for user_id in shard_plan.user_ids:
+                assert await sharding.shard_map.shard_for_user(user_id) == shard_id
+            assert all(sharding.bucket_of_check(check.public_id) == sharding.bucket_of_user(check.user_id)
+                       for check in checks)
+
+
+class TestDbProxy:
+    @pytest.fixture
+    async def proxy(self, init_db):
+        async with DbProxy(ENV_VARS['DATABASE_HOST'], int(ENV_VARS['DATABASE_PORT'])) as proxy:
+            yield proxy
+
+    @staticmethod
+    async def connect(proxy):
+        return await asyncpg.connect(
+            host='127.0.0.1', port=proxy.port, user=ENV_VARS['DATABASE_USER'], database=ENV_VARS['DATABASE_NAME']
+        )
+
+    async def test_latency(self, proxy):
+        connection = await self.connect(proxy)
+        proxy.faults = Faults(latency_ms=50)
+        started = time.perf_counter()
+        assert await connection.fetchval('SELECT 1') == 1
+        assert time.perf_counter() - started >= 0.05
+        await connection.close()
+
+    async def test_reset(self, proxy):
+        connection = await self.connect(proxy)
+        proxy.faults = Faults(reset_rate=1)
+        with pytest.raises((asyncpg.ConnectionDoesNotExistError, ConnectionResetError)):
+            await connection.fetchval('SELECT 1')
+        assert proxy.resets == 1
+
+
+class TestSharding:
+    @staticmethod
+    async def count_checks(shard, user_id):
+        async with get_shard_session_factory(shard)() as session:
+            return await session.scalar(select(func.count()).where(Check.user_id == user_id))
+
+    async def test_checks_follow_the_shard_map(self, client, db_session, shard, user_data, check_data):
+        await ShardBucket.assign(db_session, range(settings.shard_buckets), shard=1, moving=False)
+        await db_session.commit()
+
+        await client.post('/users/register', json=user_data)
+        user = await User.get_by_username(session=db_session, username=user_data['username'])
+        response = await client.post('/users/login', data=user_data)
+        headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        assert response.status_code == 201
+        check_id = response.json()['id']
+
+        assert sharding.bucket_of_check(check_id) == sharding.bucket_of_user(user.id)
+        assert await self.count_checks(0, user.id) == 0
+        assert await self.count_checks(1, user.id) == 1
+        assert (await client.get(f'/checks/{check_id}', headers=headers)).status_code == 200
+        assert (await client.get('/checks/', headers=headers)).json()['total'] == 1
+        assert (await client.get(f'/checks/{check_id}/view')).status_code == 200
+
+    async def test_move_buckets(self, client, headers, user, checks_collection, checks_collection_data, check_data,
+                                shard, monkeypatch):
+        monkeypatch.setattr(settings, 'cache_url', 'redis://shared')
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        check_ids = {response.json()['id'], *(check['id'] for check in checks_collection_data)}
+        before = (await client.get('/checks/', headers=headers)).json()['items']
+        bucket = sharding.bucket_of_user(user.id)
+
+        for source, target in [(0, 1), (1, 0)]:
+            moved = await sharding.move_buckets([bucket], target=target, batch_size=2, grace_seconds=0)
+            assert moved == len(check_ids)
+            assert await self.count_checks(source, user.id) == 0
+            assert await self.count_checks(target, user.id) == len(check_ids)
+            # pre-sharding ids are found on whatever shard they are on
+            for check_id in check_ids:
+                assert (await client.get(f'/checks/{check_id}/view')).status_code == 200
+            assert (await client.get('/checks/', headers=headers)).json()['items'] == before
+        # the copies were not announced as new checks
+        async with get_shard_session_factory(1)() as session:
+            assert await session.scalar(select(func.count()).select_from(CheckFeedEntry)) == 0
+
+    async def test_writes_fail_while_moving(self, client, headers, user, checks_collection, db_session, check_data,
+                                            shard):
+        await ShardBucket.mark_moving(db_session, [sharding.bucket_of_user(user.id)])
+        await db_session.commit()
+
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After']
+        assert (await client.get('/checks/', headers=headers)).status_code == 200
+
+
+class TestJobs:
+    @pytest.fixture(autouse=True)
+    def job_settings(self, monkeypatch):
+        monkeypatch.setattr(settings, 'cache_url', 'redis://shared')
+        monkeypatch.setattr(settings, 'job_retry_backoff_seconds', 0)
+
+    @pytest.fixture
+    def worker(self):
+        return jobs.Worker(0, concurrency=10, poll_interval=0.01, visibility_timeout=5)
+
+    @pytest.fixture
+    def failing_job(self, monkeypatch):
+        async def fail(session, payload):
+            raise RuntimeError(payload['message'])
+        monkeypatch.setitem(jobs.handlers, 'fail', fail)
+        return 'fail'
+
+    @staticmethod
+    async def get_jobs(session):
+        session.expire_all()
+        return (await session.scalars(select(Job).order_by(Job.id))).all()
+
+    async def test_check_creation_jobs(self, client, headers, user, db_session, check_data, worker,
+                                       cache_backend, query_budget):
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        check_id = response.json()['id']
+        assert [job.kind for job in await self.get_jobs(db_session)] == ['render_receipt', 'warm_list_count']
+
+        assert await worker.run_once() == 2
+        assert await self.get_jobs(db_session) == []
+        receipt = await receipts_cache.get(f'{check_id}:32')
+        response = await client.get(f'/checks/{check_id}/view')
+        assert response.text == receipt
+        # the count is warm: statement timeout, principal, latest marker and page only
+        with query_budget(4):
+            response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == 1
+
+    async def test_check_is_committed_with_its_jobs(self, client, headers, user, db_session, check_data,
+                                                     monkeypatch):
+        def enqueue_and_fail(session, check):
+            jobs.enqueue_check_created(session, check)
+            raise RuntimeError('enqueue failed')
+
+        monkeypatch.setattr('service.routers.checks.enqueue_check_created', enqueue_and_fail)
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        with pytest.raises(RuntimeError):
+            await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+        assert await self.get_jobs(db_session) == []
+        assert await db_session.scalar(select(func.count()).select_from(Check)) == 0
+
+    async def test_retries_and_failure(self, db_session, init_db, worker, failing_job):
+        jobs.enqueue(db_session, failing_job, {'message': 'boom'})
+        await db_session.commit()
+
+        for attempt in range(1, settings.job_max_attempts + 1):
+            assert await worker.run_once() == 1
+            [job] = await self.get_jobs(db_session)
+            assert job.attempts == attempt
+            assert job.last_error == "RuntimeError('boom')"
+            assert job.locked_at is None
+        assert job.failed_at is not None
+        assert await worker.run_once() == 0
+
+    async def test_visibility_timeout(self, db_session, init_db, failing_job):
+        for n in range(6):
+            jobs.enqueue(db_session, failing_job, {'message': str(n)})
+        await db_session.commit()
+
+        async def claim():
+            async with get_session_factory()() as session:
+                claimed = await Job.claim(session, limit=4, visibility_timeout=60)
+                await session.commit()
+                return [job.id for job in claimed]
+
+        first, second = await asyncio.gather(claim(), claim())
+        assert len(first) + len(second) == 6
+        assert not set(first) & set(second)
+        assert await claim() == []
+
+        # a worker died: its jobs are claimed again once their timeout has passed
+        await db_session.execute(update(Job).where(Job.id.in_(first)).values(run_at=datetime.datetime(2000, 1, 1)))
+        await db_session.commit()
+        assert sorted(await claim()) == sorted(first)
+        assert {job.attempts for job in await self.get_jobs(db_session) if job.id in first} == {2}
+
+
+class TestCheckFeed:
+    @pytest.fixture
+    async def check_feed(self, init_db):
+        yield feed.check_feed
+        await feed.check_feed.close()
+
+    @pytest.fixture
+    def create_check(self, client, headers, check_data):
+        async def create():
+            payload = {'products': check_data['products'], 'payment': check_data['payment']}
+            response = await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)
+            return response.json()
+        return create
+
+    async def test_long_poll(self, client, headers, user, check_feed, create_check):
+        response = await client.get('/checks/changes', params={'wait': 0}, headers=headers)
+        start = response.json()
+        assert start['items'] == []
+
+        poll = asyncio.create_task(
+            client.get('/checks/changes', params={'since': start['cursor'], 'wait': 5}, headers=headers)
+        )
+        await asyncio.sleep(0.2)
+        assert not poll.done()
+        check = await create_check()
+        changes = (await asyncio.wait_for(poll, 5)).json()
+        assert [item['id'] for item in changes['items']] == [check['id']]
+        assert 'products' not in changes['items'][0]
+        assert changes['items'][0]['total'] == check['total']
+
+        response = await client.get('/checks/changes', params={'since': changes['cursor'], 'wait': 0}, headers=headers)
+        assert response.json()['items'] == []
+        assert feed.decode_cursor(response.json()['cursor']) == feed.decode_cursor(changes['cursor'])
+
+    async def test_cursor_is_opaque(self, client, headers, check_feed):
+        cursor = feed.encode_cursor(3, (123456789, 987654321))
+        assert '123456789' not in cursor and '987654321' not in cursor
+        assert cursor != feed.encode_cursor(3, (123456789, 987654321))
+        assert feed.decode_cursor(cursor) == (3, (123456789, 987654321))
+
+        forged = cursor[:-2] + ('AA' if cursor[-2:] != 'AA' else 'BB')
+        for since in ['0', forged, 'not a cursor']:
+            response = await client.get('/checks/changes', params={'since': since, 'wait': 0}, headers=headers)
+            assert response.status_code == 422
+            assert response.json()['detail'][0]['loc'] == ['query', 'since']
+        response = await client.get('/checks/stream', headers={**headers, 'Last-Event-ID': forged})
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['header', 'last-event-id']
+
+    async def test_checks_committed_out_of_order(self, user, check_feed, check_data, monkeypatch):
+        monkeypatch.setattr(settings, 'feed_held_back_retry_seconds', 0.01)
+
+        def check_in(n):
+            products = [{**product, 'name': f"{product['name']} {n}"} for product in check_data['products']]
+            return schemas.CheckIn.model_validate({'products': products, 'payment': check_data['payment']})
+
+        start = await feed.poll_checks(user_id=user.id, shard=0, cursor=None, wait=0)
+        async with get_session_factory()() as earlier_session, get_session_factory()() as later_session:
+            earlier = await models.Check.create(session=earlier_session, user_id=user.id, check=check_in(1))
+            later = await models.Check.create(session=later_session, user_id=user.id, check=check_in(2))
+            assert earlier.id < later.id
+            await later_session.commit()
+
+            # the later check is held back while the earlier one may still commit
+            changes = await feed.poll_checks(
+                user_id=user.id, shard=0, cursor=feed.decode_cursor(start.cursor), wait=0.1
+            )
+            assert changes.items == []
+            await earlier_session.commit()
+
+        changes = await feed.poll_checks(
+            user_id=user.id, shard=0, cursor=feed.decode_cursor(changes.cursor), wait=1
+        )
+        assert [item.public_id for item in changes.items] == [earlier.public_id, later.public_id]
+
+    async def test_held_back_subscriptions_are_rechecked_once_per_shard(self, user, check_feed, create_check,
+                                                                       monkeypatch):
+        monkeypatch.setattr(settings, 'feed_held_back_retry_seconds', 0.01)
+        get_after = models.CheckFeedEntry.get_after
+        reads = 0
+
+        async def counting_get_after(*args, **kwargs):
+            nonlocal reads
+            reads += 1
+            return await get_after(*args, **kwargs)
+        monkeypatch.setattr(models.CheckFeedEntry, 'get_after', counting_get_after)
+
+        async with get_session_factory()() as blocker:
+            await blocker.execute(text('SELECT pg_current_xact_id()'))
+            polls = [
+                asyncio.create_task(feed.poll_checks(user_id=user.id, shard=0, cursor=(0, (0, 0)), wait=5))
+                for _ in range(3)
+            ]
+            check = await create_check()
+            await asyncio.sleep(0.3)
+            assert not any(poll.done() for poll in polls)
+            assert reads <= 2 * len(polls)
+            await blocker.commit()
+
+        for poll in polls:
+            changes = await asyncio.wait_for(poll, 5)
+            assert [item.public_id for item in changes.items] == [check['id']]
+
+    async def test_cursor_of_another_shard(self, user, check_feed, create_check):
+        check = await create_check()
+        changes = await feed.poll_checks(user_id=user.id, shard=0, cursor=(1, (2 ** 40, 0)), wait=0)
+        assert [item.public_id for item in changes.items] == [check['id']]
+        assert feed.decode_cursor(changes.cursor)[0] == 0
+
+    async def test_stream(self, user, check_feed, create_check, monkeypatch):
+        monkeypatch.setattr(settings, 'feed_heartbeat_seconds', 0.1)
+        first = await create_check()
+        stream = feed.stream_checks(user_id=user.id, shard=0, cursor=(0, (0, 0)))
+
+        event = await asyncio.wait_for(anext(stream), 5)
+        cursor, name, data = event.strip().split('\n')
+        assert name == 'event: check'
+        assert json.loads(data.removeprefix('data: '))['id'] == first['id']
+        assert await asyncio.wait_for(anext(stream), 5) == ': keep-alive\n\n'
+
+        second = asyncio.create_task(create_check())
+        while (event := await asyncio.wait_for(anext(stream), 5)).startswith(':'):
+            pass
+        assert json.loads(event.strip().split('\n')[2].removeprefix('data: '))['id'] == (await second)['id']
+        assert feed.decode_cursor(event.split('\n')[0].removeprefix('id: ')) > \
+            feed.decode_cursor(cursor.removeprefix('id: '))
+        await stream.aclose()
+
+        # a reconnecting client continues from the last id it got
+        stream = feed.stream_checks(user_id=user.id, shard=0, cursor=feed.decode_cursor(cursor.removeprefix('id: ')))
+        event = await asyncio.wait_for(anext(stream), 5)
+        assert json.loads(event.strip().split('\n')[2].removeprefix('data: '))['id'] == (await second)['id']
+        await stream.aclose()
+
+
+class TestMigrationHelpers:
+    @staticmethod
+    async def migrate(operation):
+        def run(connection):
+            with Operations.context(MigrationContext.configure(connection)):
+                return operation()
+
+        async with get_db_engine().connect() as connection:
+            return await connection.run_sync(run)
+
+    @staticmethod
+    async def fetch(db_session, sql):
+        rows = (await db_session.execute(text(sql))).all()
+        await db_session.rollback()  # a concurrent index build waits for open transactions
+        return rows
+
+    async def test_backfill_resumes(self, db_session, checks_collection, checks_collection_data, monkeypatch, caplog):
+        caplog.set_level(logging.INFO, 'alembic.online')
+
+        def interrupt(seconds):
+            raise KeyboardInterrupt
+        backfill = lambda: migrations.backfill(
+            'rest_to_total', 'checks', set_='rest = total', where='rest <> total', batch_size=2
+        )
+        with monkeypatch.context() as patch:
+            patch.setattr(migrations.time, 'sleep', interrupt)
+            with pytest.raises(KeyboardInterrupt):
+                await self.migrate(backfill)
+        [(updated_rows,)] = await self.fetch(db_session, 'SELECT updated_rows FROM alembic_backfill')
+        assert 0 < updated_rows <= 2
+
+        assert await self.migrate(backfill) == len(checks_collection_data)
+        assert 'Backfill rest_to_total resumes after id=' in caplog.text
+        assert await self.fetch(db_session, 'SELECT 1 FROM checks WHERE rest <> total') == []
+        assert await self.fetch(db_session, 'SELECT 1 FROM alembic_backfill') == []
+
+    async def test_create_index_concurrently(self, db_session, init_db, monkeypatch, caplog):
+        caplog.set_level(logging.INFO, 'alembic.online')
+        create = lambda: migrations.create_index_concurrently('idx_checks_rest', 'checks', ['rest'])
+        valid = "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('idx_checks_rest')"
+
+        monkeypatch.setattr(migrations.options, 'dry_run', True)
+        await self.migrate(create)
+        assert 'would build index idx_checks_rest on checks' in caplog.text
+        assert await self.fetch(db_session, valid) == []
+
+        monkeypatch.setattr(migrations.options, 'dry_run', False)
+        for _ in range(2):
+            await self.migrate(create)
+            assert await self.fetch(db_session, valid) == [(True,)]
+
+
+class TestDeadlines:
+    @staticmethod
+    def counter(name, route):
+        return REGISTRY.get_sample_value(name, {'route': route}) or 0
+
+    @staticmethod
+    async def running_sleeps(db_session):
+        count = await db_session.scalar(text(
+            "SELECT count(*) FROM pg_stat_activity WHERE state = 'active' AND query = 'SELECT pg_sleep(10)'"
+        ))
+        await db_session.rollback()  # the activity view is a snapshot per transaction
+        return count
+
+    async def test_slow_query_times_out(self, client, headers, checks_collection, monkeypatch):
+        async def slow_count(session, **kwargs):
+            return await session.scalar(text('SELECT count(*) FROM pg_sleep(10)'))
+        monkeypatch.setattr(models.Check, 'get_count', slow_count)
+        monkeypatch.setitem(settings.request_deadlines, '/checks/', 0.5)
+        before = self.counter('http_request_deadline_exceeded_total', '/checks/')
+
+        response = await asyncio.wait_for(client.get('/checks/', headers=headers), 5)
+        assert response.status_code == 504
+        assert self.counter('http_request_deadline_exceeded_total', '/checks/') == before + 1
+
+    async def test_disconnect_cancels_query(self, db_session):
+        querying, disconnected = asyncio.Event(), asyncio.Event()
+        received = []
+
+        async def app(scope, receive, send):
+            received.append(await receive())
+            async with get_session_factory()() as session:
+                querying.set()
+                await session.execute(text('SELECT pg_sleep(10)'))
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+
+        async def receive():
+            if not received:
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            raise AssertionError('Nothing is sent to a client that is gone')
+
+        before = self.counter('http_requests_cancelled_total', 'unmatched')
+        request = asyncio.create_task(CancelOnDisconnectMiddleware(app)({'type': 'http'}, receive, send))
+        await asyncio.wait_for(querying.wait(), 5)
+        for _ in range(50):
+            if await self.running_sleeps(db_session):
+                break
+            await asyncio.sleep(0.1)
+        else:
+            pytest.fail('The query did not start')
+
+        disconnected.set()
+        await asyncio.wait_for(request, 5)
+        assert self.counter('http_requests_cancelled_total', 'unmatched') == before + 1
+        for _ in range(50):
+            if not await self.running_sleeps(db_session):
+                break
+            await asyncio.sleep(0.1)
+        else:
+            pytest.fail('The query still runs')
+
+
+class TestProducts:
+    async def test_names_are_stored_once(self, client, headers, db_session, check_data):
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        first = (await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)).json()
+        second = (await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)).json()
+        assert first['products'] == second['products']
+
+        names = {product['name'] for product in check_data['products']}
+        assert set(await db_session.scalars(select(Product.name))) == names
+        assert await db_session.scalar(select(func.count()).select_from(CheckProduct)) == 2 * len(names)
+        response = await client.get(f"/checks/{second['id']}", headers=headers)
+        assert [product['name'] for product in response.json()['products']] == [p['name'] for p in first['products']]
+
+    async def test_only_committed_ids_are_cached(self, db_session, init_db, product_id_cache):
+        ids = await Product.get_ids(db_session, ['хліб', 'сир'])
+        await db_session.rollback()
+        assert product_id_cache.get_many(get_db_url(), ids) == {}
+
+        # released savepoints wait for the commit, a rolled back one
+        # leaves nothing it could vouch for
+        async with db_session.begin_nested():
+            await Product.get_ids(db_session, ['хліб'])
+        assert product_id_cache.get_many(get_db_url(), ['хліб']) == {}
+        savepoint = await db_session.begin_nested()
+        await Product.get_ids(db_session, ['сир'])
+        await savepoint.rollback()
+        await db_session.commit()
+        assert product_id_cache.get_many(get_db_url(), ['хліб', 'сир']) == {}
+
+        ids = await Product.get_ids(db_session, ['хліб', 'сир'])
+        await db_session.commit()
+        assert product_id_cache.get_many(get_db_url(), ['хліб', 'сир']) == ids
+
+
+class TestRecentChecks:
+    @pytest.fixture(autouse=True)
+    def shared_cache(self, monkeypatch):
+        monkeypatch.setattr(settings, 'cache_url', 'redis://shared')
+
+    async def test_default_page_is_served_from_memory(
+            self, client, headers, checks_collection, check_data, recent_checks, query_budget
+    ):
+        def hits():
+            return REGISTRY.get_sample_value(
+                'cache_requests_total', {'namespace': 'recent_checks', 'result': 'hit'}
+            ) or 0
+
+        before = hits()
+        first = await client.get('/checks/', headers=headers)
+        with query_budget(0):
+            response = await client.get('/checks/', headers=headers)
+        assert response.json() == first.json()
+        assert response.headers['ETag'] == first.headers['ETag']
+
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        created = (await client.post('/checks/', json=jsonable_encoder(payload), headers=headers)).json()
+        with query_budget(0):
+            response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == 4
+        assert response.json()['items'][0] == created
+        assert hits() - before == 2
+
+        recent_checks.clear()
+        from_db = await client.get('/checks/', headers=headers)
+        assert from_db.json() == response.json()
+        assert from_db.headers['ETag'] == response.headers['ETag']
+
+    async def test_change_by_another_worker_retires_the_ring(
+            self, client, headers, db_session, user, checks_collection, check_data
+    ):
+        assert (await client.get('/checks/', headers=headers)).json()['total'] == 3
+
+        await add_check_to_db(db_session, user, check_data)
+        await db_session.commit()
+        await list_counts_cache.invalidate(scope=user.id)
+        response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == 4
+        assert check_data['id'] in [item['id'] for item in response.json()['items']]
+
+    async def test_coalesced_checks_are_added(self, client, headers, checks_collection, check_data, monkeypatch,
+                                              query_budget):
+        monkeypatch.setattr(settings, 'check_write_coalescing', True)
+        await client.get('/checks/', headers=headers)
+        payload = {'products': check_data['products'], 'payment': check_data['payment']}
+        created = await asyncio.gather(*(
+            client.post('/checks/', json=jsonable_encoder(payload), headers=headers) for _ in range(2)
+        ))
+        with query_budget(0):
+            response = await client.get('/checks/', headers=headers)
+        assert response.json()['total'] == 5
+        assert {item['id'] for item in response.json()['items'][:2]} == {r.json()['id'] for r in created}
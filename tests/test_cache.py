@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+
+from fakeredis import FakeAsyncRedis, FakeServer
+
+from service.cache import Cache, LocalCacheBackend, RedisCacheBackend
+
+
+@pytest.fixture
+def redis_server():
+    return FakeServer()
+
+
+def make_backend(kind, redis_server):
+    if kind == 'local':
+        return LocalCacheBackend(max_entries=100)
+    return RedisCacheBackend(FakeAsyncRedis(server=redis_server))
+
+
+@pytest.fixture(params=['local', 'redis'])
+def backend(request, redis_server):
+    return make_backend(request.param, redis_server)
+
+
+class TestLocalCacheBackend:
+    async def test_lru_eviction(self):
+        backend = LocalCacheBackend(max_entries=2)
+        await backend.set('a', b'1')
+        await backend.set('b', b'2')
+        await backend.get('a')
+        await backend.set('c', b'3')
+        assert await backend.get('a') == b'1'
+        assert await backend.get('b') is None
+        assert await backend.get('c') == b'3'
+
+    async def test_ttl(self):
+        backend = LocalCacheBackend()
+        await backend.set('a', b'1', ttl=0.01)
+        await asyncio.sleep(0.02)
+        assert await backend.get('a') is None
+
+
+class TestCache:
+    async def test_get_or_set(self, backend):
+        cache = Cache('test', ttl=60, backend=backend)
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return {'value': 42}
+
+        results = await asyncio.gather(*(cache.get_or_set('key', loader) for _ in range(5)))
+        assert results == [{'value': 42}] * 5
+        assert await cache.get_or_set('key', loader) == {'value': 42}
+        assert calls == 1
+
+    async def test_none_is_not_cached(self, backend):
+        cache = Cache('test', ttl=60, backend=backend)
+
+        async def loader():
+            return None
+
+        assert await cache.get_or_set('key', loader) is None
+        assert await cache.get('key') is None
+
+    async def test_scope_invalidation(self, backend):
+        cache = Cache('test', ttl=60, backend=backend)
+        await cache.set('key', 1, scope=7)
+        await cache.set('key', 1, scope=8)
+        await cache.invalidate(scope=7)
+        assert await cache.get('key', scope=7) is None
+        assert await cache.get('key', scope=8) == 1
+
+    async def test_invalidate_returns_replaced_generation(self, backend):
+        cache = Cache('test', ttl=60, backend=backend)
+        previous, current = await cache.invalidate(scope=1)
+        assert previous is None
+        assert await cache.generation(1) == current
+        assert await cache.invalidate(scope=1) == (current, await cache.generation(1))
+
+    async def test_invalidation_across_workers(self, redis_server):
+        first = Cache('test', ttl=60, backend=make_backend('redis', redis_server))
+        second = Cache('test', ttl=60, backend=make_backend('redis', redis_server))
+        await first.set('count', 3, scope=1)
+        assert await second.get('count', scope=1) == 3
+        await second.invalidate(scope=1)
+        assert await first.get('count', scope=1) is None
+
+    async def test_waits_for_other_worker_lock(self, redis_server):
+        first = Cache('test', ttl=60, backend=make_backend('redis', redis_server))
+        second = Cache('test', ttl=60, backend=make_backend('redis', redis_server))
+        second.lock_poll_interval = 0.01
+        release = asyncio.Event()
+        calls = []
+
+        async def loader(name):
+            calls.append(name)
+            await release.wait()
+            return name
+
+        leader = asyncio.create_task(first.get_or_set('key', lambda: loader('first')))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(second.get_or_set('key', lambda: loader('second')))
+        await asyncio.sleep(0.02)
+        release.set()
+        assert await asyncio.gather(leader, follower) == ['first', 'first']
+        assert calls == ['first']
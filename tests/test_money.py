@@ -0,0 +1,119 @@
+import os
+import random
+import subprocess
+import sys
+import pytest
+
+from decimal import Decimal
+from pydantic_core import PydanticCustomError
+from sqlalchemy import text
+
+from service.config import get_db_engine, settings
+from service.main import create_app
+from service.money_columns import MINOR_UNITS, NUMERIC, check_storage, convert
+from service.utils import to_minor_units, format_minor_units, line_total, quantize_money
+from tests.consts import ENV_VARS
+
+
+SCHEMAS_SNIPPET = """
+from datetime import datetime
+from service import schemas
+
+check = schemas.CheckIn.model_validate({
+    'products': [
+        {'name': 'олія', 'price': 7.77, 'quantity': '1.337'},
+        {'name': 'борошно', 'price': '42.42', 'quantity': 0.999},
+        {'name': 'сіль', 'price': '5.00', 'quantity': '3.000'},
+    ],
+    'payment': {'type': 'cash', 'amount': '100.00'},
+})
+print(check.model_dump_json())
+out = schemas.CheckOut.model_validate({
+    **check.model_dump(exclude={'products': {'__all__': {'total'}}}),
+    'public_id': 'ch_0000000000000000000000',
+    'created_at': datetime(2025, 1, 1),
+})
+print(out.model_dump_json(by_alias=True))
+print(f'{out:32}')
+"""
+
+
+class TestMinorUnits:
+    @pytest.mark.parametrize('value, scale, expected', [
+        ('7.77', 2, 777),
+        ('1.3370', 3, 1337),
+        ('.5', 2, 50),
+        (' 12 ', 2, 1200),
+        (5, 2, 500),
+        (7.7, 2, 770),
+        (Decimal('1E+2'), 2, 10000),
+        ('1e3', 3, 1000000),
+    ])
+    def test_to_minor_units(self, value, scale, expected):
+        assert to_minor_units(value, scale) == expected
+
+    @pytest.mark.parametrize('value, error_type', [
+        ('1.001', 'decimal_max_places'),
+        (Decimal('0.005'), 'decimal_max_places'),
+        ('abc', 'decimal_parsing'),
+        ('.', 'decimal_parsing'),
+        ('NaN', 'finite_number'),
+        (True, 'decimal_type'),
+    ])
+    def test_to_minor_units_rejects(self, value, error_type):
+        with pytest.raises(PydanticCustomError) as exc_info:
+            to_minor_units(value, 2)
+        assert exc_info.value.type == error_type
+
+    def test_format_minor_units(self):
+        assert format_minor_units(5277, 2) == '52.77'
+        assert format_minor_units(1000, 3) == '1.000'
+        assert format_minor_units(-5, 2) == '-0.05'
+
+    def test_line_total_rounds_like_decimal(self):
+        rng = random.Random(0)
+        for _ in range(10_000):
+            price, quantity = rng.randrange(10 ** 6), rng.randrange(10 ** 6)
+            expected = quantize_money(Decimal(price).scaleb(-2) * Decimal(quantity).scaleb(-3))
+            assert line_total(price, quantity) == to_minor_units(expected, 2)
+
+    def test_api_format_is_the_same_in_both_modes(self):
+        outputs = [
+            subprocess.run(
+                [sys.executable, '-c', SCHEMAS_SNIPPET],
+                env={**os.environ, **ENV_VARS, 'MONEY_MINOR_UNITS': minor_units},
+                check=True, capture_output=True, text=True
+            ).stdout
+            for minor_units in ('false', 'true')
+        ]
+        assert outputs[0] == outputs[1]
+
+
+class TestMoneyColumns:
+    @staticmethod
+    async def fetch_amounts() -> tuple[str, str]:
+        async with get_db_engine().connect() as connection:
+            return tuple((await connection.execute(text(
+                'SELECT total::text, quantity::text FROM checks JOIN check_products ON check_id = checks.id '
+                'ORDER BY check_products.id LIMIT 1'
+            ))).one())
+
+    async def test_convert_there_and_back(self, db_session, existing_check):
+        await db_session.close()  # its transaction would hold off the conversion's lock
+        current, other = (MINOR_UNITS, NUMERIC) if settings.money_minor_units else (NUMERIC, MINOR_UNITS)
+        before = await self.fetch_amounts()
+
+        assert await convert(0, other)
+        assert not await convert(0, other)
+        assert await self.fetch_amounts() == (('52.77', '1.337') if other == NUMERIC else ('5277', '1337'))
+        assert await convert(0, current)
+        assert await self.fetch_amounts() == before
+
+    async def test_startup_refuses_mismatched_columns(self, init_db, monkeypatch):
+        await check_storage(0)
+        monkeypatch.setattr(settings, 'money_minor_units', not settings.money_minor_units)
+
+        app = create_app()
+        with pytest.raises(RuntimeError, match='service.money_columns convert'):
+            async with app.router.lifespan_context(app):
+                pass
@@ -0,0 +1,70 @@
+import asyncio
+import pytest
+
+from service.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    async def test_concurrent_calls_share_result(self):
+        flight = SingleFlight('test')
+        release = asyncio.Event()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return object()
+
+        tasks = [asyncio.create_task(flight.do('key', fetch)) for _ in range(5)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert calls == 1
+        assert all(result is results[0] for result in results)
+
+    async def test_different_keys_are_not_coalesced(self):
+        flight = SingleFlight('test')
+
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return value
+
+        results = await asyncio.gather(flight.do('a', lambda: fetch(1)), flight.do('b', lambda: fetch(2)))
+        assert results == [1, 2]
+
+    async def test_exception_is_shared(self):
+        flight = SingleFlight('test')
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            raise ValueError('boom')
+
+        tasks = [asyncio.create_task(flight.do('key', fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    async def test_followers_retry_when_leader_cancelled(self):
+        flight = SingleFlight('test')
+        release = asyncio.Event()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return calls
+
+        leader = asyncio.create_task(flight.do('key', fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do('key', fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await follower == 2
+        with pytest.raises(asyncio.CancelledError):
+            await leader